@@ -2,7 +2,7 @@ import sys
 from webservice_tools.utils import BaseHandler
 import datetime
 from piston.handler import BaseHandler
-from webservice_tools.decorators import login_required
+from webservice_tools.decorators import login_required, cache_response
 from webservice_tools.response_util import ResponseObject
 from webservice_tools import utils
 from django.db import models
@@ -13,6 +13,7 @@ PROFILE_MODEL = models.get_model(app_label, model_name)
 
 class BadgeHandler(BaseHandler):
     allowed_methods = ('GET',)
+    @cache_response(depends_on=(BadgeModel, BadgeToUser), per_user=False)
     @login_required
     def read(self, request, id, response):
         """
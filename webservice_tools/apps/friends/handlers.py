@@ -26,6 +26,8 @@ class FriendsHandler(BaseHandler):
             @page_number [integer] Page number to start paging on (optional)
             @limit [integer] number of results to display on page (optional)
             @query [string] query to filter against friends (optional)
+            @after [string] 'next' cursor from a previous page, pages by cursor instead of page_number (optional)
+            @before [string] 'previous' cursor from a previous page, pages by cursor instead of page_number (optional)
         
         Returns:
             @friends [User_list] see user documentation for return values
@@ -33,6 +35,8 @@ class FriendsHandler(BaseHandler):
         page_number = request.GET.get('page_number', 1)
         limit = request.GET.get('limit', 10)
         query = request.GET.get('query', '')
+        after = request.GET.get('after')
+        before = request.GET.get('before')
         try:
             profile = PROFILE_MODEL.objects.get(id=id)
         except PROFILE_MODEL.DoesNotExist:
@@ -42,7 +46,13 @@ class FriendsHandler(BaseHandler):
             friends = friends.filter(Q(user__username__icontains=query) | Q(user__first_name__icontains=query) | 
                                      Q(user__last_name__icontains=query) | Q(user__email__icontains=query))
         
-        friends, page_dict = utils.auto_page(friends, page_number=page_number, limit=limit)
+        if after or before:
+            try:
+                friends, page_dict = utils.cursor_page(friends, after=after, before=before, limit=limit)
+            except ValueError, e:
+                return response.send(errors="%s." % e)
+        else:
+            friends, page_dict = utils.auto_page(friends, page_number=page_number, limit=limit)
         friends = [f.dict() for f in friends]
         response.set(friends=friends, paging=page_dict)
         return response.send()
@@ -47,6 +47,26 @@ def data_delete(fn):
 
 
 
+def cache_response(timeout=60 * 5, vary_on=None, depends_on=(), per_user=True):
+    """
+    Caches the serialized response of a handler's read in the django cache, see utils.Resource
+    The cached body is dropped whenever a row of the handler's model, or of any model in depends_on,
+    is saved or deleted.
+
+    timeout -- seconds a cached response is kept
+    vary_on -- GET params that change the response, None for all of them
+    depends_on -- models, besides handler.model, the response is built from
+    per_user -- cache separately per user, otherwise only logged in and anonymous requests are kept apart
+
+    Users are told apart by request.user (django's session auth), so it can't be used on a Resource with a piston
+    authenticator (HTTP Basic, OAuth...), whose checks a cached response would skip.
+    """
+    def _cache_response(fn):
+        fn.response_cache = {'timeout': timeout, 'vary_on': vary_on, 'depends_on': tuple(depends_on),
+                             'per_user': per_user}
+        return fn
+    return _cache_response
+
 
 def retry(tries=5, exceptions=None, delay=0.3, exception_raise=None):
     """
@@ -1,6 +1,13 @@
 import re
+import time
+import random
+import hashlib
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
 from webservice_tools.utils import Resource
-from webservice_tools.models import StoredHandlerResponse, StoredHandlerRequest, StoredHttpParam
+from webservice_tools.models import StoredHandlerResponse, StoredHandlerRequest, StoredHttpParam, APIChangeLogEntry
 call_map = {'GET': 'read', 'POST': 'create',
             'PUT': 'update', 'DELETE': 'delete'}
 #VAR_REGEX = r'^[@][\w]+\ \[[\w\[\]]+\]\ .+' # @parameter [type] some comment
@@ -9,66 +16,121 @@ VAR_SPLIT_REGEX = r'[\s\t\ ]+\@'
 
 RETURN_VAL_REGEX = r'^[\s\t\ ]+\@\@.+'
 RETURN_VAL_SPLIT_REGEX = r'[\s\t\ ]+\@\@'
+
+VAR_RE = re.compile(VAR_REGEX, re.MULTILINE | re.DOTALL)
+VAR_SPLIT_RE = re.compile(VAR_SPLIT_REGEX)
+API_HANDLER_RE = re.compile(r'api handler\:? (?P<method>post|put|get|delete)[\ ](?P<url>.+)', re.IGNORECASE)
+API_HANDLER_COMMENT_RE = re.compile(r'^(?P<comment>.*)api handler', re.IGNORECASE | re.DOTALL)
+VAR_DECLARATION_RE = re.compile(r'^(?P<name>[\w]+)[\ ]+\[(?P<type>[\w\[\]]+)\][\ ]*(?P<comment>.*)', re.DOTALL)
+OPTIONAL_RE = re.compile(r'\(optional\)')
+
+# parsed docstrings by function object, docstrings only change with the code so these are never invalidated
+_parsed_docstrings = {}
+
+# set CODE_VERSION (e.g. the deployed revision) so every process agrees on the docs ETag,
+# otherwise each process uses its start time and builds its own copy of the docs
+CODE_VERSION = getattr(settings, 'CODE_VERSION', None) or str(time.time())
+DOCS_GENERATION_KEY = 'server_declaration:generation'
+DOCS_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def group_by(items, key):
+    ret = {}
+    for item in items:
+        ret.setdefault(key(item), []).append(item)
+    return ret
+
+
 class ServerDeclaration():
+    """
+    The documented handlers, built from the url conf and the handlers' docstrings alone so it only changes with
+    the code. The stored example requests and responses are read separately, see with_examples()
+    """
     
     def __init__(self):
         self.handlers = self.crawl_urls()
         self.handler_list = []
         
-        self.all_responses = list(StoredHandlerResponse.objects.all())
-        self.all_requests = list(StoredHandlerRequest.objects.all())
-        self.all_params = list(StoredHttpParam.objects.all())
         for handler in self.handlers:
             self.handler_list.append({'name': re.sub('Handler$', '', handler.__class__.__name__),
+                                      'handler_id': str(handler.__class__),
                                       'methods': self.get_methods(handler)})  
         
         self.handler_list.sort(key=lambda x: x['name'])
+        self.handler_index = dict((h['name'], h) for h in self.handler_list)
+        self.method_index = dict(((h['name'], m['request_method']), m) for h in self.handler_list for m in h['methods'])
+    
+    def with_examples(self):
+        """
+        Returns a copy of handler_list with each method's stored test requests and example response
+        """
+        responses_by_method = {}
+        for s in StoredHandlerResponse.objects.all():
+            responses_by_method.setdefault((s.handler_id, s.method), s)
+        requests_by_method = group_by(StoredHandlerRequest.objects.all(), lambda t: (t.handler_id, t.method))
+        params_by_request = group_by(StoredHttpParam.objects.all(), lambda p: p.request_id)
+        
+        ret = []
+        for handler in self.handler_list:
+            methods = []
+            for method in handler['methods']:
+                key = (handler['handler_id'], method['request_method'])
+                stored_response = responses_by_method.get(key)
+                tests = [t.serialize([p.dict() for p in params_by_request.get(t.id, [])])
+                         for t in requests_by_method.get(key, [])]
+                methods.append(dict(method, tests=tests,
+                                    example_response=stored_response and stored_response.response or ''))
+            ret.append(dict(handler, methods=methods))
+        return ret
     
     def get_methods(self, handler):
         ret = []
-        id = str(handler.__class__)
-        stored_responses = [s for s in self.all_responses if s.handler_id == id]
-        all_tests = [t for t in self.all_requests if t.handler_id == id]
         for request_method in handler.allowed_methods:
-            stored_response = [s for s in stored_responses if s.method == request_method]
-            tests = [t.serialize([s.dict() for s in self.all_params if s.request_id==t.id]) for t in all_tests if t.method == request_method]
-            example_response = ''
-            if stored_response:
-                example_response = stored_response[0].response
-            
             method_name = call_map[request_method]
             method = getattr(handler, method_name)
-            docstring = method.__doc__
             auth_required = False
             if hasattr(method, 'authentication_required'):
                 auth_required = True
-            api_handler = self._get_method_api_handler(docstring)
+            parsed = self._parse_docstring(method)
             
             ret.append({'name': method_name, 'request_method': request_method,
-                        'url': api_handler.get('url'), 'comment': api_handler.get('comment'),
-                        'params': self._get_method_params(docstring), 'auth_required': auth_required,
-                        'return_vals': self._get_return_vals(docstring), 'example_response': example_response, "tests": tests})
+                        'url': parsed['api_handler'].get('url'), 'comment': parsed['api_handler'].get('comment'),
+                        'params': [dict(p) for p in parsed['params']], 'auth_required': auth_required,
+                        'return_vals': [dict(r) for r in parsed['return_vals']]})
         return ret
+    
+    def _parse_docstring(self, method):
+        """
+        Parses a handler method's docstring once per function object
+        """
+        func = getattr(method, 'im_func', method)
+        parsed = _parsed_docstrings.get(func)
+        if parsed is None:
+            docstring = method.__doc__
+            parsed = _parsed_docstrings[func] = {'api_handler': self._get_method_api_handler(docstring),
+                                                 'params': self._get_method_params(docstring),
+                                                 'return_vals': self._get_return_vals(docstring)}
+        return parsed
             
     def _get_method_api_handler(self, docstring):
         if not docstring:
             return {}
         
-        api_handler = re.search(r'api handler\:? (?P<method>post|put|get|delete)[\ ](?P<url>.+)', docstring, flags=re.IGNORECASE)
+        api_handler = API_HANDLER_RE.search(docstring)
         if api_handler:
             ret = api_handler.groupdict()
-            comment = re.search(r'^(?P<comment>.*)api handler', docstring, flags=re.IGNORECASE | re.DOTALL)
+            comment = API_HANDLER_COMMENT_RE.search(docstring)
             if comment:
                 ret['comment'] = comment.groupdict()['comment'].replace('\n', '<br/>')
             return ret
         return {}
     
     def _get_method_params(self, docstring):
-        return self._parse_params(docstring, VAR_REGEX, VAR_SPLIT_REGEX, 0)
+        return self._parse_params(docstring, VAR_RE, VAR_SPLIT_RE, 0)
             
     def _get_return_vals(self, docstring):
        if docstring and 'Returns:' in docstring:
-           return self._parse_params(docstring, VAR_REGEX, VAR_SPLIT_REGEX, 1)
+           return self._parse_params(docstring, VAR_RE, VAR_SPLIT_RE, 1)
        return []
        
     def _parse_params(self, docstring, regex, split_regex, idx):
@@ -76,21 +138,21 @@ class ServerDeclaration():
        if not docstring:
            return ret
     
-       params = re.findall(regex, docstring.split('Returns:')[idx], flags=re.MULTILINE | re.DOTALL)
+       params = regex.findall(docstring.split('Returns:')[idx])
        if params:
-           params = [f.strip() for f in re.split(split_regex, params[0]) if f.strip()]
+           params = [f.strip() for f in split_regex.split(params[0]) if f.strip()]
        for param in params:
            ret.append(self._get_dict_from_var_declaration(param))
        return ret
      
     def _get_dict_from_var_declaration(self, declaration):
-        param = re.search(r'^(?P<name>[\w]+)[\ ]+\[(?P<type>[\w\[\]]+)\][\ ]*(?P<comment>.*)', declaration, flags=re.DOTALL)
+        param = VAR_DECLARATION_RE.search(declaration)
         if not param:
             return {}
         param = param.groupdict()
-        param['comment'] = re.sub('\n', '<br />', param['comment'])
-        if re.search('(optional)', declaration):
-            param['comment'] = re.sub('\(optional\)', '', param['comment'])
+        param['comment'] = param['comment'].replace('\n', '<br />')
+        if 'optional' in declaration:
+            param['comment'] = OPTIONAL_RE.sub('', param['comment'])
             param['required'] = '0'
         else:
             param['required'] = '1' 
@@ -118,5 +180,45 @@ class ServerDeclaration():
         
         _crawl_urls(urls.urlpatterns)
         return ret
-            
-        
+
+
+_declaration = None
+_declaration_lock = threading.Lock()
+
+
+def declaration_version():
+    """
+    Changes whenever the code version changes or any stored request/response/param or changelog entry is saved or
+    deleted, i.e. whenever the rendered docs may differ
+    """
+    return '%s:%s' % (CODE_VERSION, cache.get(DOCS_GENERATION_KEY))
+
+
+def docs_etag():
+    return hashlib.md5(declaration_version()).hexdigest()
+
+
+def get_server_declaration():
+    """
+    Returns this process' ServerDeclaration, built once as it only depends on the code
+    """
+    global _declaration
+    declaration = _declaration
+    if declaration is None:
+        with _declaration_lock:
+            if _declaration is None:
+                _declaration = ServerDeclaration()
+            declaration = _declaration
+    return declaration
+
+
+def invalidate_docs(**kwargs):
+    """
+    Moves the docs ETag on when the stored examples or the changelog change, the ServerDeclaration itself stays
+    """
+    cache.set(DOCS_GENERATION_KEY, '%s.%s' % (time.time(), random.randint(0, 1000000)), DOCS_CACHE_TIMEOUT)
+
+
+for model in (StoredHandlerResponse, StoredHandlerRequest, StoredHttpParam, APIChangeLogEntry):
+    post_save.connect(invalidate_docs, sender=model, dispatch_uid='invalidate_docs')
+    post_delete.connect(invalidate_docs, sender=model, dispatch_uid='invalidate_docs')
@@ -0,0 +1,249 @@
+"""
+Shared outbound HTTP client
+
+Keeps a pool of persistent (keep-alive) connections per host so repeated calls to the same API skip the
+TCP and TLS handshakes, applies timeouts per connection rather than through socket.setdefaulttimeout
+(which is process wide and unsafe in threaded workers), and transparently decodes gzipped responses.
+Responses and errors look like urllib2's so callers can switch over without other changes.
+"""
+import httplib
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+import zlib
+from StringIO import StringIO
+
+DEFAULT_TIMEOUT = 10 # seconds
+MAX_IDLE_PER_HOST = 8 # idle connections kept per host
+IDLE_TIMEOUT = 30 # seconds an idle connection is reused for, most servers drop keep-alives soon after
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307)
+# methods safe to send again when a reused connection turns out to be dead
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE')
+
+
+def _is_dropped_connection(error):
+    """
+    True for the BadStatusLine httplib raises on an empty status line, i.e. the server closed the connection
+    without answering (2.7 releases differ on whether it carries the empty line, its repr or a message)
+    """
+    return isinstance(error, httplib.BadStatusLine) and \
+        (not (error.line or '').strip("'") or 'closed the connection' in error.line)
+
+
+class HTTPResponse(object):
+    """
+    A fully read response, with the parts of urllib2's response object callers rely on
+    """
+
+    def __init__(self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.fp = StringIO(body)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        self.fp.close()
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections to a single scheme/host/port
+    """
+
+    def __init__(self, scheme, host, port, max_idle=MAX_IDLE_PER_HOST, idle_timeout=IDLE_TIMEOUT):
+        self.connection_class = scheme == 'https' and httplib.HTTPSConnection or httplib.HTTPConnection
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """
+        Returns a (connection, reused) pair, reusing the most recently released connection if it's still fresh
+        """
+        now = time.time()
+        conn = None
+        with self._lock:
+            while self._idle:
+                last_used, idle_conn = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = idle_conn
+                    break
+                idle_conn.close()
+
+        if conn is None:
+            return self.connection_class(self.host, self.port, timeout=timeout), False
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((time.time(), conn))
+                return
+        conn.close()
+
+    def idle_count(self):
+        return len(self._idle)
+
+    def close(self):
+        with self._lock:
+            for _, conn in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class HTTPClient(object):
+    """
+    Thread safe HTTP client pooling connections per host
+    """
+
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST, idle_timeout=IDLE_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'connections_created': 0, 'connections_reused': 0,
+                       'retries': 0, 'errors': 0, 'gzip_decoded': 0}
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = ConnectionPool(scheme, host, port, self.max_idle_per_host,
+                                                         self.idle_timeout)
+        return pool
+
+    def urlopen(self, url, data=None, headers=None, timeout=DEFAULT_TIMEOUT, method=None, decode_gzip=True):
+        """
+        Makes a request and returns an HTTPResponse, following redirects the way urllib2 does.
+        Raises urllib2.HTTPError for 4xx/5xx responses and urllib2.URLError if the server can't be reached.
+
+        data -- request body, the request is a POST when it's supplied unless method says otherwise
+        timeout -- seconds to wait on connect and on each socket read
+        decode_gzip -- ask for a gzipped body and decompress it before returning
+        """
+        headers = dict(headers or {})
+        if decode_gzip:
+            headers.setdefault('Accept-Encoding', 'gzip')
+        for _ in xrange(MAX_REDIRECTS + 1):
+            response = self._request(url, data, headers, timeout, method or (data is not None and 'POST' or 'GET'))
+            location = response.headers.get('location')
+            if response.code not in REDIRECT_CODES or not location:
+                break
+            url = urlparse.urljoin(url, location)
+            if response.code != 307:
+                # like urllib2, follow 301/302/303 with a GET
+                data, method = None, 'GET'
+
+        if response.code >= 400:
+            raise urllib2.HTTPError(url, response.code, response.msg, response.headers, response.fp)
+        return response
+
+    def _request(self, url, data, headers, timeout, method):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (scheme == 'https' and 443 or 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if data is not None and 'Content-Type' not in headers:
+            headers = dict(headers, **{'Content-Type': 'application/x-www-form-urlencoded'})
+
+        pool = self._get_pool(scheme, parts.hostname, port)
+        self._count('requests')
+        while True:
+            conn, reused = pool.acquire(timeout)
+            self._count(reused and 'connections_reused' or 'connections_created')
+            sent = False
+            try:
+                conn.request(method, path, data, headers)
+                sent = True
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # the server may have dropped the idle connection, in which case the request can go again on a
+                # fresh one, but only if it's idempotent and didn't get through (or got no answer at all), and
+                # never after a timeout, which would just double the wait
+                if reused and method in IDEMPOTENT_METHODS and not isinstance(e, socket.timeout) and \
+                  (not sent or _is_dropped_connection(e)):
+                    self._count('retries')
+                    continue
+                self._count('errors')
+                raise urllib2.URLError(e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            pool.release(conn)
+
+        content_encoding = (response.getheader('content-encoding') or '').lower()
+        if content_encoding in ('gzip', 'deflate'):
+            try:
+                if content_encoding == 'gzip':
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                else:
+                    try:
+                        body = zlib.decompress(body)
+                    except zlib.error:
+                        # raw deflate stream without the zlib header
+                        body = zlib.decompress(body, -zlib.MAX_WBITS)
+            except zlib.error, e:
+                self._count('errors')
+                raise urllib2.URLError(e)
+            self._count('gzip_decoded')
+        return HTTPResponse(url, response.status, response.reason, response.msg, body)
+
+    def stats(self):
+        """
+        Returns request/connection counters plus the idle connections held per host
+        """
+        with self._lock:
+            ret = dict(self._stats)
+            pools = self._pools.items()
+        ret['idle_connections'] = dict(('%s://%s:%s' % key, pool.idle_count()) for key, pool in pools)
+        return ret
+
+    def close(self):
+        with self._lock:
+            pools = self._pools.values()
+            self._pools = {}
+        for pool in pools:
+            pool.close()
+
+
+http_client = HTTPClient()
+
+
+def urlopen(url, data=None, headers=None, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """
+    Module level shortcut for the shared client, see HTTPClient.urlopen
+    """
+    return http_client.urlopen(url, data, headers=headers, timeout=timeout, **kwargs)
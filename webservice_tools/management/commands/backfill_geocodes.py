@@ -0,0 +1,198 @@
+import os
+import time
+import hashlib
+import threading
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, connection, transaction
+from django.utils import encoding
+from django.utils.importlib import import_module
+from webservice_tools import utils
+from webservice_tools.models import BaseGeoModel
+
+STUB_GEOCODER_LATENCY = 0.05 # seconds, roughly a geocoder round trip
+
+
+def default_geocoder(address):
+    return utils.GeoCode(address).getCoords()
+
+
+def stub_geocoder(address):
+    """
+    Offline geocoder for benchmarks and tests, sleeps for STUB_GEOCODER_LATENCY to stand in for
+    the network round trip, then derives a stable (lng, lat) from the address hash
+    usage: --geocoder=webservice_tools.management.commands.backfill_geocodes.stub_geocoder
+    """
+    time.sleep(STUB_GEOCODER_LATENCY)
+    digest = hashlib.md5(encoding.smart_str(address)).hexdigest()
+    lng = int(digest[:8], 16) / float(0xffffffff) * 360 - 180
+    lat = int(digest[8:16], 16) / float(0xffffffff) * 180 - 90
+    return lng, lat
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to wait() at least 1/rate seconds apart across all threads, a rate of 0 disables it
+    """
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate or 0
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Command(BaseCommand):
+    """
+    Backfills (or with --all, refreshes) geolocation for a BaseGeoModel subclass
+    Addresses are geocoded by a bounded pool of threads, rate limited across the pool, and the points
+    are written back with one UPDATE per batch. With --checkpoint the last written primary key is
+    recorded after every batch, and a rerun with the same file resumes from there.
+    """
+    args = '<app_label.ModelName>'
+    help = "Geocode rows of a BaseGeoModel subclass in bulk"
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Refresh every row, not just the ones without a geolocation'),
+        make_option('--threads', type='int', dest='threads', default=8,
+            help='Number of concurrent geocoder calls (default 8)'),
+        make_option('--rate', type='float', dest='rate', default=10,
+            help='Max geocoder requests per second across all threads, 0 for no limit (default 10)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=200,
+            help='Rows written per UPDATE (default 200)'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File to record progress in and resume from'),
+        make_option('--geocoder', dest='geocoder', default=None,
+            help='Dotted path to a callable taking an address and returning (lng, lat)'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            app_label, model_name = args[0].split('.')
+        except (IndexError, ValueError):
+            raise CommandError("Please provide a model as app_label.ModelName")
+        model = models.get_model(app_label, model_name)
+        if model is None or not issubclass(model, BaseGeoModel):
+            raise CommandError("%s is not a BaseGeoModel subclass" % args[0])
+
+        self.model = model
+        self.geocoder = self._load_geocoder(options['geocoder'])
+        self.limiter = RateLimiter(options['rate'])
+        batch_size = max(options['batch_size'], 1)
+        checkpoint_file = options['checkpoint']
+        last_pk = self._read_checkpoint(checkpoint_file)
+
+        queryset = model.objects.order_by('pk').only('pk', *model.ADDRESS_FIELDS)
+        if not options['all']:
+            queryset = queryset.filter(geolocation__isnull=True)
+
+        pool = ThreadPool(max(options['threads'], 1))
+        done = failed = 0
+        start = time.time()
+        try:
+            while True:
+                rows = queryset
+                if last_pk is not None:
+                    rows = rows.filter(pk__gt=last_pk)
+                rows = list(rows[:batch_size])
+                if not rows:
+                    break
+
+                results = pool.map(self._geocode, [(row.pk, row.address) for row in rows])
+                points = [(pk, point) for pk, point in results if point is not None]
+                failed += len(rows) - len(points)
+                self._write_batch(points)
+                done += len(points)
+                last_pk = rows[-1].pk
+                self._write_checkpoint(checkpoint_file, last_pk)
+
+                elapsed = time.time() - start
+                print "%s geocoded, %s failed, last id %s (%.1f rows/s)" % (done, failed, last_pk,
+                                                                          (done + failed) / (elapsed or 1))
+        finally:
+            pool.close()
+            pool.join()
+
+        print "Done: %s rows geocoded, %s failed in %.1fs" % (done, failed, time.time() - start)
+
+    def _load_geocoder(self, path):
+        if not path:
+            return default_geocoder
+        module_name, _, attr = path.rpartition('.')
+        try:
+            return getattr(import_module(module_name), attr)
+        except (ImportError, AttributeError, ValueError):
+            raise CommandError("Could not import geocoder %s" % path)
+
+    def _geocode(self, row):
+        pk, address = row
+        self.limiter.wait()
+        try:
+            lng, lat = self.geocoder(address)
+        except Exception, e:
+            print "Could not geocode id %s (%r): %s" % (pk, address, e)
+            return pk, None
+        return pk, utils.location_from_coords(lat, lng)
+
+    @transaction.commit_on_success
+    def _write_batch(self, points):
+        """
+        Writes a batch of points with a single UPDATE ... FROM (VALUES ...) statement, falling back
+        to one UPDATE per row if the batch fails (e.g. two rows resolving to the same unique point)
+        """
+        if not points:
+            return
+        qn = connection.ops.quote_name
+        meta = self.model._meta
+        table = qn(meta.db_table)
+        pk_column = qn(meta.pk.column)
+        field = meta.get_field('geolocation')
+        geo_column = qn(field.column)
+        values = ', '.join(["(%%s, ST_GeomFromText(%%s, %s))" % field.srid] * len(points))
+        sql = "UPDATE %s SET %s = data.geom FROM (VALUES %s) AS data(id, geom) WHERE %s.%s = data.id" % (
+            table, geo_column, values, table, pk_column)
+        params = []
+        for pk, point in points:
+            params.extend([pk, point.wkt])
+
+        sid = transaction.savepoint()
+        try:
+            connection.cursor().execute(sql, params)
+            transaction.savepoint_commit(sid)
+        except Exception, e:
+            transaction.savepoint_rollback(sid)
+            print "Batch update failed (%s), writing rows one at a time" % e
+            for pk, point in points:
+                sid = transaction.savepoint()
+                try:
+                    self.model.objects.filter(pk=pk).update(geolocation=point)
+                    transaction.savepoint_commit(sid)
+                except Exception, e:
+                    transaction.savepoint_rollback(sid)
+                    print "Could not update id %s: %s" % (pk, e)
+
+    def _read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            return int(open(path).read().strip())
+        except ValueError:
+            raise CommandError("Checkpoint file %s does not contain an id" % path)
+
+    def _write_checkpoint(self, path, pk):
+        if not path:
+            return
+        tmp_path = path + '.tmp'
+        f = open(tmp_path, 'w')
+        f.write(str(pk))
+        f.close()
+        os.rename(tmp_path, path)
@@ -0,0 +1,69 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from webservice_tools import utils
+
+
+def queryset_variants(model):
+    """
+    The ways rows of a model usually reach toDict, as (name, queryset) pairs: plain rows, and rows
+    with cached relations, annotations or deferred fields, which take the serializer plan's fallback path
+    """
+    queryset = model._default_manager.order_by('pk')
+    variants = [('loaded', queryset)]
+    if any(isinstance(field, models.ForeignKey) for field in model._meta.fields):
+        variants.append(('select_related', queryset.select_related()))
+    variants.append(('annotated', queryset.extra(select={'benchtodict_extra': '1'})))
+    deferrable = [field.name for field in model._meta.fields if not field.primary_key]
+    if deferrable:
+        variants.append(('deferred', queryset.defer(deferrable[-1])))
+    return variants
+
+
+class Command(BaseCommand):
+    """
+    Times toDict's compiled serializer plans against the reflective attribute walk
+    Requires the model as app_label.ModelName, optionally followed by the number of rows (default 10000)
+    Rows are read from the model's table (which must have some), once per queryset variant, before timing
+    """
+    args = '<app_label.ModelName> [count]'
+    help = "Benchmark toDict serializer plans against the reflective walk"
+
+    def handle(self, *args, **options):
+        try:
+            app_label, model_name = args[0].split('.')
+        except (IndexError, ValueError):
+            raise CommandError("Please provide a model as app_label.ModelName")
+        model = models.get_model(app_label, model_name)
+        if model is None:
+            raise CommandError("No such model: %s" % args[0])
+        try:
+            count = int(args[1])
+        except IndexError:
+            count = 10000
+        except ValueError:
+            raise CommandError("count must be an integer")
+
+        for name, queryset in queryset_variants(model):
+            instances = list(queryset[:count])
+            if not instances:
+                raise CommandError("%s has no rows to benchmark against" % args[0])
+            if utils.toDict(instances[0]) != utils._reflective_to_dict(instances[0]):
+                raise CommandError("Serializer plan output differs from the reflective walk for %s (%s)"
+                                   % (args[0], name))
+
+            start = time.time()
+            for instance in instances:
+                utils._reflective_to_dict(instance)
+            reflective = time.time() - start
+
+            start = time.time()
+            for instance in instances:
+                utils.toDict(instance)
+            compiled = time.time() - start
+
+            print "%s rows of %s, %s" % (len(instances), args[0], name)
+            print "  reflective walk: %.4fs" % reflective
+            print "  serializer plan: %.4fs" % compiled
+            if compiled:
+                print "  speedup: %.2fx" % (reflective / compiled)
@@ -0,0 +1,188 @@
+"""
+Per-handler request metrics
+
+Each process keeps cumulative histograms keyed by (handler_id, method) in memory and periodically
+writes a snapshot to the cache under its own key. merged_snapshot() combines the snapshots of every
+process that has reported, so any worker can serve the totals for the whole deployment.
+"""
+import os
+import socket
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+METRICS_FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10) # seconds between cache writes
+METRICS_TIMEOUT = getattr(settings, 'METRICS_TIMEOUT', 60 * 60 * 24) # a process' snapshot expires this long after its last write
+METRICS_CACHE_PREFIX = 'handler_metrics'
+METRICS_INDEX_KEY = METRICS_CACHE_PREFIX + ':processes'
+
+# upper bounds of the histogram buckets, the last bucket holds everything larger
+TIME_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000) # milliseconds
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576) # bytes
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram that also tracks count, sum and max
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        index = len(self.bounds)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                index = i
+                break
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return {'bounds': list(self.bounds), 'buckets': list(self.buckets), 'count': self.count,
+                'total': self.total, 'max': self.max}
+
+
+def merge_histograms(a, b):
+    """
+    Merges two histogram dicts (see Histogram.to_dict) with the same bounds
+    """
+    return {'bounds': a['bounds'],
+            'buckets': [x + y for x, y in zip(a['buckets'], b['buckets'])],
+            'count': a['count'] + b['count'],
+            'total': a['total'] + b['total'],
+            'max': max(a['max'], b['max'])}
+
+
+def histogram_percentile(histogram, percentile):
+    """
+    Returns the upper bound of the bucket the given percentile (0-100) falls in, None if it's in the overflow bucket
+    """
+    if not histogram['count']:
+        return 0
+    target = histogram['count'] * percentile / 100.0
+    seen = 0
+    for bound, count in zip(histogram['bounds'], histogram['buckets']):
+        seen += count
+        if seen >= target:
+            return bound
+    return None
+
+
+class HandlerStats(object):
+
+    def __init__(self):
+        self.time = Histogram(TIME_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.query_time = Histogram(TIME_BUCKETS)
+        self.size = Histogram(SIZE_BUCKETS)
+        self.status = {}
+
+    def add(self, elapsed, status, query_count=None, query_time=None, size=None):
+        self.time.add(elapsed)
+        self.status[status] = self.status.get(status, 0) + 1
+        if query_count is not None:
+            self.queries.add(query_count)
+            self.query_time.add(query_time)
+        if size is not None:
+            self.size.add(size)
+
+    def to_dict(self):
+        return {'time': self.time.to_dict(),
+                'queries': self.queries.to_dict(),
+                'query_time': self.query_time.to_dict(),
+                'size': self.size.to_dict(),
+                'status': dict(self.status)}
+
+
+def merge_stats(a, b):
+    status = dict(a['status'])
+    for code, count in b['status'].items():
+        status[code] = status.get(code, 0) + count
+    ret = dict((name, merge_histograms(a[name], b[name])) for name in ('time', 'queries', 'query_time', 'size'))
+    ret['status'] = status
+    return ret
+
+
+def summarize(stats):
+    """
+    Adds count, mean and p50/p95/p99 latency (bucket upper bounds, in ms) to a stats dict
+    """
+    time_histogram = stats['time']
+    count = time_histogram['count']
+    summary = {'count': count,
+               'mean_ms': count and float(time_histogram['total']) / count or 0,
+               'max_ms': time_histogram['max'],
+               'errors': sum(n for code, n in stats['status'].items() if int(code) >= 500)}
+    for p in (50, 95, 99):
+        summary['p%s_ms' % p] = histogram_percentile(time_histogram, p)
+    queries = stats['queries']
+    if queries['count']:
+        summary['mean_queries'] = float(queries['total']) / queries['count']
+        summary['mean_query_ms'] = float(stats['query_time']['total']) / queries['count']
+    if stats['size']['count']:
+        summary['mean_size'] = float(stats['size']['total']) / stats['size']['count']
+    return dict(stats, summary=summary)
+
+
+class MetricsRegistry(object):
+    """
+    In-process metrics, flushed to the cache at most every METRICS_FLUSH_INTERVAL seconds
+    """
+
+    def __init__(self):
+        self.process_id = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def record(self, handler_id, method, elapsed, status, query_count=None, query_time=None, size=None):
+        key = '%s %s' % (handler_id, method)
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = HandlerStats()
+            stats.add(elapsed, status, query_count, query_time, size)
+            flush = time.time() - self._last_flush >= METRICS_FLUSH_INTERVAL
+            if flush:
+                self._last_flush = time.time()
+        if flush:
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return dict((key, stats.to_dict()) for key, stats in self.stats.items())
+
+    def flush(self):
+        """
+        Writes this process' cumulative snapshot to the cache and makes sure it's listed in the index
+        """
+        cache.set('%s:%s' % (METRICS_CACHE_PREFIX, self.process_id), self.snapshot(), METRICS_TIMEOUT)
+        processes = cache.get(METRICS_INDEX_KEY) or []
+        if self.process_id not in processes:
+            # concurrent writers can drop each other's id, which is put back on that process' next flush
+            cache.set(METRICS_INDEX_KEY, processes + [self.process_id], METRICS_TIMEOUT)
+
+    def merged_snapshot(self):
+        """
+        Combines the snapshots of every process that has reported, using the live numbers for this process
+        """
+        processes = [p for p in cache.get(METRICS_INDEX_KEY) or [] if p != self.process_id]
+        keys = ['%s:%s' % (METRICS_CACHE_PREFIX, p) for p in processes]
+        snapshots = [self.snapshot()] + cache.get_many(keys).values()
+        merged = {}
+        for snapshot in snapshots:
+            for key, stats in snapshot.items():
+                merged[key] = key in merged and merge_stats(merged[key], stats) or stats
+        return merged
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,109 @@
+import zlib
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.encoding import smart_str
+
+# responses smaller than this aren't worth the cpu, streamed responses are always compressed
+COMPRESSION_MIN_SIZE = getattr(settings, 'COMPRESSION_MIN_SIZE', 1024)
+# zlib level by content type, types not listed here (images, already compressed archives...) are sent as is
+COMPRESSION_LEVELS = getattr(settings, 'COMPRESSION_LEVELS', {'application/json': 6,
+                                                              'text/xml': 6,
+                                                              'application/xml': 6,
+                                                              'text/html': 6,
+                                                              'text/plain': 6})
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Picks gzip or deflate from an Accept-Encoding header, honouring q values, None if neither is acceptable
+    """
+    qualities = {}
+    for part in accept_encoding.split(','):
+        pieces = part.strip().split(';')
+        coding = pieces[0].strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        q = 1.0
+        for param in pieces[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if coding:
+            qualities[coding] = q
+
+    wildcard = qualities.get('*', 0)
+    best, best_q = None, 0
+    for coding in ('gzip', 'deflate'):
+        q = qualities.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compression_level(content_type):
+    return COMPRESSION_LEVELS.get(content_type.split(';')[0].strip().lower())
+
+
+def compress_string(content, coding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+    return compressor.compress(content) + compressor.flush()
+
+
+def compress_stream(chunks, coding, level, charset):
+    """
+    Compresses an iterable body as it's consumed, yielding whatever the compressor has ready after each chunk
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+    for chunk in chunks:
+        data = compressor.compress(smart_str(chunk, charset))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class CompressResponse(object):
+    """
+    Gzip/deflate compresses the responses utils.Resource produces (see its compressible flag) when the
+    client's Accept-Encoding allows it. Streamed bodies are compressed chunk by chunk as they're sent,
+    bodies that already have a Content-Encoding are left alone.
+    Goes first in MIDDLEWARE_CLASSES so the other middleware log, measure and store the uncompressed body.
+    """
+
+    def process_response(self, request, response):
+        if not getattr(response, 'compressible', False) or response.status_code != 200 or \
+          response.has_header('Content-Encoding'):
+            return response
+
+        level = compression_level(response.get('Content-Type', ''))
+        if not level:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        coding = negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if not coding:
+            return response
+
+        if getattr(response, 'streaming', False):
+            response._container = compress_stream(response._container, coding, level, response._charset)
+            if response.has_header('Content-Length'):
+                del response['Content-Length']
+        else:
+            content = response.content
+            if len(content) < COMPRESSION_MIN_SIZE:
+                return response
+            compressed = compress_string(content, coding, level)
+            if len(compressed) >= len(content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        response['Content-Encoding'] = coding
+        etag = response.get('ETag')
+        if etag and not etag.startswith('W/'):
+            # the compressed bytes differ from the identity body the ETag was computed from
+            response['ETag'] = 'W/' + etag
+        return response
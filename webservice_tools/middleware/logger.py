@@ -1,37 +1,217 @@
 import logging
-from webservice_tools.utils import toDict
+import logging.handlers
+import atexit
 import datetime
+import os
+import random
+import re
+import threading
+import traceback
+import Queue
+import simplejson
+from django.conf import settings
 
 logger = logging.getLogger('webservice')
 
+# {path regex: fraction of requests logged}, the first matching pattern wins, e.g. {r'^/services/feed/': 0.05}
+SAMPLE_RATES = [(re.compile(pattern), rate) for pattern, rate in
+                getattr(settings, 'REQUEST_LOG_SAMPLE_RATES', {}).items()]
+DEFAULT_SAMPLE_RATE = getattr(settings, 'REQUEST_LOG_SAMPLE_RATE', 1.0)
+MAX_RESPONSE_LOG_LENGTH = 5000
+LOGGED_META_KEYS = ('REMOTE_ADDR', 'CONTENT_TYPE', 'CONTENT_LENGTH', 'QUERY_STRING')
+
+
+def sample_rate(path):
+    for pattern, rate in SAMPLE_RATES:
+        if pattern.match(path):
+            return rate
+    return DEFAULT_SAMPLE_RATE
+
+
 class LoggingMiddleware(object):
-    
+    """
+    Logs a structured record of each API request/response to the 'webservice' logger at DEBUG level.
+    Nothing is collected unless that level is enabled and the request is sampled (errors are always
+    logged), and the record is a plain dict of references so formatting is left to the handler.
+    Pair it with AsyncJSONLinesHandler to keep formatting and file I/O off the request thread.
+    """
+
     def process_response(self, request, response):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return response
+
         if '/static/' in request.path:
             return response
-        
-        if 'html' in response.get('Content-Type', '') or 'javascript' in response.get('Content-Type', ''):
+
+        content_type = response.get('Content-Type', '')
+        if 'html' in content_type or 'javascript' in content_type:
+            return response
+
+        if response.status_code < 400 and random.random() >= sample_rate(request.path):
             return response
-        
-        log = "-------------------------------------\n%(timestamp)s\n%(headers)s\n%(request)s\nHANDLER: %(method)s %(url)s\nRESPONSE\n%(response)s\n-------------------------------------\n" 
-        msg = ""
+
+        record = {'timestamp': datetime.datetime.utcnow(),
+                  'method': request.method,
+                  'url': request.path,
+                  'status': response.status_code,
+                  'headers': dict((k, v) for k, v in request.META.iteritems()
+                                  if k.startswith('HTTP_') or k in LOGGED_META_KEYS)}
         try:
             if request.GET:
-                msg += "REQUEST GET: %s" % toDict(request.GET)
+                record['get'] = request.GET.lists()
             if request.POST:
-                msg += "REQUEST POST: %s" % toDict(request.POST)
+                record['post'] = request.POST.lists()
             if request.FILES:
-                msg += 'FILES: %s' % ','.join([f.name for f in request.FILES.itervalues()])
+                record['files'] = [f.name for f in request.FILES.itervalues()]
         except Exception, e:
-            msg += "Error retreiving request data: %s" % e
-        
-        headers = ''
-        for k, v in request.META.iteritems():
-            headers += '%s: %s\n' % (k,v )
-        logger.debug(log % {'request': msg,
-                             'method': request.method,
-                             'response': str(response).decode('utf-8')[:5000],
-                             'url': request.path,
-                             'timestamp': datetime.datetime.utcnow(),
-                             'headers': headers})
+            record['request_error'] = e
+
+        if getattr(response, 'streaming', False):
+            # reading the body would exhaust the generator before it reaches the client
+            record['response'] = None
+        else:
+            record['response'] = response.content[:MAX_RESPONSE_LOG_LENGTH]
+        logger.debug(record)
         return response
+
+
+class AsyncJSONLinesHandler(logging.Handler):
+    """
+    Logging handler that queues records and writes them from a background thread as JSON lines,
+    one write per batch, rotating the file like RotatingFileHandler.
+    emit() only enqueues, if the queue is full the record is dropped and counted rather than blocking.
+    The writer thread is started by the first emit() of each process, so workers forked after logging is
+    configured (gunicorn, uwsgi) get their own thread and queue instead of the parent's.
+
+    'handlers': {
+        'request_log': {
+            'class': 'webservice_tools.middleware.logger.AsyncJSONLinesHandler',
+            'filename': '%s/logs/requests.log' % PROJECT_PATH,
+            'maxBytes': 10000000,
+            'backupCount': 5
+        }
+    }
+    """
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, queueSize=10000, batchSize=200, flushInterval=1.0):
+        logging.Handler.__init__(self)
+        self.target = logging.handlers.RotatingFileHandler(filename, maxBytes=maxBytes,
+                                                           backupCount=backupCount, delay=True)
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.queueSize = queueSize
+        self.dropped = 0
+        self.queue = Queue.Queue(queueSize)
+        self._stopped = threading.Event()
+        self._worker = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def _start_worker(self):
+        if self._pid is not None:
+            # forked: whatever is queued belongs to the parent, and a lock held by one of its threads
+            # at fork time would never be released here
+            self.queue = Queue.Queue(self.queueSize)
+            self.dropped = 0
+            self._stopped = threading.Event()
+            self.target.createLock()
+        self._pid = os.getpid()
+        self._worker = threading.Thread(target=self._run, name='AsyncJSONLinesHandler')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def emit(self, record):
+        # Handler.handle() holds self.lock here, so only one thread per process starts the worker
+        if self._pid != os.getpid():
+            self._start_worker()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def format_record(self, record):
+        if isinstance(record.msg, dict):
+            data = dict(record.msg)
+        else:
+            data = {'message': record.getMessage()}
+        data.setdefault('timestamp', datetime.datetime.utcfromtimestamp(record.created))
+        data['level'] = record.levelname
+        data['logger'] = record.name
+        if isinstance(data.get('response'), str):
+            data['response'] = data['response'].decode('utf-8', 'replace')
+        if record.exc_info:
+            data['exception'] = ''.join(traceback.format_exception(*record.exc_info))
+        return simplejson.dumps(data, default=self._default)
+
+    def _default(self, obj):
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
+        return repr(obj)
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flushInterval)]
+        except Queue.Empty:
+            return []
+        while len(batch) < self.batchSize:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.format_record(record))
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        data = '\n'.join(lines) + '\n'
+        target = self.target
+        target.acquire()
+        try:
+            if target.stream is None:
+                target.stream = target._open()
+            if target.maxBytes and target.stream.tell() + len(data) >= target.maxBytes:
+                target.doRollover()
+                if target.stream is None:
+                    target.stream = target._open()
+            target.stream.write(data)
+            target.stream.flush()
+        except Exception:
+            self.handleError(batch[-1])
+        finally:
+            target.release()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        batch = True
+        while batch:
+            batch = []
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._pid == os.getpid():
+            self._worker.join(self.flushInterval * 2)
+            self.flush()
+        self.target.close()
+        logging.Handler.close(self)
@@ -1,9 +1,11 @@
 import re
+import time
 from webservice_tools.response_util import ResponseObject
+from webservice_tools import metrics
 from webservice_tools.models import StoredHandlerResponse, StoredHandlerRequest, StoredHttpParam
-from webservice_tools.doc_generator.server_declaration import ServerDeclaration
+from webservice_tools.doc_generator.server_declaration import get_server_declaration
 from django.conf import settings
-from django.db import transaction
+from django.db import transaction, connections
 
 class ProvideResponse(object):
     
@@ -29,6 +31,52 @@ class ProvideResponse(object):
         return None
 
 
+class HandlerMetrics(object):
+    """
+    Records wall time, DB query count and time, response size and status for each piston handler call,
+    keyed by request.handler_id and method (see webservice_tools.metrics). Goes after ProvideResponse.
+    Queries are counted by turning on the debug cursor for the request, set METRICS_COUNT_QUERIES = False
+    to skip that overhead.
+    """
+    
+    def process_view(self, request, view, args, kwargs):
+        if not hasattr(request, 'handler_id'):
+            return None
+        
+        request._metrics_start = time.time()
+        if getattr(settings, 'METRICS_COUNT_QUERIES', True):
+            request._metrics_queries = {}
+            for conn in connections.all():
+                request._metrics_queries[conn.alias] = (conn.use_debug_cursor, len(conn.queries))
+                conn.use_debug_cursor = True
+        return None
+    
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        
+        elapsed = (time.time() - start) * 1000
+        query_count = query_time = None
+        if hasattr(request, '_metrics_queries'):
+            query_count = query_time = 0
+            for conn in connections.all():
+                if conn.alias not in request._metrics_queries:
+                    continue
+                use_debug_cursor, offset = request._metrics_queries[conn.alias]
+                conn.use_debug_cursor = use_debug_cursor
+                queries = conn.queries[offset:]
+                query_count += len(queries)
+                query_time += sum(float(q['time']) for q in queries) * 1000
+        
+        if getattr(response, 'streaming', False):
+            size = response.has_header('Content-Length') and int(response['Content-Length']) or None
+        else:
+            size = len(response.content)
+        
+        metrics.registry.record(request.handler_id, request.method, elapsed, response.status_code,
+                                query_count, query_time, size)
+        return response
 
 
 class DocBuilder(object):
@@ -37,15 +85,16 @@ class DocBuilder(object):
     def process_view(self, request, view, args, kwargs):
         if request.META.get('HTTP_STORE_AS_TEST') and \
           hasattr(view, 'callmap') and hasattr(request, 'handler_id'):
-            server_declaration = ServerDeclaration()
-            handlers = server_declaration.handler_list
-            handler_data = [h for h in handlers if h['name'] == re.sub('Handler$', '', view.handler.__class__.__name__)]
-            method_data = [m for m in handler_data[0]['methods'] if m['request_method'] == request.method]
+            server_declaration = get_server_declaration()
+            method_data = server_declaration.method_index.get((re.sub('Handler$', '', view.handler.__class__.__name__),
+                                                               request.method))
+            if method_data is None:
+                return None
             
             stored_handler_request = StoredHandlerRequest.objects.create(path=request.path, method=request.method,
                                                                           handler_id=request.handler_id, test=True)
                 
-            for param in method_data[0]['params']:
+            for param in method_data['params']:
                 
                 name = param['name']
                 if name in getattr(request, request.method):
@@ -58,6 +107,9 @@ class DocBuilder(object):
             if hasattr(request, 'handler_id'):
                 handler_id = request.handler_id
                 stored_response = StoredHandlerResponse.objects.get_or_create(handler_id=handler_id, method=request.method)[0]
+                if getattr(response, 'streaming', False):
+                    # buffer the streamed body so the client still receives it after we've read it
+                    response.content = response.content
                 stored_response.response = response.content
                 stored_response.save()
         return response
@@ -73,10 +73,23 @@ class BaseGeoModel(models.Model):
     zip = models.CharField(max_length=10, default='', blank=True)
     geolocation = models.PointField(unique=True, null=True, blank=True)
     objects = models.GeoManager()
+    # set to True to save rows straight away and have utils.geocode_queue fill in geolocation afterwards
+    defer_geocoding = False
+    ADDRESS_FIELDS = ('street', 'city', 'state', 'zip', 'country')
     
     class Meta:
         abstract = True
     
+    def __init__(self, *args, **kwargs):
+        super(BaseGeoModel, self).__init__(*args, **kwargs)
+        # remember which address the stored geolocation belongs to, kept on _state so toDict never sees it.
+        # read the raw values so loading a row doesn't build a geometry or fetch deferred fields
+        loaded = self.__dict__
+        if loaded.get('geolocation') is not None and all(f in loaded for f in self.ADDRESS_FIELDS):
+            self._state.geocoded_address = self.address
+        else:
+            self._state.geocoded_address = None
+    
     def dict(self):
         ret = utils.toDict(self)
         del ret['geolocation']
@@ -100,13 +113,31 @@ class BaseGeoModel(models.Model):
     def __unicode__(self):
         return self.name
     
+    def address_changed(self):
+        """
+        True if the address differs from the one the current geolocation was looked up for
+        """
+        return self.geolocation is None or self.address != self._state.geocoded_address
+    
     def save(self, *args, **kwargs):
         """
         Overload save function to grab the geo location for this address
-        so it is readily available later
+        so it is readily available later, rows whose address hasn't changed skip the geocoder
         """
-        geo_code = list(utils.GeoCode(self.address).getCoords())
-        geo_code.reverse()
-        if geo_code:
-            self.geolocation = utils.location_from_coords(*geo_code)
+        geocode = self.address_changed()
+        if geocode:
+            if self.defer_geocoding:
+                # the old point no longer matches the address, utils.geocode_queue fills in the new one
+                self.geolocation = None
+            else:
+                geo_code = list(utils.GeoCode(self.address).getCoords())
+                geo_code.reverse()
+                if geo_code:
+                    self.geolocation = utils.location_from_coords(*geo_code)
         super(BaseGeoModel, self).save(*args, **kwargs) #IGNORE:E1002 -- parent is not an old-style class
+        if geocode:
+            if self.defer_geocoding:
+                utils.geocode_queue.put(self.__class__, self.pk, self.address,
+                                        dict((f, getattr(self, f)) for f in self.ADDRESS_FIELDS))
+            else:
+                self._state.geocoded_address = self.address
@@ -28,6 +28,10 @@ class ResponseObject():
         self._status = 200
         self.doc = None
         self.headers = {}
+        # filled in by utils.Resource before the handler runs
+        self.emitter_format = None
+        self.if_none_match = ''
+        self.etag = None
         
         if self._request:
             message_sent.connect(self.message_callback, sender=None, dispatch_uid='response_receiver')
@@ -89,6 +93,17 @@ class ResponseObject():
     def get(self, key):
         return self._data[key]
     
+    def not_modified(self, *version):
+        """
+        Derives this response's ETag from a cheap version key (e.g. a last modified timestamp and a row count)
+        instead of the serialized body. Returns True when the client already has that version,
+        in which case send() returns a 304 and the handler can skip building the response:
+            if response.not_modified(profile.id, profile.friends_updated):
+                return response.send()
+        """
+        self.etag = utils.make_etag(self.emitter_format, *version)
+        return utils.etag_matches(self.if_none_match, self.etag)
+    
     def setStatus(self, status):
         assert isinstance(status, int)
         self._status = status
@@ -105,6 +120,12 @@ class ResponseObject():
         if messages:
             self.addMessages(messages)
         
+        if self._messages:
+            # messages aren't covered by the version key, let the body hash decide instead
+            self.etag = None
+        elif self.success and self._status == 200 and utils.etag_matches(self.if_none_match, self.etag):
+            return utils.not_modified_response(self.etag)
+        
         responseDict = {}
         responseDict['data'] = self._data
         responseDict['errors'] = self._errors
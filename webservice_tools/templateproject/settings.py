@@ -69,11 +69,13 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'webservice_tools.middleware.compression.CompressResponse',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'webservice_tools.middleware.response.ProvideResponse',
+    'webservice_tools.middleware.response.HandlerMetrics',
     'webservice_tools.middleware.logger.LoggingMiddleware',
     'webservice_tools.middleware.exception.WebServiceException',
     'django.middleware.transaction.TransactionMiddleware',
@@ -122,7 +124,7 @@ LOGGING = {
           'level': 'ERROR'
        },
        'file_log': {
-           'class': 'logging.handlers.RotatingFileHandler',
+           'class': 'webservice_tools.middleware.logger.AsyncJSONLinesHandler',
            'level': 'DEBUG',
            'filename': '%s/logs/log' % PROJECT_PATH,
            'maxBytes': 200000, 
@@ -142,3 +144,7 @@ LOGGING = {
       }
   },
 }
+
+# fraction of successful requests written to the request log, per path regex (errors are always logged)
+REQUEST_LOG_SAMPLE_RATE = 1.0
+REQUEST_LOG_SAMPLE_RATES = {}
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the twisted data access helpers:
+
+    python -m webservice_tools.twisted.benchmarks memcache --latency=0.5 --keys=50
+    python -m webservice_tools.twisted.benchmarks codec --rows=500
+
+@license:    See LICENSE file for more information
+"""
+
+#############################
+#MODULE DEPENDENCIES
+#############################
+#General deps
+import sys
+import time
+import datetime
+import decimal
+import simplejson
+from optparse import OptionParser
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import basic
+from twisted.python import log
+
+#Project specific deps
+from webservice_tools.twisted import cachecodec, memcache, singleton
+
+
+#############################
+#MODULE FUNCTIONALITY
+#############################
+def _timeIt(func, iterations):
+    start = time.time()
+    for _ in xrange(iterations):
+        func()
+    return (time.time() - start) / iterations * 1000000 #microseconds per call
+
+
+class StandInMemcacheProtocol(basic.LineReceiver):
+    """Just enough of the memcached text protocol (get, set, delete) to benchmark the client side against.
+    
+    Each reply is sent factory.latency seconds after its command arrived, standing in for the network. A
+    command arriving while no reply is outstanding starts a new round-trip (factory.roundTrips), commands
+    pipelined behind it share it. Deletes are acknowledged but not applied, so every round sees the same data.
+    """
+
+    def connectionMade(self):
+        self.transport.setTcpNoDelay(True)
+        self._outstanding = 0
+        self._pendingSet = None
+        self._buffer = ''
+
+
+    def lineReceived(self, line):
+        if not self._outstanding:
+            self.factory.roundTrips += 1
+        parts = line.split()
+        if parts[0] in ('get', 'gets'):
+            self._reply(''.join(["VALUE %s %i %i\r\n%s\r\n" % (key, self.factory.data[key][0],
+                len(self.factory.data[key][1]), self.factory.data[key][1])
+                for key in parts[1:] if key in self.factory.data]) + "END\r\n")
+        elif parts[0] == 'set':
+            self._pendingSet = (parts[1], int(parts[2]), int(parts[4]))
+            self._outstanding += 1 #a reply is owed once the data arrives
+            self.setRawMode()
+        elif parts[0] == 'delete':
+            self._reply(parts[1] in self.factory.data and "DELETED\r\n" or "NOT_FOUND\r\n")
+        else:
+            self._reply("ERROR\r\n")
+
+
+    def rawDataReceived(self, data):
+        self._buffer += data
+        key, flags, length = self._pendingSet
+        if len(self._buffer) < length + 2:
+            return
+        self.factory.data[key] = (flags, self._buffer[:length])
+        rest, self._buffer, self._pendingSet = self._buffer[length + 2:], '', None
+        self._outstanding -= 1
+        self._reply("STORED\r\n")
+        self.setLineMode(rest)
+
+
+    def _reply(self, data):
+        self._outstanding += 1
+        reactor.callLater(self.factory.latency, self._sendReply, data)
+
+
+    def _sendReply(self, data):
+        self._outstanding -= 1
+        self.transport.write(data)
+
+
+
+def benchMemcache(options):
+    """Compares the per-key memcache helpers against retrieveMany/storeMany/retrieveAndDelete, in time and in
+    round-trips to an in-process memcached stand-in with options.latency ms of simulated network latency
+    """
+    factory = protocol.ServerFactory()
+    factory.protocol = StandInMemcacheProtocol
+    factory.latency = options.latency / 1000.0
+    factory.data = {}
+    factory.roundTrips = 0
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    keys = ['bench:%i' % i for i in xrange(options.keys)]
+    value = 'x' * 100
+
+    @defer.inlineCallbacks
+    def perKeyRetrieve():
+        for key in keys:
+            yield memcache.retrieve(key)
+
+    @defer.inlineCallbacks
+    def perKeyStore():
+        for key in keys:
+            yield memcache.store(key, value)
+
+    @defer.inlineCallbacks
+    def getThenDelete():
+        #how retrieve(clearOnRetrieval=True) used to work: a get, then a delete once the get came back
+        client = singleton.get('memCacheClient')
+        for key in keys:
+            yield client.get(key)
+            yield client.delete(key)
+
+    @defer.inlineCallbacks
+    def retrieveAndDelete():
+        for key in keys:
+            yield memcache.retrieveAndDelete(key)
+
+    cases = (('retrieve x%i' % len(keys), perKeyRetrieve),
+             ('retrieveMany', lambda: memcache.retrieveMany(keys)),
+             ('store x%i' % len(keys), perKeyStore),
+             ('storeMany', lambda: memcache.storeMany(dict([(key, value) for key in keys]))),
+             ('get, then delete x%i' % len(keys), getThenDelete),
+             ('retrieveAndDelete x%i' % len(keys), retrieveAndDelete))
+
+    @defer.inlineCallbacks
+    def run():
+        #a single connection, so round-trips aren't split across parallel connections
+        yield memcache.connectToMemcached([('127.0.0.1', port.getHost().port)], connectionsPerNode=1)
+        yield memcache.storeMany(dict([(key, value) for key in keys]))
+        for name, func in cases:
+            yield func() #warm up
+            factory.roundTrips = 0
+            start = time.time()
+            for _ in xrange(options.rounds):
+                yield func()
+            elapsed = (time.time() - start) / options.rounds * 1000 #milliseconds per round
+            print "%-24s %8.2f ms/round %8.1f round-trips/round" % (name, elapsed,
+                float(factory.roundTrips) / options.rounds)
+
+    d = run()
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+def benchCodec(options):
+    """Compares the size and encode/decode time of a wide fetch='a' style result set cached as bare JSON (as it
+    used to be) and through each cachecodec codec
+    """
+    now = datetime.datetime(2010, 3, 17, 1, 54, 7)
+    rows = tuple([(i, u"user%i@example.com" % i, u"Some display name %i" % i, now + datetime.timedelta(minutes=i),
+                   decimal.Decimal('%i.%02i' % (i, i % 100)), i % 3 == 0, None, 42.5, u"active", i * 1000)
+                  for i in xrange(options.rows)])
+    
+    #JSON can't take the datetimes and Decimals (dbutil used to skip caching such results), so time it on the
+    # rows with those stringified
+    jsonRows = [[isinstance(x, (datetime.datetime, decimal.Decimal)) and str(x) or x for x in row] for row in rows]
+    formats = [('bare json', jsonRows, simplejson.dumps, lambda data: simplejson.loads(data, encoding='utf-8'))]
+    for codec in sorted(cachecodec._codecsByName):
+        formats.append((codec, codec == 'json' and jsonRows or rows,
+            lambda value, codec=codec: cachecodec.encode(value, codec), cachecodec.decode))
+    
+    iterations = options.iterations // 10 or 1
+    for name, value, dumps, loads in formats:
+        data = dumps(value)
+        print "%-10s %8i bytes %10.1f us encode %10.1f us decode   same types: %s" % (name, len(data),
+            _timeIt(lambda: dumps(value), iterations), _timeIt(lambda: loads(data), iterations), loads(data) == rows)
+
+
+BENCHMARKS = {'memcache': benchMemcache, 'codec': benchCodec}
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%%prog [options] %s" % '|'.join(sorted(BENCHMARKS)))
+    parser.add_option('-n', '--iterations', dest='iterations', type='int', default=2000)
+    parser.add_option('--latency', dest='latency', type='float', default=0.5,
+        help="simulated memcached round-trip latency, in ms")
+    parser.add_option('--keys', dest='keys', type='int', default=50, help="keys per memcache benchmark round")
+    parser.add_option('--rounds', dest='rounds', type='int', default=20, help="memcache benchmark rounds")
+    parser.add_option('--rows', dest='rows', type='int', default=500, help="rows in the codec benchmark's result set")
+    options, args = parser.parse_args(argv)
+    if not args or args[0] not in BENCHMARKS:
+        parser.error("please name a benchmark")
+    BENCHMARKS[args[0]](options)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
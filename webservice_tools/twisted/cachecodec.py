@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization of cached DB results for memcached
+
+Encoded values start with a small header (a zero byte, which JSON text never starts with, then the format
+version, the codec ID and flags), so the codec can change without invalidating what's already cached, and values
+cached as bare JSON by older code still decode. The default 'binary' codec is a pickle restricted to the types a
+DB result can hold, so cached hits come back with the same tuples, datetimes and Decimals as a live query.
+
+@license:    See LICENSE file for more information
+"""
+
+#############################
+#MODULE DEPENDENCIES
+#############################
+#General deps
+import cPickle
+import datetime
+import decimal
+import struct
+import zlib
+from cStringIO import StringIO
+import simplejson
+
+
+#############################
+#MODULE-LEVEL VARIABLES
+#############################
+HEADER = struct.Struct('!BBBB') #marker (0), format version, codec ID, flags
+HEADER_MARKER = 0
+FORMAT_VERSION = 1
+FLAG_COMPRESSED = 0x01
+
+COMPRESS_MIN_SIZE = 1024 #in bytes, encoded values smaller than this are stored uncompressed
+COMPRESS_LEVEL = 1 #zlib level, favouring speed (DB results compress well even at 1)
+
+#the classes a pickled DB result may refer to, anything else in a cached value is refused
+_PICKLE_SAFE_GLOBALS = {
+    ('datetime', 'datetime'): datetime.datetime,
+    ('datetime', 'date'): datetime.date,
+    ('datetime', 'time'): datetime.time,
+    ('datetime', 'timedelta'): datetime.timedelta,
+    ('decimal', 'Decimal'): decimal.Decimal,
+    ('__builtin__', 'set'): set, #MySQLdb returns SET columns as sets
+    ('__builtin__', 'frozenset'): frozenset,
+}
+#the types the binary codec encodes (exactly, not subclasses), so it never caches something it then can't load
+_BINARY_CONTAINER_TYPES = frozenset([tuple, list, set, frozenset])
+_BINARY_SCALAR_TYPES = frozenset([type(None), bool, int, long, float, str, unicode, datetime.datetime, datetime.date,
+    datetime.time, datetime.timedelta, decimal.Decimal])
+
+#whether Decimals can be stored by their internals (not so with a C replacement of the decimal module)
+_fastDecimals = hasattr(decimal, '_dec_from_triple') and hasattr(decimal.Decimal, '_int')
+
+_codecsByName = {}
+_codecsByID = {}
+defaultCodec = 'binary'
+
+
+#############################
+#MODULE FUNCTIONALITY
+#############################
+def registerCodec(name, codecID, dumps, loads):
+    """
+    @param codecID: A number (1-255) identifying the codec in encoded values. It must never be reused for a
+        different format, as values encoded with the old one may still be cached.
+    @param dumps: A function taking a value and returning a bytestring
+    @param loads: A function taking what dumps returned and giving back the value
+    """
+    assert 0 < codecID < 256 and codecID not in _codecsByID
+    _codecsByName[name] = _codecsByID[codecID] = (codecID, dumps, loads)
+
+
+def setDefaultCodec(name):
+    """Sets the codec L{encode} uses when none is given (values already cached decode either way)"""
+    global defaultCodec
+    if name not in _codecsByName:
+        raise ValueError("Unknown cache codec \"%s\"" % name)
+    defaultCodec = name
+
+
+def encode(value, codec=None):
+    """
+    @param codec: The name of a registered codec, defaults to L{defaultCodec}
+    @return: The value encoded as a bytestring, with the header
+    """
+    codecID, dumps, loads = _codecsByName[codec or defaultCodec]
+    data = dumps(value)
+    flags = 0
+    if len(data) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= FLAG_COMPRESSED
+    return HEADER.pack(HEADER_MARKER, FORMAT_VERSION, codecID, flags) + data
+
+
+def decode(data):
+    """
+    @return: The value from a bytestring produced by L{encode}, or a bare JSON string
+    @raise ValueError: If the data can't be decoded
+    """
+    if not data or ord(data[0]) != HEADER_MARKER:
+        #cached before the codec header was introduced
+        return simplejson.loads(data, encoding='utf-8')
+
+    if len(data) < HEADER.size:
+        raise ValueError("Truncated cache value header")
+    marker, version, codecID, flags = HEADER.unpack(data[:HEADER.size])
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported cache value format version %i" % version)
+    if codecID not in _codecsByID:
+        raise ValueError("Unknown cache codec ID %i" % codecID)
+
+    data = data[HEADER.size:]
+    if flags & FLAG_COMPRESSED:
+        try:
+            data = zlib.decompress(data)
+        except zlib.error, e:
+            raise ValueError("Could not decompress cache value: %s" % e)
+    return _codecsByID[codecID][2](data)
+
+
+def _findSafeGlobal(moduleName, name):
+    try:
+        return _PICKLE_SAFE_GLOBALS[(moduleName, name)]
+    except KeyError:
+        raise cPickle.UnpicklingError("Refusing to load %s.%s from a cached value" % (moduleName, name))
+
+
+def _decimalPersistentID(obj):
+    #Decimal pickles through str() and back, both slow in the pure python decimal module, so store its internal
+    # (sign, digits, exponent, special) instead. Called by cPickle for non-builtin types only
+    if type(obj) is decimal.Decimal:
+        return (obj._sign, obj._int, obj._exp, obj._is_special)
+    return None
+
+
+def _loadDecimal(persistentID):
+    try:
+        sign, digits, exponent, special = persistentID
+        return decimal._dec_from_triple(sign, digits, exponent, special)
+    except (TypeError, ValueError):
+        raise cPickle.UnpicklingError("Invalid Decimal in cached value")
+
+
+def _checkBinarySafe(value):
+    valueType = type(value)
+    if valueType in _BINARY_CONTAINER_TYPES:
+        items = value
+    elif valueType is dict:
+        items = value.keys() + value.values()
+    elif valueType in _BINARY_SCALAR_TYPES:
+        return
+    else:
+        raise ValueError("Can't cache a %s.%s value" % (valueType.__module__, valueType.__name__))
+    for x in items:
+        #most items are scalars, checked here rather than with a call each
+        if type(x) not in _BINARY_SCALAR_TYPES:
+            _checkBinarySafe(x)
+
+
+def _binaryDumps(value):
+    _checkBinarySafe(value)
+    f = StringIO()
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    if _fastDecimals:
+        pickler.inst_persistent_id = _decimalPersistentID
+    pickler.dump(value)
+    return f.getvalue()
+
+
+def _binaryLoads(data):
+    unpickler = cPickle.Unpickler(StringIO(data))
+    unpickler.find_global = _findSafeGlobal
+    unpickler.persistent_load = _loadDecimal
+    try:
+        return unpickler.load()
+    except (cPickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, TypeError), e:
+        raise ValueError("Could not unpickle cache value: %s" % e)
+
+
+def _jsonLoads(data):
+    return simplejson.loads(data, encoding='utf-8')
+
+
+registerCodec('binary', 1, _binaryDumps, _binaryLoads)
+registerCodec('json', 2, simplejson.dumps, _jsonLoads)
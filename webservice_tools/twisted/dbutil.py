@@ -12,21 +12,30 @@ $Id:dbutil.py 1145 2010-03-17 01:54:07Z robbyd $
 #############################
 #General deps
 import os
+import re
 import sys
 import datetime
 import time
 import hashlib
+import heapq
+import struct
+import stat
+import errno
+import fcntl
+import cPickle
+import collections
+import itertools
 import Queue
+import threading
 import MySQLdb
-import simplejson
 import base64
 from twisted.enterprise import adbapi
 from twisted.internet import defer, reactor, protocol, task, threads
-from twisted.python import log
+from twisted.python import failure as twistedFailure, log
 
 #Project specific deps
 #from castdot.shared import consts_shared, sharedstrutil, sharedutil, singleton
-from webservice_tools.twisted import config, consts, errorutil, memcache, twistedstrutil, twistedutil, singleton
+from webservice_tools.twisted import cachecodec, config, consts, errorutil, localcache, memcache, twistedstrutil, twistedutil, singleton
 
 
 #############################
@@ -38,10 +47,38 @@ CONNECTION_POOL_HIGH_WATER_MARK = 100 #high water mark of this connection pool r
 PERIODIC_CONNECTION_PING_INTERVAL = 4400 #in seconds, 4400 = 1 hour
 PERIODIC_TRY_EMPTY_QUERY_BACKLOG_INTERVAL = 2 #in seconds (should normally stay as 1 or 2)
 PERIODIC_CHECK_FOR_MAX_CONNECTIVITY_OUTAGE_INTERVAL = 1 #in seconds (this should stay as 1)
+QUERY_BACKLOG_MEM_MAXSIZE = 200 #keep this many backlogged queries in memory, later ones are spilled to disk
 QUERY_BACKLOG_MAXSIZE = 200 #cache up at most this many queries against a disconnected connection pool before
 # throwing a fatal error (queue max reached)
+QUERY_BACKLOG_JOURNALED_MAXSIZE = 100000 #the same, for pools with a backlog journal (past the in-memory entries
+# they cost disk rather than memory, and QUERY_BACKLOG_MAX_CONN_DOWN_TIME still bounds the outage)
+QUERY_BACKLOG_REPLAY_CONCURRENCY = 4 #max backlogged queries reissued at once when connectivity comes back
 QUERY_BACKLOG_MAX_CONN_DOWN_TIME = 60 #in seconds
 EXECUTE_ALREADY_QUEUED_RETURNDATA = "DBEXECUTE-BACKLOG-ALREADYQUEUED"
+PROC_NAME_REGEX = re.compile(r'^[A-Za-z_][\w$]*(\.[A-Za-z_][\w$]*)?$') #proc names are interpolated, so they must be plain identifiers
+REPLICA_CHECK_INTERVAL = 5 #in seconds, how often each read replica's health (and lag) is checked
+REPLICA_ROUTING_MODES = ('round-robin', 'least-outstanding')
+BATCH_WRITER_DEFAULT_MAXSIZE = 100 #rows per executemany() batch
+BATCH_WRITER_DEFAULT_MAXDELAY = 0.05 #in seconds, how long a row may wait for its batch to fill up
+STREAM_DEFAULT_CHUNK_SIZE = 1000 #rows per FETCH when streaming a result set (see QueryStream)
+SESSION_WRITE_TRACKING_MAXSIZE = 10000 #sessions tracked for read-your-writes before expired ones are pruned
+#statements that can go to a read replica: reads, unless they lock rows or write to a file/variable
+READ_ONLY_STATEMENT_REGEX = re.compile(r'^\s*(SELECT|SHOW|DESCRIBE|DESC|EXPLAIN)\b', re.IGNORECASE)
+READ_ONLY_EXCLUSION_REGEX = re.compile(r'\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\s+MODE\b|\bINTO\b|\bGET_LOCK\s*\(',
+    re.IGNORECASE)
+
+#in-process tier in front of memcached for useCache=True results, keyed like memcached (see _produceCacheHashKey).
+# Set its maxSize to 0 to disable it, or its stalePeriod to serve expired results while they're being refreshed
+localCache = localcache.LocalCache()
+_cacheFillsInFlight = {} #cacheHashKey -> list of deferreds waiting on the memcached/DB lookup already under way
+
+#results fetched in pool threads are written to memcached from the reactor without the thread waiting on it.
+# Writes are held this many seconds (0 = until the next reactor iteration), a newer write to a key replacing
+# an older one still pending
+CACHE_WRITE_FLUSH_DELAY = 0
+_pendingCacheWrites = {} #cacheHashKey -> (content, lifetime)
+_cacheWriteFlushCall = None
+_cacheWriteStats = {'queued': 0, 'coalesced': 0, 'written': 0, 'failed': 0}
 
 
 #############################
@@ -57,10 +94,8 @@ def _produceCacheHashKey(queryStringOrProcName, argList, fetch):
     if isinstance(queryStringOrProcName, str):
         #decode into a unicode string
         queryStringOrProcName = queryStringOrProcName.decode('utf-8')
-    #decode string args as well
-    for i in xrange(len(argList)):
-        if isinstance(argList[i], str):
-            argList[i] = argList[i].decode('utf-8')
+    #decode string args as well (argList may be a tuple, so build a new list)
+    argList = [isinstance(x, str) and x.decode('utf-8') or x for x in argList]
     
     cacheHashKey = argList and (unicode(queryStringOrProcName) + u'|' + unicode(fetch)
         + u'|'.join([unicode(x) for x in argList])) or unicode(queryStringOrProcName)
@@ -68,6 +103,10 @@ def _produceCacheHashKey(queryStringOrProcName, argList, fetch):
     return cacheHashKey
 
 
+def _truncateQueryForLog(queryString, length=80):
+    return u' '.join(queryString.split())[:length]
+
+
 def _getBacklogEntryLoggingHash(backlogItem):
     if backlogItem['callType'] == 'callProc':
         return _produceCacheHashKey(backlogItem['procName'], backlogItem['inArgList'], backlogItem['fetch'])
@@ -75,6 +114,121 @@ def _getBacklogEntryLoggingHash(backlogItem):
         return _produceCacheHashKey(backlogItem['queryString'], backlogItem['argList'], backlogItem['fetch'])
 
 
+def _getCacheExpireTime(cacheExpireTime):
+    #if we are running this code in the castdaemon, override the cache period with the DB-based setting
+    if     cacheExpireTime == consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD \
+       and singleton.get('core', strict=False):
+        return singleton.get('core').getPlatformSetting('castdaemon_dbcache_interval', strict=False) \
+            or consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD
+    return cacheExpireTime
+
+
+def _cachedCall(cacheHashKey, cacheExpireTime, cbCall, *args):
+    """Looks a useCache=True result up in L{localCache}, and otherwise in memcached and then the DB via cbCall
+    (L{_cbCallProc} or L{_cbExecute}, called with the memcached value and args).
+    
+    Concurrent misses on the same key share a single memcached/DB lookup. A stale local entry is returned
+    right away, with a refresh started in the background if none is under way.
+    
+    @return: A deferred yielding the results
+    """
+    state, value = localCache.lookup(cacheHashKey)
+    if state == localcache.HIT:
+        return defer.succeed(value)
+    if state == localcache.STALE:
+        if cacheHashKey not in _cacheFillsInFlight:
+            d = _fillCache(cacheHashKey, cacheExpireTime, cbCall, *args)
+            d.addErrback(lambda failure: log.msg(u"Could not refresh stale cached DB results (key: %s). Failure: %s"
+                % (cacheHashKey, failure.getErrorMessage()), lvl='w', ss='ss_db'))
+        return defer.succeed(value)
+    
+    if cacheHashKey in _cacheFillsInFlight:
+        localCache.countCoalesced()
+        d = defer.Deferred()
+        _cacheFillsInFlight[cacheHashKey].append(d)
+        return d
+    return _fillCache(cacheHashKey, cacheExpireTime, cbCall, *args)
+
+
+def _fillCache(cacheHashKey, cacheExpireTime, cbCall, *args):
+    _cacheFillsInFlight[cacheHashKey] = []
+    try:
+        d = memcache.retrieve(cacheHashKey)
+    except:
+        del _cacheFillsInFlight[cacheHashKey]
+        raise
+    d.addCallback(cbCall, *args)
+    d.addBoth(_cbFillCache, cacheHashKey, cacheExpireTime)
+    return d
+
+
+def _cbFillCache(result, cacheHashKey, cacheExpireTime):
+    waiters = _cacheFillsInFlight.pop(cacheHashKey, [])
+    if isinstance(result, twistedFailure.Failure):
+        for d in waiters:
+            d.errback(result)
+        return result
+    
+    localCache.store(cacheHashKey, result, _getCacheExpireTime(cacheExpireTime))
+    for d in waiters:
+        d.callback(localcache.copyResult(result))
+    return result
+
+
+def _storeInCacheFromThread(cacheHashKey, encodedResults, cacheExpireTime):
+    """Hands a result fetched in a pool thread to the reactor to be written to memcached, without waiting on it
+    (so the thread and its connection go back to the pool right away)
+    """
+    reactor.callFromThread(_queueCacheWrite, cacheHashKey, encodedResults, _getCacheExpireTime(cacheExpireTime))
+
+
+def _queueCacheWrite(cacheHashKey, content, lifetime):
+    global _cacheWriteFlushCall
+    _cacheWriteStats['queued'] += 1
+    if cacheHashKey in _pendingCacheWrites:
+        _cacheWriteStats['coalesced'] += 1
+    _pendingCacheWrites[cacheHashKey] = (content, lifetime)
+    if _cacheWriteFlushCall is None:
+        _cacheWriteFlushCall = reactor.callLater(CACHE_WRITE_FLUSH_DELAY, _flushCacheWrites)
+
+
+def _flushCacheWrites():
+    global _pendingCacheWrites, _cacheWriteFlushCall
+    writes, _pendingCacheWrites = _pendingCacheWrites, {}
+    _cacheWriteFlushCall = None
+    for cacheHashKey, (content, lifetime) in writes.iteritems():
+        try:
+            d = memcache.store(cacheHashKey, content, lifetime=lifetime)
+        except Exception, e:
+            #memcached client not up (yet), nobody is waiting on this so just drop it
+            _cacheWriteStats['failed'] += 1
+            log.msg(u"Could not store database results in memcached (key: %s): %s" % (cacheHashKey, e),
+                lvl='w', ss='ss_db')
+            continue
+        d.addCallback(_cbFlushCacheWrite)
+
+
+def _cbFlushCacheWrite(result):
+    #memcache.store yields the key on success, None on failure (which it has already logged)
+    _cacheWriteStats[result and 'written' or 'failed'] += 1
+
+
+def getCacheWriteStats():
+    """@return: A dict counting the memcached writes queued from pool threads, those that were replaced by a newer
+    write to the same key before going out, and those written or failed, plus the number still pending
+    """
+    stats = dict(_cacheWriteStats)
+    stats['pending'] = len(_pendingCacheWrites)
+    return stats
+
+
+def getLocalCacheStats():
+    """@return: A dict with the hit/stale hit/miss/eviction counts and size of L{localCache}, and 'coalesced', the
+    number of lookups that waited on another's memcached/DB lookup instead of making their own
+    """
+    return localCache.getStats()
+
+
 
 
 class QuietConnection(adbapi.Connection):
@@ -109,7 +263,287 @@ class QuietConnection(adbapi.Connection):
 
 
 
-class BackloggingConnectionPool(adbapi.ConnectionPool):
+def _prepareJournalDir(journalDir):
+    """Creates the backlog journal directory (mode 0700) if need be, and makes sure no other user can write to it
+    or read from it, as journals are unpickled when they're recovered"""
+    try:
+        os.mkdir(journalDir, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(journalDir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) & 0077:
+        raise ValueError("Backlog journal directory \"%s\" must be a directory owned by this user and accessible to"
+            " no one else (mode 0700)" % journalDir)
+
+
+def _openJournalForReading(journalPath):
+    f = os.fdopen(os.open(journalPath, os.O_RDONLY | os.O_NOFOLLOW), 'rb')
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+        f.close()
+        raise ValueError("Refusing to read backlog journal \"%s\", it isn't a file owned by this user" % journalPath)
+    return f
+
+
+class QueryBacklog(object):
+    """A FIFO of backlogged queries for L{BackloggingConnectionPool}.
+    
+    The first memMaxSize entries are held in a deque. Past that, entries are appended to an on-disk journal
+    (length prefixed pickles) and read back in order once the in-memory ones have been handed out, so a long
+    outage costs disk space rather than memory. With no journalPath, every entry is kept in memory. Only each entry's dRequestCompleted deferred stays in memory.
+    Entries that could not be issued yet are handed back with L{putBack} and come out first, in their original
+    order. A journal left behind by a previous run is picked up and replayed as well (entries it had already
+    handed out before exiting are replayed again, so recovery is at-least-once). The journal is flock()ed for the
+    life of the process, so a second one pointed at the same journal fails to start instead of replaying it too.
+    """
+    
+    def __init__(self, journalPath=None, memMaxSize=QUERY_BACKLOG_MEM_MAXSIZE):
+        self._journalPath = journalPath
+        self._memMaxSize = memMaxSize
+        self._mem = collections.deque()
+        self._retry = [] #heap of (seq, item)
+        self._spilledDeferreds = {}
+        self._journalCount = 0
+        self._journalWriteFile = None
+        self._journalReadFile = None
+        self._nextSeq = 0
+        self._lockFile = None
+        self.spilledBytes = 0 #size of the journal currently on disk
+        self.totalSpilledBytes = 0 #everything written to the journal during this run
+        if journalPath is not None:
+            self._recoverJournal()
+    
+    
+    def __len__(self):
+        return len(self._retry) + len(self._mem) + self._journalCount
+    
+    
+    def getSpilledSize(self):
+        return self._journalCount
+    
+    
+    def hasJournal(self):
+        return self._journalPath is not None
+    
+    
+    def append(self, item):
+        item['seq'] = self._nextSeq
+        self._nextSeq += 1
+        if not self._journalCount and (self._journalPath is None or len(self._mem) < self._memMaxSize):
+            self._mem.append(item)
+        else:
+            #once anything is on disk, newer entries have to follow it there to keep the order
+            self._spill(item)
+    
+    
+    def putBack(self, item):
+        heapq.heappush(self._retry, (item['seq'], item))
+    
+    
+    def popleft(self):
+        """@return: The oldest entry, or None if the backlog is empty"""
+        if self._retry:
+            return heapq.heappop(self._retry)[1]
+        if self._mem:
+            return self._mem.popleft()
+        if self._journalCount:
+            return self._readJournal()
+        return None
+    
+    
+    def _spill(self, item):
+        if self._journalWriteFile is None:
+            #a new journal (an existing one is always recovered first, and removed once read through)
+            self._journalWriteFile = os.fdopen(os.open(self._journalPath,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0600), 'ab')
+        if item.get('dRequestCompleted') is not None:
+            self._spilledDeferreds[item['seq']] = item['dRequestCompleted']
+        data = cPickle.dumps(dict([(k, v) for k, v in item.iteritems() if k != 'dRequestCompleted']),
+            cPickle.HIGHEST_PROTOCOL)
+        record = struct.pack('!I', len(data)) + data
+        self._journalWriteFile.write(record)
+        self._journalWriteFile.flush()
+        self._journalCount += 1
+        self.spilledBytes += len(record)
+        self.totalSpilledBytes += len(record)
+    
+    
+    def _readRecord(self, f):
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        (length,) = struct.unpack('!I', header)
+        data = f.read(length)
+        if len(data) < length:
+            return None
+        try:
+            return cPickle.loads(data)
+        except Exception:
+            return None
+    
+    
+    def _readJournal(self):
+        if self._journalReadFile is None:
+            self._journalReadFile = _openJournalForReading(self._journalPath)
+        item = self._readRecord(self._journalReadFile)
+        if item is None:
+            #a torn or corrupt record (e.g. the disk filled up while it was written), what follows can't be trusted
+            log.msg(u"Backlog journal \"%s\" is damaged, dropping the %i queries left in it"
+                % (self._journalPath, self._journalCount), lvl='e', ss='ss_db')
+            lostDeferreds = self._spilledDeferreds.values()
+            self._spilledDeferreds = {}
+            self._journalCount = 0
+            self._removeJournal()
+            for d in lostDeferreds:
+                d.errback(Exception("Backlogged query lost from a damaged backlog journal"))
+            return None
+        self._journalCount -= 1
+        item['dRequestCompleted'] = self._spilledDeferreds.pop(item['seq'], None) or self._orphanDeferred()
+        if not self._journalCount:
+            self._removeJournal()
+        return item
+    
+    
+    def _orphanDeferred(self):
+        #recovered from a previous run's journal, nobody is waiting on the result
+        d = defer.Deferred()
+        d.addErrback(log.err)
+        return d
+    
+    
+    def _removeJournal(self):
+        for f in (self._journalWriteFile, self._journalReadFile):
+            if f is not None:
+                f.close()
+        self._journalWriteFile = self._journalReadFile = None
+        if os.path.lexists(self._journalPath):
+            os.remove(self._journalPath)
+        self.spilledBytes = 0
+    
+    
+    def _lockJournal(self):
+        #held for the life of the process, so that two daemons can't share (and replay each other's) journal
+        self._lockFile = os.fdopen(os.open(self._journalPath + '.lock', os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+            0600), 'r+b')
+        try:
+            fcntl.flock(self._lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            self._lockFile.close()
+            raise ValueError("Backlog journal \"%s\" is in use by another process" % self._journalPath)
+    
+    
+    def _recoverJournal(self):
+        """Counts the complete records of a journal left by a previous run, dropping a partly written last one"""
+        self._lockJournal()
+        if not os.path.lexists(self._journalPath):
+            return
+        f = _openJournalForReading(self._journalPath)
+        goodOffset = 0
+        try:
+            while True:
+                item = self._readRecord(f)
+                if item is None:
+                    break
+                goodOffset = f.tell()
+                self._journalCount += 1
+                self._nextSeq = max(self._nextSeq, item['seq'] + 1)
+        finally:
+            f.close()
+        
+        if not self._journalCount:
+            os.remove(self._journalPath)
+            return
+        if goodOffset < os.path.getsize(self._journalPath):
+            fd = os.open(self._journalPath, os.O_WRONLY | os.O_NOFOLLOW)
+            try:
+                os.ftruncate(fd, goodOffset)
+            finally:
+                os.close(fd)
+        self.spilledBytes = goodOffset
+        log.msg(u"Recovered %i backlogged queries from journal \"%s\"" % (self._journalCount, self._journalPath),
+            lvl='w', ss='ss_db')
+
+
+
+
+class UtilizationTrackingConnectionPool(adbapi.ConnectionPool):
+    """A ConnectionPool that times how long each interaction ties up one of its threads (and that thread's
+    connection), retries included, for L{getPoolUtilizationStats}.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        self._utilizationLock = threading.Lock()
+        self._resetUtilizationStats()
+        adbapi.ConnectionPool.__init__(self, *args, **kwargs)
+
+
+    def _runInteraction(self, interaction, *args, **kw):
+        self._interactionStarted()
+        startTime = time.time()
+        try:
+            return self._runTimedInteraction(interaction, *args, **kw)
+        finally:
+            self._interactionFinished(time.time() - startTime)
+
+
+    def _runTimedInteraction(self, interaction, *args, **kw):
+        return adbapi.ConnectionPool._runInteraction(self, interaction, *args, **kw)
+
+
+    def _runWithConnection(self, func, *args, **kw):
+        self._interactionStarted()
+        startTime = time.time()
+        try:
+            return adbapi.ConnectionPool._runWithConnection(self, func, *args, **kw)
+        finally:
+            self._interactionFinished(time.time() - startTime)
+
+
+    def _interactionStarted(self):
+        with self._utilizationLock:
+            self._utilization['active'] += 1
+            self._utilization['peakActive'] = max(self._utilization['peakActive'], self._utilization['active'])
+
+
+    def _interactionFinished(self, elapsed):
+        with self._utilizationLock:
+            self._utilization['active'] -= 1
+            self._utilization['interactions'] += 1
+            self._utilization['busySeconds'] += elapsed
+
+
+    def _resetUtilizationStats(self):
+        with self._utilizationLock:
+            active = getattr(self, '_utilization', {}).get('active', 0)
+            self._utilization = {'active': active, 'peakActive': active, 'interactions': 0, 'busySeconds': 0.0}
+            self._utilizationSince = time.time()
+
+
+    def getPoolUtilizationStats(self, reset=False):
+        """
+        @param reset: Set to True to start a new measurement period after this one
+        @return: A dict with the interactions currently running and the most seen at once, the number
+        completed and the seconds they held a pool thread/connection for, their mean duration in ms, and
+        'utilization', the fraction of the pool's capacity (cp_max threads) that was busy since the period started
+        """
+        with self._utilizationLock:
+            stats = dict(self._utilization)
+            period = time.time() - self._utilizationSince
+        stats['period'] = period
+        stats['maxThreads'] = self.max
+        stats['meanInteractionMs'] = stats['interactions'] \
+            and stats['busySeconds'] / stats['interactions'] * 1000 or 0
+        stats['utilization'] = period and stats['busySeconds'] / (period * self.max) or 0
+        if reset:
+            self._resetUtilizationStats()
+        return stats
+
+
+
+class BackloggingConnectionPool(UtilizationTrackingConnectionPool):
     """A frontend to twisted's ConnectionPool so that we try to reconnect to mysql if/when the connection goes
     down.
     
@@ -130,12 +564,17 @@ class BackloggingConnectionPool(adbapi.ConnectionPool):
     stop everything from working, even for very short and temporary DB connectivity "hiccups").
     
     Important implementation notes:
-    - The current implementation of this does NOT guarantee that queries will be re-executed in
-    the order in which they were queued. The current implementation instead only attempts a "best effort"
-    attempt at keeping query order. This should not be an issue due to the fact that in-order query execution
+    - Backlogged queries are reissued in the order in which they were queued, up to
+    QUERY_BACKLOG_REPLAY_CONCURRENCY at a time, so they may complete out of order. In-order execution
     should be maintained where it really matters via deferred chaining elsewhere in the castdaemon.
     
-    - A fatal error is thrown when the query backlog exceeds a maximum size (QUERY_BACKLOG_MAXSIZE entries),
+    - Given a backlogJournalDir argument, the backlog spills to an append-only journal on disk past
+    QUERY_BACKLOG_MEM_MAXSIZE entries (see L{QueryBacklog}). That directory must be private to this daemon (it's
+    created with mode 0700 if missing, and refused if anyone else can get in), as the journal is unpickled when a
+    pool starts up. Without one, the backlog is only kept in memory.
+    
+    - A fatal error is thrown when the query backlog exceeds a maximum size (QUERY_BACKLOG_MAXSIZE entries, or
+    QUERY_BACKLOG_JOURNALED_MAXSIZE with a journal),
     and/or DB connectivity is down for over some period of time (QUERY_BACKLOG_MAX_CONN_DOWN_TIME seconds).
     
     - Query backlogging is NOT supported for queries made through L{runInteraction}, L{runWithConnection},
@@ -155,13 +594,23 @@ class BackloggingConnectionPool(adbapi.ConnectionPool):
         #self._connPoolRetryAttemptCounter = 0
         #self._decreaseRetryAttemptCounterLoop = None
         self._periodicConnPingLoop = None
-        #self._queryBacklog = Queue.Queue(QUERY_BACKLOG_MAXSIZE)
-        self._queryBacklog = []
+        journalDir = kwargs.pop('backlogJournalDir', None)
+        if journalDir:
+            _prepareJournalDir(journalDir)
+            self._queryBacklog = QueryBacklog(os.path.join(journalDir, 'dbbacklog-%s.journal' % self._poolName))
+            self._queryBacklogMaxSize = QUERY_BACKLOG_JOURNALED_MAXSIZE
+        else:
+            self._queryBacklog = QueryBacklog()
+            self._queryBacklogMaxSize = QUERY_BACKLOG_MAXSIZE
+        self._backlogReplaysInFlight = 0
+        self._backlogReplayStalled = False
+        self._backlogReplayedAny = False
+        self._backlogReplayWaiters = []
         self._connectivityDownSince = None
         self._connectivityLastRestored = None
         
         #init parent
-        adbapi.ConnectionPool.__init__(self, *args, **kwargs)
+        UtilizationTrackingConnectionPool.__init__(self, *args, **kwargs)
 
         self._periodicConnPingLoop = task.LoopingCall(self._periodicConnPing)
         dLoop = self._periodicConnPingLoop.start(PERIODIC_CONNECTION_PING_INTERVAL, now=False)
@@ -187,15 +636,18 @@ class BackloggingConnectionPool(adbapi.ConnectionPool):
         cannotPingOnConns = []
         firstExceptionValue = None
         for conn in self.connections.values():
+            if not hasattr(conn, 'ping'):
+                #only MySQLdb has it (and needs it, for wait_timeout), connections of other drivers aren't timed out
+                continue
             try:
                 conn.ping()
-            except MySQLdb.OperationalError:
+            except self.dbapi.OperationalError:
                 excType, excValue, excTraceback = sys.exc_info()
                 
                 #try to close this connection
                 try:
                     self._close(conn)
-                except MySQLdb.ProgrammingError: #closing a closed connection
+                except self.dbapi.ProgrammingError: #closing a closed connection
                     #connection is already closed, don't include it in our list of bad connections we had
                     pass
 
@@ -260,13 +712,16 @@ class BackloggingConnectionPool(adbapi.ConnectionPool):
         if not self._connectivityDownSince:
             self._connectivityDownSince = time.time()
         
-        if len(self._queryBacklog) >= QUERY_BACKLOG_MAXSIZE:
+        if len(self._queryBacklog) >= self._queryBacklogMaxSize:
             #connection has been dead for too long, die
             errorutil.triggerFatalError("Query backlog for pool \"%s\" would overflow (DB down for too long). Exiting!"
                 % (self._poolName,))
             return None
         
         self._queryBacklog.append(item)
+        if self._queryBacklog.getSpilledSize() == 1:
+            log.msg(u"Query backlog for pool \"%s\" exceeded %i in-memory entries, spilling to disk"
+                % (self._poolName, QUERY_BACKLOG_MEM_MAXSIZE), lvl='w', ss='ss_db')
         return True
     
     
@@ -275,29 +730,28 @@ class BackloggingConnectionPool(adbapi.ConnectionPool):
         
         @return: The item received, or None if there was no item to get.
         """
-        if not self._queryBacklog:
-            return None
-
-        item = self._queryBacklog.pop(0)
-        return item
-    
-    
-    def _peekAtQueryBacklogHead(self):
-        if not len(self._queryBacklog):
-            return None
-        
-        return self._queryBacklog[0]
+        return self._queryBacklog.popleft()
     
     
     def getQueryBacklogSize(self):
-        #return self._queryBacklog.qsize()
         return len(self._queryBacklog)
+    
+    
+    def getQueryBacklogStats(self):
+        """@return: A dict with the backlog depth (total, and how much of it is on disk), the current and
+        total spilled journal bytes and the number of backlogged queries being reissued
+        """
+        return {'depth': len(self._queryBacklog),
+                'spilledDepth': self._queryBacklog.getSpilledSize(),
+                'spilledBytes': self._queryBacklog.spilledBytes,
+                'totalSpilledBytes': self._queryBacklog.totalSpilledBytes,
+                'replaysInFlight': self._backlogReplaysInFlight}
         
     
     def connect(self):
         conn = adbapi.ConnectionPool.connect(self)
-        #CASTDOT-CUSTOM: call _emptyBacklog
-        threads.blockingCallFromThread(reactor, self._emptyBacklog)
+        #CASTDOT-CUSTOM: call _emptyBacklog (without waiting on it, replaying needs this pool's threads)
+        reactor.callFromThread(self._emptyBacklog)
         return conn
 
 
@@ -310,13 +764,13 @@ class BackloggingConnectionPool(adbapi.ConnectionPool):
  
         try:
             conn.close()
-        except MySQLdb.ProgrammingError: #closing a closed connection
+        except self.dbapi.ProgrammingError: #closing a closed connection
             pass
         except:
             log.err(None, "Connection close failed")
  
     
-    def _runInteraction(self, interaction, *args, **kw):
+    def _runTimedInteraction(self, interaction, *args, **kw):
         """See http://www.gelens.org/2009/09/13/twisted-connectionpool-revisited/"""
         try:
             return adbapi.ConnectionPool._runInteraction(self, interaction, *args, **kw)
@@ -343,66 +797,91 @@ class BackloggingConnectionPool(adbapi.ConnectionPool):
         1. a new connection is established/reestablished (as the cp_openfun arg to ConnectionPool); or
         2. periodically by the connection pool, if its query backlog is not empty
         
-        If we have any entries in our connection backlog, empty them now.
-        """
-        backlogPresent = False
-        d = defer.succeed(True)
+        If we have any entries in our connection backlog, reissue them now, oldest first and at most
+        QUERY_BACKLOG_REPLAY_CONCURRENCY at a time. Replay stops at the first entry that still can't be issued.
         
-        while True: 
-            #backlogItem = self._peekAtQueryBacklogHead()
+        @return: A deferred fired once this replay has finished or stalled
+        """
+        d = defer.Deferred()
+        self._backlogReplayWaiters.append(d)
+        self._backlogReplayStalled = False
+        self._pumpBacklog()
+        return d
+    
+    
+    def _pumpBacklog(self):
+        while not self._backlogReplayStalled \
+          and self._backlogReplaysInFlight < QUERY_BACKLOG_REPLAY_CONCURRENCY:
             backlogItem = self._removeFromQueryBacklog()
             if not backlogItem:
                 #empty backlog
                 break
-
+            
             #otherwise we have a backlog item to process
-            backlogPresent = True
+            self._backlogReplaysInFlight += 1
+            self._backlogReplayedAny = True
             assert backlogItem['callType'] in ('callProc', 'execute')
             if backlogItem['callType'] == 'callProc':
-                d.addCallback(lambda result, backlogItem=backlogItem: callProc(backlogItem['procName'],
-                    backlogItem['inArgList'], backlogItem['fetch'], backlogItem['connID'], backlogItem['useCache'],
-                    backlogItem['cacheExpireTime'], backlogItem['printQuery'], _alreadyInBacklog=True))
+                d = callProc(backlogItem['procName'], backlogItem['inArgList'], backlogItem['fetch'],
+                    backlogItem['connID'], backlogItem['useCache'], backlogItem['cacheExpireTime'],
+                    backlogItem['printQuery'], _alreadyInBacklog=True)
             elif backlogItem['callType'] == 'execute':
-                d.addCallback(lambda result, backlogItem=backlogItem: execute(backlogItem['queryString'],
-                    backlogItem['argList'], backlogItem['fetch'], backlogItem['connID'], backlogItem['useCache'],
-                    backlogItem['cacheExpireTime'], backlogItem['printQuery'], _alreadyInBacklog=True))
-                d.addCallback(self._cbEmptyBacklog_perEntry, backlogItem, self.getQueryBacklogSize())
-        d.addCallback(self._cbEmptyBacklog, backlogPresent)
-        return d
+                d = execute(backlogItem['queryString'], backlogItem['argList'], backlogItem['fetch'],
+                    backlogItem['connID'], backlogItem['useCache'], backlogItem['cacheExpireTime'],
+                    backlogItem['printQuery'], _alreadyInBacklog=True, many=backlogItem.get('many', False))
+            d.addCallbacks(self._cbEmptyBacklog_perEntry, self._ebEmptyBacklog_perEntry,
+                callbackArgs=(backlogItem,), errbackArgs=(backlogItem,))
+        
+        if not self._backlogReplaysInFlight:
+            self._cbEmptyBacklog()
 
 
-    def _cbEmptyBacklog_perEntry(self, result, backlogItem, newBacklogSize):
+    def _cbEmptyBacklog_perEntry(self, result, backlogItem):
+        self._backlogReplaysInFlight -= 1
         if result == EXECUTE_ALREADY_QUEUED_RETURNDATA:
-            #we couldn't end up actually issuing the query/proc, don't remove it from the backlog
+            #we couldn't end up actually issuing the query/proc, put it back at the head of the backlog
             if backlogItem['callType'] == 'callProc':
-                log.msg(u"Couldn't remove query with MD5 of \"%s\" as connection still not back up..."
+                log.msg(u"Couldn't remove proc with MD5 of \"%s\" as connection still not back up..."
                     % (_getBacklogEntryLoggingHash(backlogItem),), lvl='d2', ss='ss_db')
             elif backlogItem['callType'] == 'execute':
-                log.msg(u"Couldn't remove proc with MD5 of \"%s\" as connection still not back up..."
+                log.msg(u"Couldn't remove query with MD5 of \"%s\" as connection still not back up..."
                     % (_getBacklogEntryLoggingHash(backlogItem),), lvl='d2', ss='ss_db')
-            self._addToQueryBacklog(backlogItem)
+            self._queryBacklog.putBack(backlogItem)
+            self._backlogReplayStalled = True
+            self._pumpBacklog()
             return
 
         if backlogItem['callType'] == 'callProc':
             log.msg(u"Connectivity re-established: Executed proc (MD5: %s): \"%s\". New backlog length: %i"
-                % (_getBacklogEntryLoggingHash(backlogItem), backlogItem['procName'], newBacklogSize),
+                % (_getBacklogEntryLoggingHash(backlogItem), backlogItem['procName'], self.getQueryBacklogSize()),
                 lvl='i', ss='ss_db')
         elif backlogItem['callType'] == 'execute':
             log.msg(u"Connectivity re-established: Executed query (MD5: %s): \"%s\". New backlog length: %i"
-                % (_getBacklogEntryLoggingHash(backlogItem),
-                   sharedstrutil.truncate(sharedstrutil.removeMultipleSpacesFromString(
-                   backlogItem['queryString']), 80).strip(), newBacklogSize), lvl='i', ss='ss_db')
+                % (_getBacklogEntryLoggingHash(backlogItem), _truncateQueryForLog(backlogItem['queryString']),
+                   self.getQueryBacklogSize()), lvl='i', ss='ss_db')
         
         #the query has completed so fire off the dRequestCompleted deferred...
-        #backlogItem['dRequestCompleted'].chainDeferred(d)
         backlogItem['dRequestCompleted'].callback(result)
+        self._pumpBacklog()
+    
+    
+    def _ebEmptyBacklog_perEntry(self, failure, backlogItem):
+        #the query was issued but failed for another reason (e.g. bad syntax), hand the failure to its caller
+        self._backlogReplaysInFlight -= 1
+        log.msg(u"Backlogged query (MD5: %s) failed when reissued: %s"
+            % (_getBacklogEntryLoggingHash(backlogItem), failure.getErrorMessage()), lvl='w', ss='ss_db')
+        backlogItem['dRequestCompleted'].errback(failure)
+        self._pumpBacklog()
 
     
-    def _cbEmptyBacklog(self, unused, backlogPresent):
-        if backlogPresent and self.getQueryBacklogSize() == 0:
-            #NOTE that this condition may trigger two times in quick succession for any given conn pool 
+    def _cbEmptyBacklog(self):
+        waiters, self._backlogReplayWaiters = self._backlogReplayWaiters, []
+        if self._backlogReplayedAny and self.getQueryBacklogSize() == 0:
+            self._backlogReplayedAny = False
             self._connectivityDownSince = None #connectivity no longer down
             self._connectivityLastRestored = time.time()
+            log.msg(u"Query backlog for pool \"%s\" emptied (%i bytes were spilled to disk this run)"
+                % (self._poolName, self._queryBacklog.totalSpilledBytes), lvl='i', ss='ss_db')
             
             #as we successfully cleared a backlog, purposefully refresh our server stats now just to be safe (and to reduce
             # the chance the the AC sees us as dead) (or if this is the case, to properly realize it)
@@ -411,9 +890,228 @@ class BackloggingConnectionPool(adbapi.ConnectionPool):
                 singleton.get('core').updateServerStats()
                 singleton.get('core').doRefresh(doFullRefresh=False)
         
+        for d in waiters:
+            d.callback(None)
+        
 
         
 
+class ReadReplica(object):
+    """A read replica's connection pool, with its routing state"""
+    
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = True
+        self.lag = None #seconds behind the primary as of the last check, None if unknown
+        self.outstanding = 0
+        self.dispatched = 0
+
+
+    def runInteraction(self, interaction, *args):
+        self.outstanding += 1
+        self.dispatched += 1
+        d = self.pool.runInteraction(interaction, *args)
+        d.addBoth(self._finished)
+        return d
+
+
+    def _finished(self, result):
+        self.outstanding -= 1
+        return result
+
+
+
+class ReplicaSet(object):
+    """The read replicas registered for a connID (see L{establishConnection}).
+    
+    Read-only statements (see L{isReadOnlyStatement}) are spread over the healthy replicas, either round-robin or
+    to the one with the fewest queries outstanding. A replica is taken out of rotation when a query on it finds it
+    unreachable (the query is then reissued on the primary) and put back once a periodic check succeeds. With
+    maxLag set, that check also reads the replication lag, and replicas further behind than maxLag seconds (or
+    not replicating at all) are skipped.
+    
+    Reads made under a session (any hashable, e.g. a user or request ID) within readYourWritesWindow seconds of
+    a write under the same session go to the primary, so that session sees its own writes.
+    """
+    
+    def __init__(self, connID, replicas, routing='round-robin', maxLag=None, readYourWritesWindow=0):
+        """
+        @param replicas: A list of L{ReadReplica}
+        """
+        assert routing in REPLICA_ROUTING_MODES
+        self.connID = connID
+        self.replicas = replicas
+        self.routing = routing
+        self.maxLag = maxLag
+        self.readYourWritesWindow = readYourWritesWindow
+        self._nextReplica = 0
+        self._lastWriteBySession = {}
+        self._stats = {'replicaReads': 0, 'primaryReads': 0, 'pinnedReads': 0, 'failovers': 0}
+        
+        self._periodicCheckLoop = task.LoopingCall(self._periodicCheckReplicas)
+        dLoop = self._periodicCheckLoop.start(REPLICA_CHECK_INTERVAL, now=True)
+        dLoop.addErrback(log.err) #don't put a callback on this deferred, however
+
+
+    def stop(self):
+        if self._periodicCheckLoop.running:
+            self._periodicCheckLoop.stop()
+        for replica in self.replicas:
+            replica.pool.close()
+
+
+    def _isUsable(self, replica):
+        return replica.healthy and (self.maxLag is None or (replica.lag is not None and replica.lag <= self.maxLag))
+
+
+    def chooseReplica(self, readOnly, session=None):
+        """@return: The L{ReadReplica} to run a statement on, or None to run it on the primary"""
+        if not readOnly:
+            self.noteWrite(session)
+            return None
+        if self.isPinned(session):
+            self._stats['pinnedReads'] += 1
+            return None
+        
+        usable = [replica for replica in self.replicas if self._isUsable(replica)]
+        if not usable:
+            self._stats['primaryReads'] += 1
+            return None
+        self._stats['replicaReads'] += 1
+        self._nextReplica = (self._nextReplica + 1) % len(usable)
+        usable = usable[self._nextReplica:] + usable[:self._nextReplica]
+        if self.routing == 'least-outstanding':
+            #ties go round-robin
+            return min(usable, key=lambda replica: replica.outstanding)
+        return usable[0]
+
+
+    def noteWrite(self, session):
+        if session is None or not self.readYourWritesWindow:
+            return
+        now = time.time()
+        if len(self._lastWriteBySession) >= SESSION_WRITE_TRACKING_MAXSIZE:
+            self._lastWriteBySession = dict([(k, t) for k, t in self._lastWriteBySession.iteritems()
+                if now - t < self.readYourWritesWindow])
+        self._lastWriteBySession[session] = now
+
+
+    def isPinned(self, session):
+        lastWrite = session is not None and self._lastWriteBySession.get(session)
+        return bool(lastWrite) and time.time() - lastWrite < self.readYourWritesWindow
+
+
+    def markDown(self, replica, reason):
+        self._stats['failovers'] += 1
+        if replica.healthy:
+            replica.healthy = False
+            log.msg(u"Read replica %s for pool \"%s\" is unreachable (%s), sending its reads to the primary until it's back"
+                % (replica.name, self.connID, reason), lvl='w', ss='ss_db')
+
+
+    def _periodicCheckReplicas(self):
+        for replica in self.replicas:
+            d = replica.pool.runInteraction(_directCheckReplica, self.maxLag is not None, replica.pool.dbapiName)
+            d.addCallbacks(self._cbCheckReplica, self._ebCheckReplica, callbackArgs=(replica,),
+                errbackArgs=(replica,))
+
+
+    def _cbCheckReplica(self, lag, replica):
+        replica.lag = lag
+        if not replica.healthy:
+            replica.healthy = True
+            log.msg(u"Read replica %s for pool \"%s\" is reachable again" % (replica.name, self.connID),
+                lvl='i', ss='ss_db')
+
+
+    def _ebCheckReplica(self, failure, replica):
+        replica.lag = None
+        if replica.healthy:
+            self.markDown(replica, failure.getErrorMessage())
+
+
+    def getStats(self):
+        """@return: A dict with the number of reads sent to replicas, to the primary for lack of a usable replica,
+        and to the primary for read-your-writes; the number of failovers; and per replica stats under 'replicas'
+        """
+        stats = dict(self._stats)
+        stats['replicas'] = dict([(replica.name, {'healthy': replica.healthy, 'lag': replica.lag,
+            'outstanding': replica.outstanding, 'dispatched': replica.dispatched}) for replica in self.replicas])
+        return stats
+
+
+def _directCheckReplica(txn, checkLag, dbapiName):
+    """@return: The replica's lag in seconds (0 if checkLag is False), None if it isn't replicating"""
+    if not checkLag:
+        txn.execute("SELECT 1")
+        txn.fetchall()
+        return 0
+    if dbapiName == 'MySQLdb':
+        txn.execute("SHOW SLAVE STATUS")
+        status = fetchResultRowToDict(txn, txn.fetchone())
+        return status and status.get('Seconds_Behind_Master')
+    #a PostgreSQL hot standby. Lag is measured from the last replayed transaction, so it also grows while the
+    # primary is idle (its reads then going to the primary, which has nothing else to do)
+    txn.execute("SELECT pg_is_in_recovery(), EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())")
+    inRecovery, lag = txn.fetchone()
+    if not inRecovery or lag is None:
+        return None
+    return max(float(lag), 0.0)
+
+
+def isReadOnlyStatement(queryString, fetch='N', many=False):
+    """@return: True if the statement can be run on a read replica"""
+    return not many and fetch != 'lid' and bool(READ_ONLY_STATEMENT_REGEX.match(queryString)) \
+        and not READ_ONLY_EXCLUSION_REGEX.search(queryString)
+
+
+def _runDirect(connID, readOnly, session, interaction, *args):
+    """Runs an interaction on one of connID's read replicas if it's read only and one is usable, and on the primary
+    otherwise. A replica found unreachable is taken out of rotation and the interaction reissued on the primary.
+    
+    @return: A deferred yielding the interaction's result
+    """
+    replicaSet = singleton.get(connID + 'Replicas', strict=False)
+    replica = replicaSet and replicaSet.chooseReplica(readOnly, session)
+    if not replica:
+        d = singleton.get(connID).runInteraction(interaction, *args)
+        if replicaSet and not readOnly:
+            #the read-your-writes window starts over once the write is done
+            d.addBoth(lambda result: (replicaSet.noteWrite(session), result)[1])
+        return d
+    
+    d = replica.runInteraction(interaction, *args)
+    d.addErrback(_ebRunOnReplica, replicaSet, replica, connID, interaction, args)
+    return d
+
+
+def _isConnDownFailure(failure, pool):
+    """@return: True if failure is pool's connection to its server being (or having gone) down"""
+    if failure.check(adbapi.ConnectionLost):
+        return True
+    if not failure.check(pool.dbapi.OperationalError):
+        return False
+    if pool.dbapiName == 'MySQLdb':
+        return _isMySQLServerConnDownErrorMessage(failure.getErrorMessage())
+    #other drivers (pyPgSQL) have no error codes to tell a lost connection from other operational errors by,
+    # and the DB-API has OperationalError cover the former
+    return True
+
+
+def _ebRunOnReplica(failure, replicaSet, replica, connID, interaction, args):
+    if not _isConnDownFailure(failure, replica.pool):
+        return failure
+    replicaSet.markDown(replica, failure.getErrorMessage())
+    return singleton.get(connID).runInteraction(interaction, *args)
+
+
+def getReplicaStats(connID='dbMetastore'):
+    """@return: See L{ReplicaSet.getStats}, or None if connID has no read replicas"""
+    replicaSet = singleton.get(connID + 'Replicas', strict=False)
+    return replicaSet and replicaSet.getStats() or None
+
+
 def fetchResultRowToDict(txn, row):
     if row is None:
         return None
@@ -431,8 +1129,8 @@ def fetchResultRowsToDict(txn, rows):
 
 
 def establishConnection(connID, hostname, port, username,
-password, database, minPoolCons, maxPoolCons, sslEnabled=False, sslCACert='', useServerCursor=False,
-dbProxySecHosts=None):
+password, database, minPoolCons, maxPoolCons, sslEnabled=False, sslCACert='',
+dbProxySecHosts=None, replicas=None, replicaRouting='round-robin', replicaMaxLag=None, readYourWritesWindow=0):
     """I establish a connection to either:
         - A mySQL SQL server using twisted's ADBAPI connection pool semantics.
         - A dbproxy server using twisted perspective broker (PB).
@@ -469,6 +1167,21 @@ dbProxySecHosts=None):
     @param maxPoolCons: The maximum number of connections to keep open to the database as part of the
     connection pool. 
     @type maxPoolCons: int
+    
+    @param replicas: (Optional.) Read replicas of the database, as a list of (hostname, port) tuples. They're
+    connected to with the same credentials and pool sizes, and read-only execute() statements (and callProc()
+    calls made with readOnly=True) are spread over them. See L{ReplicaSet}.
+    @type replicas: list
+    
+    @param replicaRouting: How reads are spread over the replicas, one of L{REPLICA_ROUTING_MODES}
+    @type replicaRouting: str
+    
+    @param replicaMaxLag: (Optional.) Skip replicas more than this many seconds behind the primary
+    @type replicaMaxLag: int
+    
+    @param readYourWritesWindow: Seconds after a write made under a session during which reads under the same
+    session go to the primary (see the session argument of L{execute})
+    @type readYourWritesWindow: int
     """
     assert isinstance(connID, basestring) and len(connID) >= 2 and connID[0:2] == 'db'
     assert hostname and isinstance(hostname, basestring)
@@ -476,6 +1189,7 @@ dbProxySecHosts=None):
     assert minPoolCons and isinstance(minPoolCons, int)
     assert maxPoolCons and isinstance(maxPoolCons, int)
     assert (sslEnabled and sslCACert) or not sslEnabled
+    assert replicaRouting in REPLICA_ROUTING_MODES
     
     d = None
     
@@ -494,27 +1208,34 @@ dbProxySecHosts=None):
         'cipher': None,
     }
     
-    cursorClassDict = {}
-    if useServerCursor:
-        from MySQLdb.cursors import SSCursor
-        cursorClassDict['cursorclass'] = SSCursor
     #try:
-    connPool = adbapi.ConnectionPool("pyPgSQL.PgSQL",
-        database=database,user=username, password=password,
-        host=hostname, port=port)
-        #user=username, passwd=password,
-        #db=database, cp_min=minPoolCons, cp_max=maxPoolCons)
-        #use_unicode=True, charset='utf8', ssl=sslEnabled and sslDict or None,
-        #cp_noisy=False,
-        #cp_reconnect=True, poolName=connID,
-        #**cursorClassDict)
+    connPool = _makeConnectionPool(BackloggingConnectionPool, hostname, port, username, password, database,
+        minPoolCons, maxPoolCons, poolName=connID)
     #except:
         #errorutil.triggerFatalError("Could not connect to database for pool \"%s\"" % connID)
         
     d = defer.succeed(True)
     singleton.store(connID + 'Type', 'direct')
     singleton.store(connID, connPool)
+    if replicas:
+        replicaSet = ReplicaSet(connID,
+            [ReadReplica("%s:%s" % (replicaHostname, replicaPort),
+                _makeConnectionPool(UtilizationTrackingConnectionPool, replicaHostname, replicaPort, username,
+                    password, database, minPoolCons, maxPoolCons))
+             for replicaHostname, replicaPort in replicas],
+            replicaRouting, replicaMaxLag, readYourWritesWindow)
+        singleton.store(connID + 'Replicas', replicaSet)
     return d
+
+
+def _makeConnectionPool(poolClass, hostname, port, username, password, database, minPoolCons, maxPoolCons,
+**poolKwargs):
+    """@param poolClass: L{BackloggingConnectionPool} for a primary, L{UtilizationTrackingConnectionPool} for a
+    read replica (whose failed reads go to the primary rather than being backlogged)"""
+    return poolClass("pyPgSQL.PgSQL",
+        database=database,user=username, password=password,
+        host=hostname, port=port, cp_min=minPoolCons, cp_max=maxPoolCons,
+        cp_noisy=False, cp_reconnect=True, **poolKwargs)
     
     
 def terminateConnection(connID):
@@ -525,10 +1246,14 @@ def terminateConnection(connID):
     """
     #Database connection is already closed by this point in twisted 2.x - what about PB? (closed automatically)
     singleton.remove(connID, errorLevelIfNonExistent='n')
+    if singleton.get(connID + 'Replicas', strict=False):
+        singleton.get(connID + 'Replicas').stop()
+        singleton.remove(connID + 'Replicas', errorLevelIfNonExistent='n')
 
 
 def callProc(procName, inArgList=(), fetch='N', connID='dbMetastore', useCache=False,
-cacheExpireTime=consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD, printQuery=False):
+cacheExpireTime=consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD, printQuery=False, _alreadyInBacklog=False, readOnly=False,
+session=None):
     """
     I execute a stored procedure on the database, and optionally trigger a callback function to handle
     the results.
@@ -554,9 +1279,17 @@ cacheExpireTime=consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD, printQuery=False):
     
     @param printQuery: Set to True to print the query to be executed. False by default.    
     
+    @param readOnly: Set to True if the proc only reads, so it can be run on a read replica (see
+    L{establishConnection}). Procs are assumed to write otherwise.
+    
+    @param session: See L{execute}
+    
     @return: A deferred that is triggered when the database operation is complete
+    
+    @note: The arguments are bound through the DB-API (see L{_getCallStatement}) rather than pasted into the
+    statement, so they can contain quotes and keep their types. The proc name itself must be a plain identifier.
     """
-    assert isinstance(procName, basestring)
+    _checkProcName(procName)
     assert isinstance(inArgList, tuple)
     assert fetch in ('N', 'o', 'om', 'a', 'am')
     assert singleton.get(connID + 'Type') in ('direct', 'dbproxy')
@@ -566,9 +1299,7 @@ cacheExpireTime=consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD, printQuery=False):
         #decode into a unicode string
         procName = procName.decode('utf-8')
     #decode string args as well
-    for i in xrange(len(inArgList)):
-        if isinstance(inArgList[i], str):
-            inArgList[i] = inArgList[i].decode('utf-8')
+    inArgList = tuple([isinstance(x, str) and x.decode('utf-8') or x for x in inArgList])
     
     log.msg(u"Processing stored proc call: \"%s\"; InArgs: %s" % (procName, inArgList,),
             lvl=printQuery and 'a' or 'd2', ss='ss_db')
@@ -582,78 +1313,98 @@ cacheExpireTime=consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD, printQuery=False):
     if useCache:
         #use the query string itself, along with the args list as the hash key, and the fetch mode
         cacheHashKey = _produceCacheHashKey(procName, inArgList, fetch) 
-        d = memcache.retrieve(cacheHashKey)
-        d.addCallback(_cbCallProc, procName, inArgList, fetch, connID, useCache, cacheExpireTime, printQuery,
-                      cacheHashKey)
+        if _alreadyInBacklog:
+            #a replay, whoever queued it already holds the in-flight entry for this key
+            d = memcache.retrieve(cacheHashKey)
+            d.addCallback(_cbCallProc, procName, inArgList, fetch, connID, useCache, cacheExpireTime, printQuery,
+                          cacheHashKey, _alreadyInBacklog, readOnly, session)
+        else:
+            d = _cachedCall(cacheHashKey, cacheExpireTime, _cbCallProc, procName, inArgList, fetch, connID, useCache,
+                cacheExpireTime, printQuery, cacheHashKey, _alreadyInBacklog, readOnly, session)
     else:
         cacheHashKey = ""
         d = defer.succeed(None)
         d.addCallback(_cbCallProc, procName, inArgList, fetch, connID, useCache, cacheExpireTime, printQuery,
-                      cacheHashKey)
+                      cacheHashKey, _alreadyInBacklog, readOnly, session)
     return d
 
 
-def _cbCallProc(cacheValue, procName, inArgList, fetch, connID, useCache, cacheExpireTime, printQuery, cacheHashKey):
+def _cbCallProc(cacheValue, procName, inArgList, fetch, connID, useCache, cacheExpireTime, printQuery, cacheHashKey,
+_alreadyInBacklog, readOnly, session):
     if cacheHashKey and cacheValue:
         #useCache set to true and we found something in the cache
-        #serialize it out from JSON
+        #deserialize it (see cachecodec)
         try:
-            cacheValue = simplejson.loads(cacheValue, encoding='utf-8')
+            cacheValue = cachecodec.decode(cacheValue)
             return cacheValue
         except:
-            log.msg(u"Could not load previously stored database results from memcached; could not unserialize from JSON for proc: \"%s\". InArgs: \"%s\""
+            log.msg(u"Could not load previously stored database results from memcached; could not deserialize the cached value for proc: \"%s\". InArgs: \"%s\""
                     % (procName, inArgList), lvl='w', ss='ss_db')
     
     #otherwise we're not caching or did not find anything in the memcache...call the proc
     if singleton.get(connID + 'Type') == 'direct':
-        d = singleton.get(connID).runInteraction(_directProcessCallProc, procName, inArgList, fetch, connID, useCache,
-            cacheExpireTime, cacheHashKey, printQuery)
+        d = _runDirect(connID, readOnly, session, _directProcessCallProc, procName, inArgList, fetch, connID,
+            useCache, cacheExpireTime, cacheHashKey, printQuery)
         d.addErrback(_directProcessCallProc_onError, procName, inArgList, fetch, connID, useCache,
-            cacheExpireTime, cacheHashKey, printQuery)
+            cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog)
         return d
     else: #dbproxy
         return singleton.get(connID).callProc(procName, inArgList, fetch, connID, useCache,
             cacheExpireTime, cacheHashKey)
     
 
+def _checkProcName(procName):
+    """@raise ValueError: If procName isn't a plain (optionally schema qualified) identifier, as it's pasted into
+    the CALL statement"""
+    if not isinstance(procName, basestring) or not PROC_NAME_REGEX.match(procName):
+        raise ValueError("Invalid stored procedure name: %r" % (procName,))
+
+
+def _getCallStatement(procName, argCount):
+    """Returns the parameterized CALL statement for a proc and number of arguments, e.g. "CALL myProc(%s, %s)",
+    the arguments being bound by the DB-API module rather than pasted in.
+    """
+    _checkProcName(procName)
+    return u"CALL %s(%s)" % (procName, ", ".join(["%s"] * argCount))
+
+
+def _fetchResults(txn, fetch):
+    if fetch == 'o':
+        return txn.fetchone()
+    elif fetch == 'om':
+        return fetchResultRowToDict(txn, txn.fetchone())
+    elif fetch == 'a':
+        return txn.fetchall()
+    elif fetch == 'am':
+        return fetchResultRowsToDict(txn, txn.fetchall())
+    #N = don't fetch anything
+    return None
+
+
 def _directProcessCallProc(txn, procName, inArgList, fetch, connID, useCache, cacheExpireTime, cacheHashKey,
 printQuery):
-    try:
-        #no out arguments
-        if fetch in ('a', 'am', 'N'):
-            txn.execute("CALL %s(%s);" % (procName, ", ".join(["'%s'" % arg for arg in inArgList])))
-            if fetch == 'o':
-                results = txn.fetchone()
-            elif fetch == 'om':
-                row = txn.fetchone()
-                results = fetchResultRowToDict(txn, row)
-            elif fetch == 'a':
-                results = txn.fetchall()
-            elif fetch == 'am':
-                rows = txn.fetchall()
-                results = fetchResultRowToDict(txn, rows)
-    except:
-        raise
+    #no out arguments
+    txn.execute(_getCallStatement(procName, len(inArgList)), inArgList)
+    results = _fetchResults(txn, fetch)
+    #with MySQLdb a CALL returns an extra (status) result set after the proc's own, drain it or the connection's
+    # next statement fails with "commands out of sync"
+    nextset = getattr(txn, 'nextset', None) #optional in the DB-API
+    while nextset and nextset():
+        pass
 
     if useCache:
         #cache this result in memory
         assert cacheHashKey
         
         try:
-            jsonResults = simplejson.dumps(results)
+            encodedResults = cachecodec.encode(results)
         except:
             #do not store in the memcache
-            log.msg(u"Could not store database results in memcached; could not serialize into JSON for proc: \"%s\". InArgs: \"%s\""
+            log.msg(u"Could not store database results in memcached; could not serialize the results for proc: \"%s\". InArgs: \"%s\""
                     % (procName, inArgList), lvl='w', ss='ss_db')
             return results
 
-        #if we are running this code in the castdaemon, override the cache period with the DB-based setting
-        if     cacheExpireTime == consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD \
-           and singleton.get('core', strict=False):
-            cacheExpireTime = singleton.get('core').getPlatformSetting('castdaemon_dbcache_interval', strict=False) \
-                or consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD
-        
-        threads.blockingCallFromThread(reactor, memcache.store, cacheHashKey, jsonResults, lifetime=cacheExpireTime)
+        _storeInCacheFromThread(cacheHashKey, encodedResults, cacheExpireTime)
     return results
 
 
@@ -662,7 +1413,7 @@ cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog):
     
     if failure.check(MySQLdb.ProgrammingError) or failure.check(TypeError):
         log.msg(u"Database query failure. Error: %s. Failed proc was: %s; Args: (%s)"
-            % (failure.getErrorMessage(), procName, ', '.join([x for x in inArgList]),), lvl='e', ss='ss_db')
+            % (failure.getErrorMessage(), procName, ', '.join([unicode(x) for x in inArgList]),), lvl='e', ss='ss_db')
         failure.raiseException() #invalid syntax error
     elif failure.check(MySQLdb.OperationalError):
         if singleton.get('castdaemon', strict=False) and (singleton.get('castdaemon').isShuttingDown() or errorutil.checkIfFatalErrorOccurred()):
@@ -692,19 +1443,20 @@ cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog):
         else:
             log.msg(u"Unknown database operational error. Error: %s. Failed proc was: %s; Args: (%s)"
                 % (failure.getErrorMessage(), procName,
-                    ', '.join([x for x in inArgList]),), lvl='e', ss='ss_db')
+                    ', '.join([unicode(x) for x in inArgList]),), lvl='e', ss='ss_db')
             failure.raiseException()
 
 
 def execute(queryString, argList=tuple(), fetch='N', connID='dbMetastore', useCache=False,
 cacheExpireTime=consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD, printQuery=False,
-_alreadyInBacklog=False, many=False):
+_alreadyInBacklog=False, many=False, session=None):
     """
     Executes a SQL statement on the database
     
     @param useCache: Set to True to use to cache the results of the query in memcached, or
     if the results are already cached in memcached, the cached version will be returned instead of having to
-    make a query to the DB again.
+    make a query to the DB again. Results are also kept for a few seconds in L{localCache}, and concurrent
+    calls missing on the same query share one memcached/DB lookup (see L{_cachedCall}).
     @param cacheExpireTime: The length of time that the result is valid in the memcache for (in seconds).
     This value is only used if memCacheKey is set to True.
     
@@ -712,6 +1464,10 @@ _alreadyInBacklog=False, many=False):
     
     @param fetch: Same as the arguments for L{callProc}, with the addition of:
         - 'lid': Return the last insert ID (not in a tuple or list)
+    
+    @param session: (Optional.) A key (e.g. a user ID) for the logical session the statement belongs to. If connID
+    has read replicas, reads are normally sent to them (see L{isReadOnlyStatement}), except for a short window
+    after a write under the same session (see the readYourWritesWindow argument of L{establishConnection}).
         
     @return: A deferred that yields the result of the query, or the data "DBEXECUTE-BACKLOG-ALREADYQUEUED" if we were executing
     a backlogged query (_alreadyInBacklog=True) and the DB was still downed (meaning it could still not be
@@ -751,35 +1507,40 @@ _alreadyInBacklog=False, many=False):
     if useCache:
         #use the query string itself, along with the args list as the hash key
         cacheHashKey = _produceCacheHashKey(queryString, argList, fetch)
-        d = memcache.retrieve(cacheHashKey)
-        d.addCallback(_cbExecute, queryString, argList, fetch, connID, useCache, cacheExpireTime, printQuery,
-                      cacheHashKey, _alreadyInBacklog, many)
+        if _alreadyInBacklog:
+            #a replay, whoever queued it already holds the in-flight entry for this key
+            d = memcache.retrieve(cacheHashKey)
+            d.addCallback(_cbExecute, queryString, argList, fetch, connID, useCache, cacheExpireTime, printQuery,
+                          cacheHashKey, _alreadyInBacklog, many, session)
+        else:
+            d = _cachedCall(cacheHashKey, cacheExpireTime, _cbExecute, queryString, argList, fetch, connID, useCache,
+                cacheExpireTime, printQuery, cacheHashKey, _alreadyInBacklog, many, session)
     else:
         cacheHashKey = ""
         d = defer.succeed(None)
         d.addCallback(_cbExecute, queryString, argList, fetch, connID, useCache, cacheExpireTime, printQuery,
-                      cacheHashKey, _alreadyInBacklog, many)
+                      cacheHashKey, _alreadyInBacklog, many, session)
     return d
 
 
 def _cbExecute(cacheValue, queryString, argList, fetch, connID, useCache, cacheExpireTime, printQuery, cacheHashKey,
-_alreadyInBacklog, many):
+_alreadyInBacklog, many, session):
     if cacheHashKey and cacheValue:
         #useCache set to true and we found something in the cache
-        #serialize it out from JSON
+        #deserialize it (see cachecodec)
         try:
-            cacheValue = simplejson.loads(cacheValue, encoding='utf-8')
+            cacheValue = cachecodec.decode(cacheValue)
             return cacheValue
         except:
-            log.msg(u"Could not load previously stored database results from memcached; could not unserialize from JSON for query: \"%s\". Args: \"%s\""
+            log.msg(u"Could not load previously stored database results from memcached; could not deserialize the cached value for query: \"%s\". Args: \"%s\""
                     % (queryString, argList), lvl='w', ss='ss_db')
 
     #otherwise we're not caching or did not find anything in the memcache...make the query
     if singleton.get(connID + 'Type') == 'direct':
-        d = singleton.get(connID).runInteraction(_directProcessExecute, queryString, argList, fetch, connID, useCache,
-            cacheExpireTime, cacheHashKey, printQuery, many)
+        d = _runDirect(connID, isReadOnlyStatement(queryString, fetch, many), session, _directProcessExecute,
+            queryString, argList, fetch, connID, useCache, cacheExpireTime, cacheHashKey, printQuery, many)
         d.addErrback(_directProcessExecute_onError, queryString, argList, fetch, connID, useCache,
-            cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog)
+            cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog, many)
         return d
     else: #dbproxy
         return singleton.get(connID).execute(queryString, argList, fetch, connID, useCache,
@@ -815,28 +1576,22 @@ def _directProcessExecute(txn, queryString, argList, fetch, connID, useCache, ca
         assert cacheHashKey
         
         try:
-            jsonResults = simplejson.dumps(results)
+            encodedResults = cachecodec.encode(results)
         except:
             #do not store in the memcache
-            log.msg(u"Could not store database results in memcached; could not serialize into JSON for query: \"%s\". Args: \"%s\""
+            log.msg(u"Could not store database results in memcached; could not serialize the results for query: \"%s\". Args: \"%s\""
                     % (queryString, argList), lvl='w', ss='ss_db')
             return results
 
-        #if we are running this code in the castdaemon, override the cache period with the DB-based setting
-        if     cacheExpireTime == consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD \
-           and singleton.get('core', strict=False):
-            cacheExpireTime = singleton.get('core').getPlatformSetting('castdaemon_dbcache_interval', strict=False) \
-                or consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD
-        
-        threads.blockingCallFromThread(reactor, memcache.store, cacheHashKey, jsonResults, lifetime=cacheExpireTime)
+        _storeInCacheFromThread(cacheHashKey, encodedResults, cacheExpireTime)
     return results
 
 
 def _directProcessExecute_onError(failure, queryString, argList, fetch, connID, useCache,
-cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog):
+cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog, many):
     if failure.check(MySQLdb.ProgrammingError) or failure.check(TypeError):
         log.msg(u"Database query failure. Error: %s. Failed query was: %s; Args: (%s)"
-            % (failure.getErrorMessage(), queryString, ', '.join([x for x in argList]),), lvl='e', ss='ss_db')
+            % (failure.getErrorMessage(), queryString, ', '.join([unicode(x) for x in argList]),), lvl='e', ss='ss_db')
         failure.raiseException() #invalid syntax error
     elif failure.check(MySQLdb.OperationalError):
         if singleton.get('castdaemon', strict=False) and (singleton.get('castdaemon').isShuttingDown() or errorutil.checkIfFatalErrorOccurred()):
@@ -847,14 +1602,13 @@ cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog):
         if     _isMySQLServerConnDownErrorMessage(failure.getErrorMessage()) and not _alreadyInBacklog:
             #currently not connected, queue up the request to be run when the connection is restored
             dRequestCompleted = defer.Deferred() #will be fired when the query is finally issued against the DB
-            backlogItem = {'callType': 'execute', 'queryString': queryString, 'argList': argList,
+            backlogItem = {'callType': 'execute', 'queryString': queryString, 'argList': argList, 'many': many,
                 'fetch': fetch, 'connID': connID, 'useCache': useCache,
                 'cacheExpireTime': cacheExpireTime, 'cacheHashKey': cacheHashKey, 'printQuery': printQuery,
                 'dRequestCompleted': dRequestCompleted, }
 
             log.msg(u"Connectivity failure: Queuing query (MD5: %s): \"%s\". New backlog length: %i"
-                % (_getBacklogEntryLoggingHash(backlogItem),
-                   sharedstrutil.truncate(sharedstrutil.removeMultipleSpacesFromString(queryString).strip(), 80),
+                % (_getBacklogEntryLoggingHash(backlogItem), _truncateQueryForLog(queryString),
                    singleton.get(connID).getQueryBacklogSize() + 1), lvl='i', ss='ss_db')
 
             singleton.get(connID)._addToQueryBacklog(backlogItem)
@@ -866,10 +1620,315 @@ cacheExpireTime, cacheHashKey, printQuery, _alreadyInBacklog):
         else:
             log.msg(u"Unknown database operational error. Error: %s. Failed query was: %s; Args: (%s)"
                 % (failure.getErrorMessage(), queryString,
-                    ', '.join([x for x in argList]),), lvl='e', ss='ss_db')
+                    ', '.join([unicode(x) for x in argList]),), lvl='e', ss='ss_db')
             failure.raiseException()
 
 
+class BatchWriter(object):
+    """Coalesces single-row writes of one statement into batches issued with L{execute}(many=True), i.e. a single
+    executemany() and commit per batch (which MySQLdb turns into one multi-row statement for INSERTs).
+    
+    A batch is flushed once it holds maxBatchSize rows, or maxDelay seconds after its first row was queued. If a
+    batch fails for a reason other than DB connectivity (which the backlog handles as for any execute), its rows
+    are retried one by one so that only the offending ones fail.
+    """
+    
+    def __init__(self, queryString, connID='dbMetastore', maxBatchSize=BATCH_WRITER_DEFAULT_MAXSIZE,
+    maxDelay=BATCH_WRITER_DEFAULT_MAXDELAY):
+        assert queryString and not READ_ONLY_STATEMENT_REGEX.match(queryString)
+        assert maxBatchSize >= 1
+        self.queryString = queryString
+        self.connID = connID
+        self.maxBatchSize = maxBatchSize
+        self.maxDelay = maxDelay
+        self._rows = []
+        self._deferreds = []
+        self._flushCall = None
+        self._stats = {'rowsQueued': 0, 'rowsWritten': 0, 'rowsFailed': 0, 'batches': 0, 'batchFailures': 0}
+    
+    
+    def write(self, argList):
+        """Queues a row.
+        
+        @param argList: The statement's arguments for this row
+        @type argList: tuple
+        @return: A deferred fired (with None) once the row is committed, or errbacked if it couldn't be written
+        """
+        d = defer.Deferred()
+        self._rows.append(tuple(argList))
+        self._deferreds.append(d)
+        self._stats['rowsQueued'] += 1
+        if len(self._rows) >= self.maxBatchSize:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = reactor.callLater(self.maxDelay, self.flush)
+        return d
+    
+    
+    def flush(self):
+        """Issues the rows queued so far as one batch.
+        
+        @return: A deferred fired once that batch is done (whether its rows were written or not)
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if not self._rows:
+            return defer.succeed(None)
+        
+        rows, deferreds = tuple(self._rows), self._deferreds
+        self._rows, self._deferreds = [], []
+        self._stats['batches'] += 1
+        d = execute(self.queryString, rows, connID=self.connID, many=True)
+        d.addCallbacks(self._cbFlush, self._ebFlush, callbackArgs=(rows, deferreds), errbackArgs=(rows, deferreds))
+        return d
+    
+    
+    def _cbFlush(self, result, rows, deferreds):
+        self._stats['rowsWritten'] += len(rows)
+        for d in deferreds:
+            d.callback(None)
+    
+    
+    def _ebFlush(self, failure, rows, deferreds):
+        if len(rows) == 1 or failure.check(MySQLdb.OperationalError):
+            #nothing to isolate, or the DB is going away (see _directProcessExecute_onError)
+            self._stats['rowsFailed'] += len(rows)
+            for d in deferreds:
+                d.errback(failure)
+            return
+        
+        self._stats['batchFailures'] += 1
+        log.msg(u"Batch of %i rows failed (%s), retrying them one by one. Statement: \"%s\""
+            % (len(rows), failure.getErrorMessage(), _truncateQueryForLog(self.queryString)), lvl='w', ss='ss_db')
+        dRows = []
+        for row, dRow in zip(rows, deferreds):
+            d = execute(self.queryString, row, connID=self.connID)
+            d.addCallbacks(self._cbFlush, self._ebFlush, callbackArgs=((row,), [dRow]),
+                errbackArgs=((row,), [dRow]))
+            dRows.append(d)
+        return defer.DeferredList(dRows)
+    
+    
+    def getStats(self):
+        """@return: A dict with the rows queued, written and failed, the batches issued and failed, the mean batch
+        size and the rows currently waiting
+        """
+        stats = dict(self._stats)
+        stats['pending'] = len(self._rows)
+        stats['meanBatchSize'] = stats['batches'] and float(stats['rowsQueued'] - stats['pending']) \
+            / stats['batches'] or 0
+        return stats
+
+
+_batchWriters = {} #(connID, queryString) -> BatchWriter
+
+def executeBatched(queryString, argList=tuple(), connID='dbMetastore'):
+    """Writes a row through the shared L{BatchWriter} for the statement (created with the default batch size and
+    delay on first use). Meant for hot single-row INSERT/UPDATE/DELETE paths, e.g. event and log inserts.
+    
+    @return: A deferred fired (with None) once the row is committed
+    """
+    key = (connID, queryString)
+    if key not in _batchWriters:
+        _batchWriters[key] = BatchWriter(queryString, connID)
+    return _batchWriters[key].write(argList)
+
+
+def flushBatchWriters():
+    """Flushes every shared L{BatchWriter} right away (e.g. at shutdown).
+    
+    @return: A deferred fired once all their batches are done
+    """
+    return defer.DeferredList([writer.flush() for writer in _batchWriters.values()])
+
+
+def getBatchWriterStats():
+    """@return: L{BatchWriter.getStats} for each shared writer, keyed by connID and (truncated) statement"""
+    return dict([("%s: %s" % (connID, _truncateQueryForLog(queryString)), writer.getStats())
+        for (connID, queryString), writer in _batchWriters.iteritems()])
+
+
+_streamCursorIDs = itertools.count()
+
+class QueryStream(object):
+    """Reads the results of a (large) query a chunk at a time off a named server-side cursor (DECLARE ... CURSOR
+    FOR, then FETCH FORWARD chunkSize), rather than loading them all in memory as L{execute} does.
+    
+    The query runs in a pool thread that holds its connection, and keeps its transaction open, until the stream
+    ends. Once it has fetched a chunk,
+    that thread waits for the chunk to be taken before fetching the next one, so no more than two chunks are ever
+    held in memory, however large the result set. Chunks are taken with L{nextChunk}, or handed to a callback by
+    L{consume}. A stream must be read to its end or L{cancel}led, as it ties up a pool connection until then.
+    
+    Streamed queries aren't cached, backlogged or sent to read replicas.
+    """
+    
+    def __init__(self, queryString, argList=tuple(), fetch='a', chunkSize=STREAM_DEFAULT_CHUNK_SIZE,
+    connID='dbMetastore'):
+        assert queryString and fetch in ('a', 'am')
+        assert chunkSize >= 1
+        assert singleton.get(connID + 'Type') == 'direct'
+        self.queryString = queryString
+        self.argList = tuple(argList)
+        self.fetch = fetch
+        self.chunkSize = chunkSize
+        self.connID = connID
+        self.rowCount = 0 #rows taken so far
+        self._chunk = None #fetched by the pool thread, not taken yet
+        self._dChunkTaken = None #what the pool thread waits on before fetching the next chunk
+        self._dWaiting = None #a nextChunk() call waiting on the pool thread
+        self._cancelled = False
+        self._done = False
+        self._failure = None
+        self._cursorName = "webservice_stream_%i" % _streamCursorIDs.next()
+    
+    
+    def start(self):
+        log.msg(u"Streaming query: \"%s\"; Args: %s" % (self.queryString, self.argList), lvl='d2', ss='ss_db')
+        d = singleton.get(self.connID).runWithConnection(self._directStream)
+        d.addBoth(self._streamFinished)
+        return self
+    
+    
+    def nextChunk(self):
+        """@return: A deferred yielding the next chunk of rows (a list of tuples, or of dicts with fetch='am'), or
+        None once the result set is exhausted (or the stream cancelled). It errbacks if the query failed.
+        """
+        assert self._dWaiting is None, "nextChunk() called before the previous chunk came"
+        self._dWaiting = defer.Deferred()
+        d = self._dWaiting
+        self._serve()
+        return d
+    
+    
+    def consume(self, consumer):
+        """Hands each chunk to consumer(rows) as it comes. If the consumer returns a deferred, the next chunk
+        isn't handed over until it has fired.
+        
+        @return: A deferred yielding the number of rows streamed once the result set is exhausted. It errbacks if
+        the query or the consumer failed (the stream being cancelled in the latter case).
+        """
+        dDone = defer.Deferred()
+        self._consumeNext(dDone, consumer)
+        return dDone
+    
+    
+    def cancel(self):
+        """Stops the stream. No more chunks are fetched, and the pool connection is released once the chunk
+        being fetched (if any) has come and the cursor is closed.
+        """
+        if self._done or self._cancelled:
+            return
+        self._cancelled = True
+        self._chunk = None
+        if self._dChunkTaken is not None:
+            d, self._dChunkTaken = self._dChunkTaken, None
+            d.callback(None)
+    
+    
+    def _consumeNext(self, dDone, consumer):
+        d = self.nextChunk()
+        d.addCallbacks(self._cbConsumeChunk, dDone.errback, callbackArgs=(dDone, consumer))
+    
+    
+    def _cbConsumeChunk(self, rows, dDone, consumer):
+        if rows is None:
+            dDone.callback(self.rowCount)
+            return
+        d = defer.maybeDeferred(consumer, rows)
+        d.addCallbacks(lambda _: self._consumeNext(dDone, consumer), self._ebConsumer, errbackArgs=(dDone,))
+    
+    
+    def _ebConsumer(self, failure, dDone):
+        log.msg(u"Consumer of streamed query failed (%s), cancelling the stream. Query: \"%s\""
+            % (failure.getErrorMessage(), _truncateQueryForLog(self.queryString)), lvl='w', ss='ss_db')
+        self.cancel()
+        dDone.errback(failure)
+    
+    
+    def _serve(self):
+        #hands the pending chunk (or the end of the stream) to a waiting nextChunk() call, if any
+        if self._dWaiting is None:
+            return
+        if self._chunk is not None:
+            d, rows = self._dWaiting, self._chunk
+            self._dWaiting = self._chunk = None
+            self.rowCount += len(rows)
+            #let the pool thread fetch the next chunk while this one is being processed
+            dTaken, self._dChunkTaken = self._dChunkTaken, None
+            dTaken.callback(None)
+            d.callback(rows)
+        elif self._done:
+            d, self._dWaiting = self._dWaiting, None
+            if self._failure is not None:
+                d.errback(self._failure)
+            else:
+                d.callback(None)
+    
+    
+    def _deliver(self, rows):
+        #called in the reactor, the pool thread blocking until the returned deferred fires
+        if self._cancelled:
+            return defer.succeed(None)
+        self._chunk = rows
+        self._dChunkTaken = defer.Deferred()
+        d = self._dChunkTaken
+        self._serve()
+        return d
+    
+    
+    def _directStream(self, conn):
+        #runs in a pool thread, within the connection's transaction (which runWithConnection commits, or rolls back
+        # on an error, closing the cursor). The result set stays on the server until it's FETCHed
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DECLARE %s NO SCROLL CURSOR FOR %s" % (self._cursorName,
+                self.queryString.rstrip().rstrip(';')), self.argList)
+            fetchStatement = "FETCH FORWARD %i FROM %s" % (self.chunkSize, self._cursorName)
+            while not self._cancelled:
+                cursor.execute(fetchStatement)
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                if self.fetch == 'am':
+                    rows = fetchResultRowsToDict(cursor, rows)
+                threads.blockingCallFromThread(reactor, self._deliver, list(rows))
+            cursor.execute("CLOSE %s" % self._cursorName)
+        finally:
+            cursor.close()
+    
+    
+    def _streamFinished(self, result):
+        self._done = True
+        if isinstance(result, twistedFailure.Failure):
+            log.msg(u"Streamed query failed. Error: %s. Failed query was: %s; Args: (%s)"
+                % (result.getErrorMessage(), self.queryString, ', '.join([unicode(x) for x in self.argList]),),
+                lvl='e', ss='ss_db')
+            self._failure = result
+        self._serve()
+
+
+def streamQuery(queryString, argList=tuple(), fetch='a', chunkSize=STREAM_DEFAULT_CHUNK_SIZE, connID='dbMetastore'):
+    """Starts streaming the results of a query (see L{QueryStream}), for result sets too large to be fetched
+    whole with L{execute}. Either read it chunk by chunk::
+    
+        stream = dbutil.streamQuery("SELECT id, email FROM user", fetch='am')
+        rows = yield stream.nextChunk()
+        while rows is not None:
+            ...
+            rows = yield stream.nextChunk()
+    
+    or hand it a callback with C{dbutil.streamQuery(...).consume(processRows)}.
+    
+    @param fetch: 'a' for the rows as tuples, or 'am' for them as maps
+    @param chunkSize: The number of rows fetched at a time
+    @return: The started L{QueryStream}
+    """
+    return QueryStream(queryString, argList, fetch, chunkSize, connID).start()
+
+
 def runInteraction(interaction, *args, **kwargs):
     """
     I am a wrapper to the L{twisted.enterprise.adbapi.ConnectionPool.runInteraction} function. See the
@@ -987,11 +2046,23 @@ cacheExpireTime=consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD):
         #use the query string itself, along with the args list as the hash key
         cacheHashKey = _produceCacheHashKey(queryString, argList, fetch)
         
+        #try the local tier first (not coalesced with other lookups, as that would mean holding this
+        # transaction's connection while waiting on someone else's)
+        state, results = localCache.lookup(cacheHashKey)
+        if state == localcache.HIT:
+            return results
+        
         #get the result from memcached in a blocking manner
         results = threads.blockingCallFromThread(reactor, memcache.retrieve, cacheHashKey)
         if results:
-            results = simplejson.loads(results)
-            return results
+            try:
+                results = cachecodec.decode(results)
+            except:
+                log.msg(u"Could not load previously stored database results from memcached; could not deserialize the cached value for query: \"%s\". Args: \"%s\""
+                        % (queryString, argList), lvl='w', ss='ss_db')
+            else:
+                localCache.store(cacheHashKey, results, _getCacheExpireTime(cacheExpireTime))
+                return results
     else:
         cacheHashKey = ""
     
@@ -1021,20 +2092,15 @@ cacheExpireTime=consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD):
         assert cacheHashKey
         
         try:
-            jsonResults = simplejson.dumps(results)
+            encodedResults = cachecodec.encode(results)
         except:
             #do not store in the memcache
-            log.msg(u"Could not store database results in memcached; could not serialize into JSON for query: \"%s\". Args: \"%s\""
+            log.msg(u"Could not store database results in memcached; could not serialize the results for query: \"%s\". Args: \"%s\""
                     % (queryString, argList), lvl='w', ss='ss_db')
             return results
         
-        #if we are running this code in the castdaemon, override the cache period with the DB-based setting
-        if     cacheExpireTime == consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD \
-           and singleton.get('core', strict=False):
-            cacheExpireTime = singleton.get('core').getPlatformSetting('castdaemon_dbcache_interval', strict=False) \
-                or consts.MEMCACHED_DEFAULT_EXPIRE_PERIOD
-
-        threads.blockingCallFromThread(reactor, memcache.store, cacheHashKey, jsonResults, lifetime=cacheExpireTime)
+        localCache.store(cacheHashKey, results, _getCacheExpireTime(cacheExpireTime))
+        _storeInCacheFromThread(cacheHashKey, encodedResults, cacheExpireTime)
     
     return results
 
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded in-process LRU cache with per-entry lifetimes, used as a first tier in front of memcached
+
+@license:    See LICENSE file for more information
+"""
+
+#############################
+#MODULE DEPENDENCIES
+#############################
+#General deps
+import collections
+import threading
+import time
+
+
+#############################
+#MODULE-LEVEL VARIABLES
+#############################
+LOCAL_CACHE_DEFAULT_MAXSIZE = 5000 #max number of entries held before the least recently used ones are evicted
+LOCAL_CACHE_DEFAULT_MAX_LIFETIME = 5 #in seconds, entries never live longer than this (nor their memcached lifetime)
+LOCAL_CACHE_DEFAULT_STALE_PERIOD = 0 #in seconds, how long an expired entry may still be served while it's refreshed
+
+#lookup states
+MISS = 'miss'
+HIT = 'hit'
+STALE = 'stale'
+
+
+#############################
+#MODULE FUNCTIONALITY
+#############################
+def copyResult(value):
+    """Copies a DB result (a row, or a list/tuple of rows) down to the rows, so that a caller modifying what it
+    got back doesn't change what other callers get from the cache
+    """
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [_copyRow(row) for row in value]
+    if isinstance(value, tuple):
+        return tuple([_copyRow(row) for row in value])
+    return value
+
+
+def _copyRow(row):
+    if isinstance(row, dict):
+        return dict(row)
+    if isinstance(row, list):
+        return list(row)
+    return row
+
+
+
+class LocalCache(object):
+    """A thread safe LRU cache. Entries expire after their lifetime, but are kept for stalePeriod seconds
+    more so that L{lookup} can hand them out (as L{STALE}) while the caller refreshes them.
+    """
+
+    def __init__(self, maxSize=LOCAL_CACHE_DEFAULT_MAXSIZE, maxLifetime=LOCAL_CACHE_DEFAULT_MAX_LIFETIME,
+    stalePeriod=LOCAL_CACHE_DEFAULT_STALE_PERIOD):
+        self.maxSize = maxSize
+        self.maxLifetime = maxLifetime
+        self.stalePeriod = stalePeriod
+        self._entries = collections.OrderedDict() #key -> (value, expiresAt), least recently used first
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'staleHits': 0, 'misses': 0, 'evictions': 0, 'coalesced': 0}
+
+
+    def lookup(self, key):
+        """@return: A (state, value) tuple, state being one of L{HIT}, L{STALE} or L{MISS} (value is None)"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats['misses'] += 1
+                return MISS, None
+            value, expiresAt = entry
+            if now < expiresAt:
+                self._entries[key] = entry #most recently used again
+                self._stats['hits'] += 1
+                return HIT, copyResult(value)
+            if now < expiresAt + self.stalePeriod:
+                self._entries[key] = entry
+                self._stats['staleHits'] += 1
+                return STALE, copyResult(value)
+            #expired for good, leave it removed
+            self._stats['misses'] += 1
+            return MISS, None
+
+
+    def store(self, key, value, lifetime):
+        """@param lifetime: In seconds, capped to maxLifetime (0 meaning no expiry, as with memcached)"""
+        if not self.maxSize:
+            return
+        expiresAt = time.time() + (lifetime and min(lifetime, self.maxLifetime) or self.maxLifetime)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (copyResult(value), expiresAt)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def countCoalesced(self):
+        """Counts a lookup that missed but was served by a fill already in progress for the same key"""
+        with self._lock:
+            self._stats['coalesced'] += 1
+
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
+
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """
-Interface to local memcached on the box (which Castdaemon will manage)    
+Interface to memcached: the local one on the box (which Castdaemon will manage), or a set of nodes sharded over
+with consistent hashing
 
 $Id:memcache.py 754 2010-01-02 18:03:05Z robbyd $
 @copyright:  2004-2007 Robby Dermody. 2008-Present Castdot, Inc. All Rights Reserved.
@@ -12,6 +13,9 @@ $Id:memcache.py 754 2010-01-02 18:03:05Z robbyd $
 #MODULE DEPENDENCIES
 #############################
 #General deps
+import bisect
+import hashlib
+import struct
 import uuid
 from twisted.internet import defer, protocol, reactor
 from twisted.python import log
@@ -26,47 +30,261 @@ from webservice_tools.twisted import consts, singleton
 #############################
 STORED_TOKEN_ACTIVE_PERIOD_MIN = 1 #in seconds
 STORED_TOKEN_ACTIVE_PERIOD_MAX = 86400 * 5 #in seconds
+MEMCACHED_CONNECTIONS_PER_NODE = 2 #protocol connections kept to each memcached node
+KETAMA_POINTS_PER_NODE = 160 #points each node gets on the hash ring (as with libketama, 4 per MD5 digest)
 
 
 #############################
 #MODULE FUNCTIONALITY
 #############################
+class MemcacheClientProtocol(memcache.MemCacheProtocol):
+    
+    def connectionMade(self):
+        memcache.MemCacheProtocol.connectionMade(self)
+        #requests are small and often pipelined (see retrieveMany/storeMany/retrieveAndDelete), don't let Nagle's
+        # algorithm hold them back waiting on the server's (delayed) ACKs
+        self.transport.setTcpNoDelay(True)
+        self.factory.node.connectionMade(self)
+    
+    
+    def connectionLost(self, reason):
+        memcache.MemCacheProtocol.connectionLost(self, reason)
+        self.factory.node.connectionLost(self)
+
+
+
 class MemcacheClientFactory(protocol.ReconnectingClientFactory):
     noisy = False
     factor = 1
     maxDelay = 1
 
-    def __init__(self, deferred):
-        self.deferred = deferred
+    def __init__(self, node):
+        self.node = node
         self.proto = None #initialized in buildProtocol
 
 
     def __repr__(self):
-        return "<ClientCreator factory: %r>" % (self.instance, )
+        return "<MemcacheClientFactory for %s>" % (self.node, )
 
 
     def buildProtocol(self, addr):
         self.resetDelay()
-        self.proto = memcache.MemCacheProtocol()
-        if self.deferred:
-            reactor.callLater(0, self.deferred.callback, self.proto)
-            del self.deferred
-            self.deferred = None
-        singleton.store('memCacheClient', self.proto)
+        self.proto = MemcacheClientProtocol()
+        self.proto.factory = self
         return self.proto
 
 
-def connectToMemcached():
+
+class MemcacheNode(object):
+    """A memcached server, and the pool of connections we keep to it"""
+    
+    def __init__(self, client, host, port, connections=MEMCACHED_CONNECTIONS_PER_NODE):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.protocols = [] #connected ones
+        self._factories = [MemcacheClientFactory(self) for i in xrange(connections)]
+    
+    
+    def __repr__(self):
+        return "%s:%s" % (self.host, self.port)
+    
+    
+    def connect(self):
+        for factory in self._factories:
+            reactor.connectTCP(self.host, self.port, factory)
+    
+    
+    def disconnect(self):
+        for factory in self._factories:
+            factory.stopTrying()
+            if factory.proto and factory.proto.transport:
+                factory.proto.transport.loseConnection()
+    
+    
+    def isAlive(self):
+        return bool(self.protocols)
+    
+    
+    def connectionMade(self, proto):
+        self.protocols.append(proto)
+        if len(self.protocols) == 1:
+            self.client.nodeUp(self)
+
+
+    def connectionLost(self, proto):
+        if proto in self.protocols:
+            self.protocols.remove(proto)
+            if not self.protocols:
+                self.client.nodeDown(self)
+    
+    
+    def getProtocol(self, keyHash):
+        #always use the same connection for a given key, so pipelined requests on it (e.g. a get then a delete)
+        # are answered in the order they were sent
+        return self.protocols[keyHash % len(self.protocols)]
+
+
+
+class HashRing(object):
+    """A ketama style consistent hash ring. Adding or removing a node only remaps the keys that hash to
+    (or, once it's back, from) that node's points on the ring.
     """
-    @return: The memcached protocol client object, or False if a connection attempt is already in progress
+    
+    def __init__(self, pointsPerNode=KETAMA_POINTS_PER_NODE):
+        self.pointsPerNode = pointsPerNode
+        self._nodes = []
+        self._points = [] #sorted ring positions
+        self._pointNodes = [] #node at each of those positions
+    
+    
+    def setNodes(self, nodes):
+        ring = []
+        for node in nodes:
+            for i in xrange(self.pointsPerNode // 4):
+                digest = hashlib.md5("%s-%i" % (node, i)).digest()
+                ring.extend([(point, node) for point in struct.unpack('<4I', digest)])
+        ring.sort()
+        self._nodes = list(nodes)
+        self._points = [point for point, node in ring]
+        self._pointNodes = [node for point, node in ring]
+    
+    
+    def getNode(self, keyHash):
+        """@return: The node responsible for the given key hash (see L{hashKey}), or None if the ring is empty"""
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, keyHash)
+        return self._pointNodes[i < len(self._points) and i or 0]
+    
+    
+    def __len__(self):
+        return len(self._nodes)
+
+
+def hashKey(key):
+    return struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+
+
+
+class ShardedMemcacheClient(object):
+    """Spreads keys over several memcached nodes with a L{HashRing}. Exposes the subset of
+    L{memcache.MemCacheProtocol}'s interface used in this module, so the functions here go through it unchanged.
+    
+    A node whose connections have all gone down is taken off the ring (its keys move to the next nodes on the
+    ring, the others stay where they were) until one reconnects. With no node up, gets miss and sets/deletes
+    yield False.
+    """
+    
+    def __init__(self, nodes, connectionsPerNode=MEMCACHED_CONNECTIONS_PER_NODE):
+        """
+        @param nodes: A list of (host, port) tuples
+        """
+        self.nodes = [MemcacheNode(self, host, port, connectionsPerNode) for host, port in nodes]
+        self.ring = HashRing()
+        self._dConnected = defer.Deferred() #fired once the first node is up
+    
+    
+    def connect(self):
+        """@return: A deferred fired (with this client) once the first node is up"""
+        for node in self.nodes:
+            node.connect()
+        return self._dConnected
+    
+    
+    def disconnect(self):
+        for node in self.nodes:
+            node.disconnect()
+    
+    
+    def nodeUp(self, node):
+        log.msg(u"memcached node %s is up, adding it to the ring" % (node,), lvl='i', ss='ss_iblapi_memcache')
+        self._rebuildRing()
+        if self._dConnected is not None:
+            d, self._dConnected = self._dConnected, None
+            reactor.callLater(0, d.callback, self)
+    
+    
+    def nodeDown(self, node):
+        log.msg(u"memcached node %s is down, ejecting it from the ring" % (node,), lvl='w', ss='ss_iblapi_memcache')
+        self._rebuildRing()
+    
+    
+    def _rebuildRing(self):
+        self.ring.setNodes([node for node in self.nodes if node.isAlive()])
+    
+    
+    def getLiveNodeCount(self):
+        return len(self.ring)
+    
+    
+    def _getProtocol(self, key):
+        keyHash = hashKey(key)
+        node = self.ring.getNode(keyHash)
+        return node and node.getProtocol(keyHash) or None
+    
+    
+    def get(self, key):
+        proto = self._getProtocol(key)
+        if proto is None:
+            return defer.succeed((0, None))
+        return proto.get(key)
+    
+    
+    def set(self, key, val, flags=0, expireTime=0):
+        proto = self._getProtocol(key)
+        if proto is None:
+            return defer.succeed(False)
+        return proto.set(key, val, flags, expireTime)
+    
+    
+    def delete(self, key):
+        proto = self._getProtocol(key)
+        if proto is None:
+            return defer.succeed(False)
+        return proto.delete(key)
+    
+    
+    def getMultiple(self, keys):
+        """One multi-key get per node, all sent at once.
+        
+        @return: A deferred yielding a dict of key to (flags, value), (0, None) for keys not found
+        """
+        keysByProtocol = {}
+        results = {}
+        for key in keys:
+            proto = self._getProtocol(key)
+            if proto is None:
+                results[key] = (0, None)
+            else:
+                keysByProtocol.setdefault(proto, []).append(key)
+        
+        dGets = []
+        for proto, protoKeys in keysByProtocol.iteritems():
+            d = proto.getMultiple(protoKeys)
+            d.addCallback(results.update)
+            dGets.append(d)
+        d = defer.gatherResults(dGets)
+        d.addCallback(lambda _: results)
+        return d
+
+
+
+def connectToMemcached(nodes=None, connectionsPerNode=MEMCACHED_CONNECTIONS_PER_NODE):
+    """
+    @param nodes: The memcached servers to shard over, as a list of (host, port) tuples. Defaults to the local
+        memcached only.
+    @return: A deferred yielding the L{ShardedMemcacheClient} (also stored as the 'memCacheClient' singleton)
+        once the first node is up
     """
     log.msg("%s memcache client connection..." % (singleton.get('memCacheClient', strict=False)
         and "REMAKING" or "Making",), lvl='i', ss='ss_castdaemon')
-
-    d = defer.Deferred()
-    client = MemcacheClientFactory(d)
-    reactor.connectTCP("localhost", consts.MISC_MEMCACHED_PORT, client)
-    return d
+    
+    if singleton.get('memCacheClient', strict=False):
+        singleton.get('memCacheClient').disconnect()
+    client = ShardedMemcacheClient(nodes or [("localhost", consts.MISC_MEMCACHED_PORT)], connectionsPerNode)
+    singleton.store('memCacheClient', client)
+    return client.connect()
 
 
 def storeByUUID(content, lifetime=consts.IBL_API_MEMCACHE_DEFAULT_LIFETIME):
@@ -111,10 +329,7 @@ def store(key, content, lifetime=consts.IBL_API_MEMCACHE_DEFAULT_LIFETIME):
    
     log.msg("memcache.store: key=%s, lifetime=%s" % (key, lifetime), lvl='d2', ss='ss_iblapi_memcache')
 
-    memcacheClient = singleton.get('memCacheClient', strict=False)
-    if not memcacheClient:
-        raise Exception("memCacheClient not initialized yet!")
-
+    memcacheClient = _getClient()
     d = memcacheClient.set(key, content, expireTime=lifetime)
     d.addCallback(lambda result: result == True and key or None)
     d.addErrback(lambda failure: log.msg("Could not make 'set' query to memcached daemon. Failure: %s" % failure,
@@ -127,42 +342,139 @@ def retrieve(key, clearOnRetrieval=False):
     Given a Key, retrieves content that was stored earlier in a local memcache.
     
     @param key: The key to get.
-    @param clearOnRetrieval: Set to True to remove the data from the memcache after retrival.
+    @param clearOnRetrieval: Set to True to remove the data from the memcache after retrival (see
+        L{retrieveAndDelete}).
     @return: The cached data, or None if not found
     """
     assert key
+    if clearOnRetrieval:
+        return retrieveAndDelete(key)
     #convert unicode strings to ascii strings
     if isinstance(key, unicode):
         key = key.encode('utf-8')
         
-    log.msg("memcache.retrieve: key=%s, clearOnRetrieval=%s" % (key, clearOnRetrieval),
-            lvl='d2', ss='ss_iblapi_memcache')
+    log.msg("memcache.retrieve: key=%s" % (key,), lvl='d2', ss='ss_iblapi_memcache')
 
-    memcacheClient = singleton.get('memCacheClient', strict=False)
-    if not memcacheClient:
-        raise Exception("memCacheClient not initialized yet!")
+    memcacheClient = _getClient()
     d = memcacheClient.get(key)
-    d.addCallback(_cbRetrieve, key, clearOnRetrieval, memcacheClient)
+    d.addCallback(_cbRetrieve, key)
     d.addErrback(lambda failure: log.msg(u"Could not make 'get' query to memcached daemon for key '%s'. Failure: %s" % (key, failure),
         lvl='e', ss='ss_iblapi_memcache'))
     return d
 
 
-def _cbRetrieve(getResult, key, clearOnRetrieval, memcacheClient):
+def _cbRetrieve(getResult, key):
     if getResult == (0, None):
         return None #key not found
+    return getResult[1]
+
+
+def _getClient():
+    memcacheClient = singleton.get('memCacheClient', strict=False)
+    if not memcacheClient:
+        raise Exception("memCacheClient not initialized yet!")
+    return memcacheClient
+
+
+def _encodeKeys(keys):
+    """@return: A dict mapping each key as sent to memcached (a bytestring) to the key as given"""
+    return dict([(isinstance(key, unicode) and key.encode('utf-8') or key, key) for key in keys])
+
+
+def retrieveAndDelete(key):
+    """
+    Retrieves content stored earlier and removes it from the memcache. The delete is sent right behind the get,
+    without waiting on its reply, so this takes a single round-trip.
     
-    if clearOnRetrieval:
-        d = memcacheClient.delete(key)
-        d.addCallback(_cbRetrievePhase2, getResult, key, clearOnRetrieval)
-    else:
-        d = defer.succeed(None) #no delete
-        d.addCallback(_cbRetrievePhase2, getResult, key, clearOnRetrieval)
+    @return: The cached data, or None if not found
+    """
+    assert key
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    
+    log.msg("memcache.retrieveAndDelete: key=%s" % (key,), lvl='d2', ss='ss_iblapi_memcache')
+
+    memcacheClient = _getClient()
+    dGet = memcacheClient.get(key)
+    dDelete = memcacheClient.delete(key)
+    d = defer.gatherResults([dGet, dDelete])
+    d.addCallback(_cbRetrieveAndDelete, key)
+    d.addErrback(lambda failure: log.msg(u"Could not make 'get'/'delete' queries to memcached daemon for key '%s'. Failure: %s"
+        % (key, failure), lvl='e', ss='ss_iblapi_memcache'))
     return d
 
 
-def _cbRetrievePhase2(deleteResult, getResult, key, clearOnRetrieval):
-    if getResult == False:
-        log.msg(u"memcache.retrieve: delete FAILED for key=%s" % (key,), lvl='w', ss='ss_iblapi_memcache')
-        
+def _cbRetrieveAndDelete((getResult, deleteResult), key):
+    if getResult == (0, None):
+        return None #key not found
+    if deleteResult == False:
+        log.msg(u"memcache.retrieveAndDelete: delete FAILED for key=%s" % (key,), lvl='w', ss='ss_iblapi_memcache')
     return getResult[1]
+
+
+def retrieveMany(keys):
+    """
+    Retrieves several keys with a single multi-key get.
+    
+    @param keys: The keys to get.
+    @return: A dict mapping each of the given keys to its cached data, or to None if not found. On failure, every
+        key maps to None.
+    """
+    keyMap = _encodeKeys(keys)
+    if not keyMap:
+        return defer.succeed({})
+    
+    log.msg("memcache.retrieveMany: %i keys" % (len(keyMap),), lvl='d2', ss='ss_iblapi_memcache')
+
+    memcacheClient = _getClient()
+    d = memcacheClient.getMultiple(keyMap.keys())
+    d.addCallback(lambda getResults: dict([(keyMap[key], value) for key, (flags, value) in getResults.iteritems()]))
+    d.addErrback(_ebRetrieveMany, keyMap)
+    return d
+
+
+def _ebRetrieveMany(failure, keyMap):
+    log.msg(u"Could not make 'get' query to memcached daemon for %i keys. Failure: %s" % (len(keyMap), failure),
+        lvl='e', ss='ss_iblapi_memcache')
+    return dict([(key, None) for key in keyMap.itervalues()])
+
+
+def storeMany(mapping, lifetime=consts.IBL_API_MEMCACHE_DEFAULT_LIFETIME):
+    """
+    Stores several key/content pairs. The sets are pipelined (all sent before any reply is waited on), so this
+    takes about as long as a single L{store}.
+    
+    @param mapping: A dict of key to content.
+    @param lifetime: See L{store}.
+    @return: A dict mapping each of the given keys to True if it was stored, or False if not.
+    """
+    if    lifetime < STORED_TOKEN_ACTIVE_PERIOD_MIN \
+       or lifetime > STORED_TOKEN_ACTIVE_PERIOD_MAX:
+        raise ValueError("lifetime parameter is out of bounds")
+    if not mapping:
+        return defer.succeed({})
+    
+    log.msg("memcache.storeMany: %i keys, lifetime=%s" % (len(mapping), lifetime), lvl='d2', ss='ss_iblapi_memcache')
+
+    memcacheClient = _getClient()
+    keys = mapping.keys()
+    dSets = []
+    for key in keys:
+        content = mapping[key]
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        dSets.append(memcacheClient.set(isinstance(key, unicode) and key.encode('utf-8') or key, content,
+            expireTime=lifetime))
+    d = defer.DeferredList(dSets, consumeErrors=True)
+    d.addCallback(_cbStoreMany, keys)
+    return d
+
+
+def _cbStoreMany(setResults, keys):
+    results = {}
+    for key, (success, result) in zip(keys, setResults):
+        if not success:
+            log.msg(u"Could not make 'set' query to memcached daemon for key '%s'. Failure: %s" % (key, result),
+                lvl='e', ss='ss_iblapi_memcache')
+        results[key] = success and result == True
+    return results
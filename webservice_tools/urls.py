@@ -7,6 +7,7 @@ urlpatterns = patterns('webservice_tools.views',
     (r'resetpass/?$', Resource(ResetPassHandler)),
     (r'locations/?$', Resource(PlacesHandler)),
     (r'amialive/?$', Resource(KeepAliveHandler)),
+    (r'metrics/?$', Resource(MetricsHandler)),
     (r'docs/?$', Resource(DocHandler)),
     (r'^apiconsole/?$', direct_to_template, {'template': 'apiconsole.html', 'extra_context': {'baseURL': '/%s/' % settings.SERVER_NAME}}),
     (r'^uploadtest/?$', direct_to_template, {'template': 'fileupload.html', 'extra_context': {'baseURL': '/%s/' % settings.SERVER_NAME}}),
@@ -8,13 +8,18 @@ import types
 import random
 import re
 import xml.sax.handler
-import socket
 import urllib
 import urllib2
 import simplejson
 import passwordpieces
 import base64
+import hashlib
 import logging
+import threading
+import time
+import Queue
+import itertools
+from collections import OrderedDict
 from xml.dom import minidom
 from django.utils import encoding
 from PIL import Image
@@ -23,15 +28,22 @@ from StringIO import StringIO
 from piston.resource import Resource as PistonResource
 from piston.handler import BaseHandler as PistonBaseHandler, HandlerMetaClass as PistonHandlerMetaClass
 from piston.emitters import Emitter, XMLEmitter as PistonXMLEmitter
+from piston.authentication import NoAuthentication
+from piston.utils import HttpStatusCode
 from webservice_tools.decorators import retry
+from webservice_tools.http_util import http_client
 from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.cache import cache
-from django.db import  models
+from django.db import  models, transaction, IntegrityError
 from django.contrib.gis.measure import D
 from django.core.paginator import EmptyPage, Paginator
 from django.contrib.gis.geos import fromstr
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.forms.models import fields_for_model
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.core.serializers.json import DateTimeAwareJSONEncoder
 
 JSON_INDENT = 4
 GOOGLE_API_KEY = "ABQIAAAAfoFQ0utZ24CUH1Mu2CNwjRT2yXp_ZAY8_ufC3CFXhHIE1NvwkxSbhhdGY56wVeZKZ-crGIkLMPghOA"
@@ -45,11 +57,178 @@ GOOGLE_QR_CODE_URL = "https://chart.googleapis.com/chart?cht=qr&chs=150x150&(dat
 SITE_SETTINGS_KEY = '%s_site_settings' % django_settings.SERVER_NAME
 GOOGLE_PLACES_SEARCH_URL = "https://maps.googleapis.com/maps/api/place/search/json?sensor=false&"
 GOOGLE_PLACES_DETAILS_URL = "https://maps.googleapis.com/maps/api/place/details/json?sensor=false&"
+STREAM_CHUNK_SIZE = 200
+STREAM_HEAD_SIZE = 65536 # characters encoded before a streamed response is committed to
+PAGE_COUNT_CACHE_PREFIX = 'auto_page_count_'
+RESPONSE_CACHE_PREFIX = 'response_cache'
+RESPONSE_GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+GEOCODE_CACHE_PREFIX = 'geocode_'
+GEOCODE_CACHE_SIZE = getattr(django_settings, 'GEOCODE_CACHE_SIZE', 5000) # entries kept in process
+GEOCODE_CACHE_TTL = getattr(django_settings, 'GEOCODE_CACHE_TTL', 60 * 60) # in-process lifetime, in seconds
+GEOCODE_CACHE_TIMEOUT = getattr(django_settings, 'GEOCODE_CACHE_TIMEOUT', 60 * 60 * 24 * 7) # django cache lifetime
+GEOCODE_NEGATIVE_TTL = getattr(django_settings, 'GEOCODE_NEGATIVE_TTL', 60 * 10) # how long invalid addresses are remembered
+GOOGLE_GEOCODE_INVALID_STATUSES = (601, 602, 603) # empty query, unknown address, address that can't be returned
+GEOCODE_COORD_PRECISION = 4 # decimal places coordinates are rounded to for cache keys (~11m)
+GEOCODE_QUEUE_BATCH_SIZE = getattr(django_settings, 'GEOCODE_QUEUE_BATCH_SIZE', 50)
+GEOCODE_QUEUE_BATCH_WAIT = getattr(django_settings, 'GEOCODE_QUEUE_BATCH_WAIT', 2) # seconds to collect a batch for
+GEOCODE_QUEUE_MAX_ATTEMPTS = 3 # times a row is retried if it isn't visible yet (saving transaction not committed)
+
+
+def make_etag(*parts):
+    """
+    Returns a quoted strong ETag derived from the given parts
+    """
+    return '"%s"' % hashlib.md5(':'.join([encoding.smart_str(p) for p in parts])).hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Checks an If-None-Match header value against an ETag, weak client tags compare equal to our strong ones
+    """
+    if not if_none_match or not etag:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
+
+
+def not_modified_response(etag):
+    response = HttpResponseNotModified()
+    response['ETag'] = etag
+    return response
+
+
+def model_generation_key(model):
+    return '%s:generation:%s.%s' % (RESPONSE_CACHE_PREFIX, model._meta.app_label, model._meta.object_name)
+
+
+def new_generation():
+    return '%s.%s' % (time.time(), random.randint(0, 1000000))
+
+
+def bump_model_generation(sender, **kwargs):
+    cache.set(model_generation_key(sender), new_generation(), RESPONSE_GENERATION_TIMEOUT)
+
+
+def watch_model(model):
+    """
+    Invalidates cached responses that depend on model whenever one of its rows is saved or deleted
+    Queryset update()s and bulk deletes don't send these signals, call bump_model_generation(model) after them
+    """
+    post_save.connect(bump_model_generation, sender=model, dispatch_uid='response_cache')
+    post_delete.connect(bump_model_generation, sender=model, dispatch_uid='response_cache')
+
+
+def model_generations(models):
+    """
+    Returns the current generation of each model, starting a fresh one for any the cache has lost
+    so responses cached under an older generation can never come back
+    """
+    keys = [model_generation_key(m) for m in models]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            generation = new_generation()
+            if not cache.add(key, generation, RESPONSE_GENERATION_TIMEOUT):
+                generation = cache.get(key, generation)
+            generations[key] = generation
+    return [generations[key] for key in keys]
+
+
 class Resource(PistonResource):
     
     def __init__(self, *args, **kwargs):
         super(Resource, self).__init__(*args, **kwargs)
         self.__name__ = 'foo'
+        if getattr(self.handler, 'stream_json', False):
+            # have piston hand the emitter's generator straight to the HttpResponse
+            self.stream = True
+        
+        # see decorators.cache_response
+        self.response_cache = getattr(getattr(self.handler, 'read', None), 'response_cache', None)
+        self.response_cache_models = []
+        if self.response_cache:
+            # cached bodies are served before piston authenticates the request, and are only kept apart by
+            # request.user, so the user must come from django's session auth rather than a piston authenticator
+            if any(not isinstance(a, NoAuthentication) for a in self.authentication):
+                raise ImproperlyConfigured("%s.read uses cache_response, which can't be combined with piston "
+                                           "authentication" % self.handler.__class__.__name__)
+            model = getattr(self.handler, 'model', None)
+            self.response_cache_models = [m for m in (model,) + self.response_cache['depends_on'] if m is not None]
+            for m in self.response_cache_models:
+                watch_model(m)
+    
+    def __call__(self, request, *args, **kwargs):
+        """
+        Adds conditional GET support: successful GETs get an ETag, either the one the handler derived from a
+        version key (see ResponseObject.not_modified) or a hash of the serialized body, and a matching
+        If-None-Match gets a 304 instead of the body.
+        Set use_etags = False on a handler to skip hashing its bodies.
+        Reads decorated with decorators.cache_response are served from the cache when possible.
+        Responses are flagged for middleware.compression.CompressResponse unless the handler sets compress = False.
+        """
+        resp = self._respond(request, *args, **kwargs)
+        resp.compressible = getattr(self.handler, 'compress', True)
+        return resp
+    
+    def _respond(self, request, *args, **kwargs):
+        em_format = self.determine_emitter(request, *args, **kwargs)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        response_object = kwargs.get('response')
+        if response_object is not None:
+            response_object.emitter_format = em_format
+            response_object.if_none_match = if_none_match
+        
+        cache_key = None
+        if request.method == 'GET' and self.response_cache:
+            cache_key = self.response_cache_key(request, em_format, args, kwargs)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                content, content_type, etag = cached
+                if etag_matches(if_none_match, etag):
+                    return not_modified_response(etag)
+                resp = HttpResponse(content, mimetype=content_type)
+                resp['ETag'] = etag
+                return resp
+        
+        resp = super(Resource, self).__call__(request, *args, **kwargs)
+        if request.method not in ('GET', 'HEAD') or resp.status_code != 200:
+            return resp
+        
+        streaming = getattr(resp, 'streaming', False)
+        etag = getattr(response_object, 'etag', None) or resp.get('ETag')
+        if etag is None and not streaming and (cache_key or getattr(self.handler, 'use_etags', True)):
+            etag = make_etag(resp.content)
+        if etag is None:
+            return resp
+        
+        if cache_key and not streaming and not getattr(response_object, '_messages', None):
+            cache.set(cache_key, (resp.content, resp['Content-Type'], etag), self.response_cache['timeout'])
+        
+        if etag_matches(if_none_match, etag):
+            return not_modified_response(etag)
+        resp['ETag'] = etag
+        return resp
+    
+    def response_cache_key(self, request, em_format, args, kwargs):
+        """
+        Keys a cached read on the handler, URL args, the GET params it varies on, the user (or just whether
+        there is one), the emitter format and the current generation of every model it depends on
+        """
+        spec = self.response_cache
+        if spec['vary_on'] is None:
+            params = sorted(request.GET.lists())
+        else:
+            params = [(k, request.GET.getlist(k)) for k in spec['vary_on']]
+        user = getattr(request, 'user', None)
+        authenticated = user is not None and user.is_authenticated()
+        if spec['per_user']:
+            user_key = authenticated and user.id or 'anon'
+        else:
+            user_key = authenticated and 'auth' or 'anon'
+        url_kwargs = sorted((k, v) for k, v in kwargs.items() if k not in ('response', 'emitter_format'))
+        key = make_etag(self.handler.__class__, args, url_kwargs, params, user_key, em_format,
+                        model_generations(self.response_cache_models))
+        return '%s:%s' % (RESPONSE_CACHE_PREFIX, key.strip('"'))
          
     def determine_emitter(self, request, *args, **kwargs):
         """
@@ -64,6 +243,11 @@ class Resource(PistonResource):
         
         if not em:
             em = request.GET.get('format', 'json')
+        
+        # JSONP callbacks and indented (DEBUG) output are only written by the buffered emitter
+        if em == 'json' and getattr(self.handler, 'stream_json', False) \
+          and not request.GET.get('callback') and not django_settings.DEBUG:
+            em = 'json-stream'
 
         return em
     def error_handler(self, e, request, meth, em_format):
@@ -123,7 +307,7 @@ class ListHandler(BaseHandler):
         if location:
             try:
                 lng, lat = GeoCode(address=location).getCoords()
-            except utils.GeoCodeError:
+            except GeoCodeError:
                 return response.send(errors="Invalid address.")
         
         if all([lat, lng, radius]):
@@ -141,18 +325,37 @@ class ListHandler(BaseHandler):
 
 class AutoListHandler(ListHandler):
     paging = True
+    # set to True to page with opaque 'after'/'before' cursors on cursor_key instead of page numbers
+    cursor_paging = False
+    # must be unique and indexed, prefix with '-' for descending order
+    cursor_key = 'id'
+    # seconds to cache the total row count for, None counts on every request
+    count_timeout = None
+    # set to True to have JSON responses encoded incrementally by StreamingJSONEmitter
+    stream_json = False
     
     def read(self, request, response):
         page_number = request.GET.get('page_number', 1)
         limit = request.GET.get('limit', 10)
         results = super(AutoListHandler, self).read(request, response)
+        if isinstance(results, HttpResponse):
+            return results
         if isinstance(self.model._meta.verbose_name_plural, basestring):
             name = re.sub(' ', '_', self.model._meta.verbose_name_plural).lower() 
         
         else:
             name = self.model.__name__.lower() + 's'
-        if self.paging:
-            results, paging_dict = auto_page(results, page_number=page_number, limit=limit)
+        if self.paging and self.cursor_paging:
+            try:
+                results, paging_dict = cursor_page(results, after=request.GET.get('after'),
+                                                   before=request.GET.get('before'), limit=limit,
+                                                   key=self.cursor_key, count_timeout=self.count_timeout)
+            except ValueError, e:
+                return response.send(errors="%s." % e)
+            response.set(**{name: results, 'paging': paging_dict})
+        elif self.paging:
+            results, paging_dict = auto_page(results, page_number=page_number, limit=limit,
+                                             count_timeout=self.count_timeout)
             response.set(**{name: results, 'paging': paging_dict})
         else:
             response.set(**{name: results})
@@ -161,18 +364,133 @@ class AutoListHandler(ListHandler):
     
             
 class XMLEmitter(PistonXMLEmitter):
+    """
+    Writes the same document as piston's XMLEmitter in a single pass over the data.
+    Output is appended to a list and joined once, text is escaped with one regex pass, and in
+    DEBUG mode the document is indented as it is written instead of being re-parsed and pretty printed.
+    """
+    indent = u'    '
+    
     def render(self, request):
-        result = super(XMLEmitter, self).render(request)
-        if django_settings.DEBUG:
-            result = prettyxml(minidom.parseString(result))
-        return result
+        out = [u'<?xml version="1.0" encoding="utf-8"?>\n']
+        self._write(out.append, u'response', self.construct(), 0, django_settings.DEBUG)
+        return u''.join(out).encode('utf-8')
+    
+    def _write(self, write, name, value, depth, pretty):
+        pad = pretty and self.indent * depth or u''
+        newline = pretty and u'\n' or u''
+        if isinstance(value, (list, tuple)):
+            children = [(u'resource', item) for item in value]
+        elif isinstance(value, dict):
+            children = value.items()
+        else:
+            write(u'%s<%s>%s</%s>%s' % (pad, name, escape_xml_text(encoding.smart_unicode(value)), name, newline))
+            return
+        
+        if not children:
+            write(u'%s<%s></%s>%s' % (pad, name, name, newline))
+            return
+        
+        write(u'%s<%s>%s' % (pad, name, newline))
+        for child_name, child in children:
+            self._write(write, child_name, child, depth + 1, pretty)
+        write(u'%s</%s>%s' % (pad, name, newline))
 
 Emitter.register('xml', XMLEmitter, 'text/xml; charset=utf-8')
 
+
+class StreamingJSONEmitter(Emitter):
+    """
+    Encodes the response envelope piece by piece instead of building one big string.
+    Querysets and lists found in the envelope are iterated and encoded `chunk_size` rows at a time,
+    so memory stays flat no matter how many rows a page returns.
+    The first `head_size` characters (and at least the first chunk of rows) are encoded before the
+    response is returned, so an error in them still becomes an error response rather than a cut off body.
+    """
+    chunk_size = STREAM_CHUNK_SIZE
+    head_size = STREAM_HEAD_SIZE
+    # envelope -> data -> values, anything nested deeper than this is encoded in one piece
+    stream_depth = 2
+    
+    def render(self, request):
+        return u''.join(self.stream_render(request))
+    
+    def stream_render(self, request):
+        # piston only turns an HttpStatusCode into its response (e.g. the 304 of ResponseObject.not_modified)
+        # while it's calling us, not once the body is being iterated, so raise it and encode the head here
+        if isinstance(self.data, HttpResponse):
+            raise HttpStatusCode(self.data)
+        self._row_emitter = Emitter(None, self.typemapper, self.handler, self.fields, self.anonymous)
+        self._rows_encoded = False
+        chunks = self._stream_value(self.data, 0)
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.head_size and self._rows_encoded:
+                break
+        return itertools.chain(head, chunks)
+    
+    def _encode(self, thing):
+        # one emitter for every row, construct() encodes whatever its data is
+        self._row_emitter.data = thing
+        constructed = self._row_emitter.construct()
+        return simplejson.dumps(constructed, cls=DateTimeAwareJSONEncoder, ensure_ascii=False)
+    
+    def _stream_value(self, value, depth):
+        if isinstance(value, dict) and depth < self.stream_depth:
+            return self._stream_dict(value, depth)
+        if isinstance(value, (QuerySet, list, tuple)):
+            return self._stream_list(value)
+        return iter([self._encode(value)])
+    
+    def _stream_dict(self, indict, depth):
+        yield u'{'
+        first = True
+        for k, v in indict.iteritems():
+            yield u'%s%s: ' % (u'' if first else u', ', simplejson.dumps(k))
+            first = False
+            for chunk in self._stream_value(v, depth + 1):
+                yield chunk
+        yield u'}'
+    
+    def _stream_list(self, rows):
+        if isinstance(rows, QuerySet):
+            # bypass the queryset's result cache so rows can be released as we go
+            rows = rows.iterator()
+        yield u'['
+        first = True
+        buf = []
+        for row in rows:
+            buf.append(self._encode(row))
+            if len(buf) >= self.chunk_size:
+                self._rows_encoded = True
+                yield (u'' if first else u', ') + u', '.join(buf)
+                first = False
+                buf = []
+        if buf:
+            self._rows_encoded = True
+            yield (u'' if first else u', ') + u', '.join(buf)
+        yield u']'
+
+Emitter.register('json-stream', StreamingJSONEmitter, 'application/json; charset=utf-8')
+
 def toDict(obj, r=4):
     """ 
     Returns a Dict representation of the given object, replacing object relations with ids
     this is handy for serializing a django model instance
+    Model instances are serialized from their class's compiled SerializerPlan rather than by
+    inspecting every attribute of every row.
+    """
+    if r and isinstance(obj, models.Model):
+        return get_serializer_plan(obj.__class__).serialize(obj, r)
+    return _reflective_to_dict(obj, r)
+
+
+def _reflective_to_dict(obj, r=4):
+    """
+    The original attribute walk behind toDict, used for dicts and non-model objects
     """
     isDict = isinstance(obj, types.DictType)
     if not any([hasattr(obj, '__dict__'), isDict]) or not r:
@@ -188,16 +506,83 @@ def toDict(obj, r=4):
     for k, v in generator:
         if k.startswith('_') or k.endswith('_set'): # ignore 'private' keys
             continue
-        elif type(v) is types.ObjectType or hasattr(v, '__dict__'):
-            ret[k] = toDict(v, r - 1)
-        elif hasattr(v, 'id'):
-            ret[k] = v.id
-        else:
-            ret[k] = v
+        ret[k] = _to_dict_value(v, r)
     
     return ret
 
 
+def _to_dict_value(v, r):
+    if type(v) is types.ObjectType or hasattr(v, '__dict__'):
+        return toDict(v, r - 1)
+    elif hasattr(v, 'id'):
+        return v.id
+    return v
+
+
+# values of these fields never carry a __dict__, so they can be copied as is
+PLAIN_FIELD_TYPES = (models.AutoField, models.CharField, models.TextField, models.IntegerField,
+                     models.BooleanField, models.NullBooleanField, models.DateField, models.TimeField,
+                     models.FloatField, models.DecimalField)
+
+_serializer_plans = {}
+
+class SerializerPlan(object):
+    """
+    What toDict emits for one model class, worked out once from the model's _meta:
+      plain -- field attnames whose values are copied straight across
+      foreign_keys -- attnames of FK fields, already holding the related id
+      nested -- fields whose values may be objects (files, geometries, custom fields) and get
+                walked one level deeper
+    """
+    def __init__(self, model):
+        self.model = model
+        self.plain = []
+        self.foreign_keys = []
+        self.nested = []
+        for field in model._meta.fields:
+            name = field.attname
+            if name.startswith('_') or name.endswith('_set'):
+                continue
+            if isinstance(field, models.ForeignKey):
+                self.foreign_keys.append(name)
+            elif isinstance(field, PLAIN_FIELD_TYPES):
+                self.plain.append(name)
+            else:
+                self.nested.append(name)
+        self.direct = self.plain + self.foreign_keys
+        self.names = frozenset(self.direct + self.nested)
+        # a fully loaded instance holds every field plus django's _state
+        self.instance_size = len(self.names) + 1
+    
+    def serialize(self, obj, r=4):
+        d = obj.__dict__
+        ret = {}
+        for name in self.direct:
+            if name in d:
+                ret[name] = d[name]
+        for name in self.nested:
+            if name in d:
+                ret[name] = _to_dict_value(d[name], r)
+        
+        if len(d) != self.instance_size:
+            # annotations, cached relations or deferred fields, pick up whatever the plan doesn't cover
+            for k, v in d.iteritems():
+                if k in self.names or k.startswith('_') or k.endswith('_set'):
+                    continue
+                ret[k] = _to_dict_value(v, r)
+        return ret
+
+
+def get_serializer_plan(model):
+    """
+    Returns the SerializerPlan for a model class, compiling it on first use
+    """
+    plan = _serializer_plans.get(model)
+    if plan is None:
+        plan = _serializer_plans[model] = SerializerPlan(model)
+    return plan
+
+
 def strToBool(str):
     if not isinstance(str, basestring):
         raise TypeError
@@ -340,23 +725,24 @@ def toXML(obj, objname, nodePrefix='', isCdata=False):
     """
     Converts python data structures into XML
     """
+    out = []
+    write = out.append
+    
     def getXML_dict(indict, objname=None):
-        h = u"<%s>" % objname
+        write(u"<%s>" % objname)
         for k, v in indict.items():
-            h += toXML(v, k)
-        h += u"</%s>" % objname
-        return h
+            getXML(v, k)
+        write(u"</%s>" % objname)
 
     def getXML_list(inlist, objname=None):
         if len(inlist) == 0:
             #return a set of tags to denote an empty list
             #or should we return a single tag like <bla/>?
-            return u"<%s></%s>" % (objname, objname)
+            write(u"<%s></%s>" % (objname, objname))
+            return
         
-        h = u""
         for i in inlist:
-            h += toXML(i, objname)
-        return h
+            getXML(i, objname)
 
     adapt = {
         dict: getXML_dict,
@@ -368,29 +754,31 @@ def toXML(obj, objname, nodePrefix='', isCdata=False):
         """
         This function generates XML for any Python object through recursive functions. It is easy to add
         specific handlers for your own object types for more complex output options.
+        Pieces are appended to a single buffer so large structures are built in linear time.
         
         From http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/440595
         """
         if obj == None:
-            return u''
-        if adapt.has_key(obj.__class__):
-            return adapt[obj.__class__](obj, objname)
-        else:
-            objXML = None
-            if hasattr(obj, 'toXML'):
-                objXML = obj.toXML(nodePrefix)
-                if not objXML: return u''
-            if not objXML:
-                objXML = unicode(obj)
-            if objXML and len(objXML) > 0:
-                if isCdata:
-                    return u"%s<%s><![CDATA[%s]]></%s>" % (nodePrefix, objname, objXML, objname)
-                else:
-                    return u"%s<%s>%s</%s>" % (nodePrefix, objname, objXML, objname)
+            return
+        if obj.__class__ in adapt:
+            adapt[obj.__class__](obj, objname)
+            return
+        objXML = None
+        if hasattr(obj, 'toXML'):
+            objXML = obj.toXML(nodePrefix)
+            if not objXML: return
+        if not objXML:
+            objXML = unicode(obj)
+        if objXML and len(objXML) > 0:
+            if isCdata:
+                write(u"%s<%s><![CDATA[%s]]></%s>" % (nodePrefix, objname, objXML, objname))
             else:
-                return u"%s<%s/>" % (nodePrefix, objname)
+                write(u"%s<%s>%s</%s>" % (nodePrefix, objname, objXML, objname))
+        else:
+            write(u"%s<%s/>" % (nodePrefix, objname))
     
-    return  getXML(obj, objname, nodePrefix, isCdata)
+    getXML(obj, objname, nodePrefix, isCdata)
+    return u''.join(out)
 
 
 
@@ -421,39 +809,322 @@ class GeoCodeError(Exception):
         return repr(self.msg)
 
 
+class GeoCodeUnavailable(GeoCodeError):
+    """
+    The geocoder couldn't be reached or didn't give a usable answer, which says nothing about the address itself
+    """
+
+
+def _geocode_request(url):
+    try:
+        return simplejson.loads(http_client.urlopen(url).read())
+    except (urllib2.URLError, ValueError), e:
+        # network errors, timeouts and 4xx/5xx responses (HTTPError) alike, as well as garbled bodies
+        raise GeoCodeUnavailable(str(e))
+
+
+class LRUCache(object):
+    """
+    A small thread safe in-process cache, holds at most max_size entries for ttl seconds each
+    and evicts the least recently used entry when full
+    """
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return default
+            if expires < time.time():
+                return default
+            # re-insert to mark as most recently used
+            self._entries[key] = (expires, value)
+            return value
+    
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + (ttl or self.ttl), value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GeoCodeCache(object):
+    """
+    Two level cache in front of the geocoder: an in-process LRU backed by the django cache.
+    Addresses/coordinates the geocoder found nothing for are remembered for GEOCODE_NEGATIVE_TTL seconds
+    (GeoCodeUnavailable failures aren't, they say nothing about the address), and concurrent
+    lookups of the same key wait on a single upstream call instead of each making their own.
+    """
+    INVALID = '__geocode_invalid__'
+    
+    def __init__(self, max_size=GEOCODE_CACHE_SIZE, ttl=GEOCODE_CACHE_TTL, timeout=GEOCODE_CACHE_TIMEOUT,
+                 negative_ttl=GEOCODE_NEGATIVE_TTL):
+        self.local = LRUCache(max_size, ttl)
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self._flights = {}
+        self._lock = threading.Lock()
+    
+    def address_key(self, kind, address):
+        address = encoding.smart_unicode(address).strip().lower()
+        address = re.sub(r'\s*,\s*', ', ', re.sub(r'\s+', ' ', address))
+        return u'%s:%s' % (kind, address)
+    
+    def coords_key(self, kind, latlng):
+        try:
+            lat, lng = [round(float(n), GEOCODE_COORD_PRECISION) for n in encoding.smart_unicode(latlng).split(',')]
+        except ValueError:
+            return self.address_key(kind, latlng)
+        return u'%s:%s,%s' % (kind, lat, lng)
+    
+    def _backend_key(self, key):
+        return GEOCODE_CACHE_PREFIX + hashlib.md5(key.encode('utf-8')).hexdigest()
+    
+    def _is_invalid(self, value):
+        return isinstance(value, tuple) and len(value) == 2 and value[0] == self.INVALID
+    
+    def _unpack(self, value):
+        if self._is_invalid(value):
+            raise GeoCodeError(value[1])
+        return value
+    
+    def get_or_fetch(self, key, fetch):
+        """
+        Returns the cached value for key, calling fetch() to fill it on a miss.
+        Raises GeoCodeError for keys that are known (or found) to be invalid.
+        """
+        value = self.local.get(key)
+        if value is not None:
+            return self._unpack(value)
+        
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        
+        if not leader:
+            flight.event.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+        
+        try:
+            backend_key = self._backend_key(key)
+            value = cache.get(backend_key)
+            if value is None:
+                try:
+                    value = fetch()
+                except GeoCodeUnavailable:
+                    raise
+                except GeoCodeError, e:
+                    value = (self.INVALID, e.msg)
+                    cache.set(backend_key, value, self.negative_ttl)
+                    self.local.set(key, value, self.negative_ttl)
+                    raise
+                cache.set(backend_key, value, self.timeout)
+            self.local.set(key, value, self._is_invalid(value) and self.negative_ttl or None)
+            flight.result = self._unpack(value)
+            return flight.result
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+geocode_cache = GeoCodeCache()
+
+
 class GeoCode():
     
     def __init__(self, address):
+        self.address = address
         self.query = friendlyURLEncode({'q': address})
     
+    @retry(exceptions=(GeoCodeUnavailable,))
     def _make_call(self):
-        return simplejson.loads(urllib2.urlopen(GOOGLE_API_URL + '&' + self.query).read())
+        return _geocode_request(GOOGLE_API_URL + '&' + self.query)
     
-    @retry(exception_raise=GeoCodeError("Invalid Address"))
-    def getResponse(self):
+    def _fetch_response(self):
         return  self._make_call()
     
-    @retry(exception_raise=GeoCodeError("Invalid Address"))
-    def getCoords(self):
+    def _fetch_coords(self):
         response = self._make_call()
-        coordinates = response['Placemark'][0]['Point']['coordinates'][0:2]
+        try:
+            coordinates = response['Placemark'][0]['Point']['coordinates'][0:2]
+        except (KeyError, IndexError, TypeError):
+            status = isinstance(response, dict) and response.get('Status', {}).get('code')
+            if status in GOOGLE_GEOCODE_INVALID_STATUSES:
+                raise GeoCodeError("Invalid Address")
+            # over the query limit, server error...
+            raise GeoCodeUnavailable("No coordinates in geocoder response (status %s)" % status)
         return tuple([float(n) for n in coordinates])
+    
+    def getResponse(self):
+        return geocode_cache.get_or_fetch(geocode_cache.address_key('response', self.address), self._fetch_response)
+    
+    def getCoords(self):
+        return geocode_cache.get_or_fetch(geocode_cache.address_key('coords', self.address), self._fetch_coords)
             
         
 class ReverseGeoCode():      
 
     def __init__(self, latlng):
+        self.latlng = latlng
         self.query = friendlyURLEncode({'latlng': latlng})
     
-    @retry(exception_raise=GeoCodeError("Invalid Coordinates"))
-    def getAddress(self):
-        response = simplejson.loads(urllib2.urlopen(GOOGLE_REVERSE_URL + '&' + self.query).read())
-        ret = response['results']
-        if not ret:
+    @retry(exceptions=(GeoCodeUnavailable,))
+    def _fetch_address(self):
+        response = _geocode_request(GOOGLE_REVERSE_URL + '&' + self.query)
+        ret = response.get('results')
+        if ret:
+            return ret
+        status = response.get('status', 'ZERO_RESULTS')
+        if status == 'ZERO_RESULTS':
             raise GeoCodeError('Invalid coordinates')
-        return ret
+        # OVER_QUERY_LIMIT, UNKNOWN_ERROR...
+        raise GeoCodeUnavailable('Reverse geocoder status %s' % status)
+    
+    def getAddress(self):
+        return geocode_cache.get_or_fetch(geocode_cache.coords_key('address', self.latlng), self._fetch_address)
             
 
+class GeoCodeQueue(object):
+    """
+    Background worker filling in geolocation for rows saved with deferred geocoding (see BaseGeoModel).
+    Rows are collected for up to batch_wait seconds or batch_size rows, each distinct address in the
+    batch is geocoded once and the points are written back with queryset update()s, so no save() signals fire.
+    A row is only updated if it still has the address that was geocoded, a save changing it in the meantime
+    queues the new address.
+    """
+    
+    def __init__(self, batch_size=GEOCODE_QUEUE_BATCH_SIZE, batch_wait=GEOCODE_QUEUE_BATCH_WAIT):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def put(self, model, pk, address, address_fields, attempts=0):
+        """
+        address_fields -- the row's address field values the address was built from, as a dict
+        """
+        self._queue.put((model, pk, address, address_fields, attempts))
+        self._ensure_worker()
+    
+    def qsize(self):
+        return self._queue.qsize()
+    
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='geocode-queue')
+                self._thread.daemon = True
+                self._thread.start()
+    
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        from django.db import connection
+        logger = logging.getLogger('webservice')
+        while True:
+            batch = self._next_batch()
+            try:
+                self.process(batch)
+            except Exception:
+                logger.exception("Deferred geocoding batch of %s rows failed" % len(batch))
+            finally:
+                # this thread holds its own connection, don't leave it open between batches
+                connection.close()
+    
+    def process(self, batch):
+        logger = logging.getLogger('webservice')
+        by_address = {}
+        for item in batch:
+            by_address.setdefault(item[2], []).append(item)
+        
+        for address, items in by_address.iteritems():
+            try:
+                lng, lat = GeoCode(address).getCoords()
+            except GeoCodeError:
+                logger.debug("Deferred geocoding: invalid address %r" % address)
+                continue
+            point = location_from_coords(lat, lng)
+            for model, pk, _, address_fields, attempts in self._write_point(point, items):
+                if attempts < GEOCODE_QUEUE_MAX_ATTEMPTS:
+                    self.put(model, pk, address, address_fields, attempts + 1)
+    
+    @transaction.commit_on_success
+    def _write_point(self, point, items):
+        """
+        Sets point on the rows that still have the address it was looked up for, each in its own savepoint so
+        a failing row (e.g. one whose point another row already has, geolocation being unique) doesn't abort
+        the rest. Returns the items whose row isn't visible yet (its saving transaction hadn't committed)
+        """
+        logger = logging.getLogger('webservice')
+        not_found = []
+        for item in items:
+            model, pk, address, address_fields, _ = item
+            sid = transaction.savepoint()
+            try:
+                updated = model.objects.filter(pk=pk, **address_fields).update(geolocation=point)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                logger.warning("Deferred geocoding: not updating %s %s, another row already has the point for %r"
+                               % (model.__name__, pk, address))
+                continue
+            except Exception:
+                transaction.savepoint_rollback(sid)
+                logger.exception("Deferred geocoding: could not update %s %s" % (model.__name__, pk))
+                continue
+            # nothing updated either because the row's address has changed since (nothing to do, the save that
+            # changed it queued the new one) or because the row isn't committed yet
+            if not updated and not model.objects.filter(pk=pk).exists():
+                not_found.append(item)
+        return not_found
+
+geocode_queue = GeoCodeQueue()
+
+
 class YahooPlacesSearch():
     
     def __init__(self, lat=None, lng=None, query='*', app_id=YAHOO_APPID, **kwargs):
@@ -470,7 +1141,7 @@ class YahooPlacesSearch():
         
     def fetch(self):
         args = friendlyURLEncode(self.arg_dict)
-        return simplejson.loads(urllib2.urlopen(YAHOO_LOCATION_URL + args).read())
+        return simplejson.loads(http_client.urlopen(YAHOO_LOCATION_URL + args).read())
 
 
 class GooglePlacesSearch():
@@ -482,7 +1153,7 @@ class GooglePlacesSearch():
 
     def fetch(self):
         args = friendlyURLEncode(self.arg_dict)
-        return simplejson.loads(urllib2.urlopen(GOOGLE_PLACES_SEARCH_URL + args).read())
+        return simplejson.loads(http_client.urlopen(GOOGLE_PLACES_SEARCH_URL + args).read())
 
 
 
@@ -490,7 +1161,7 @@ def google_places_details(reference):
     api_key = getattr(django_settings, 'GOOGLE_PLACES_API_KEY', '')
     args = friendlyURLEncode({'reference': reference, 'key': api_key})
     try:
-        return simplejson.loads(urllib2.urlopen(GOOGLE_PLACES_DETAILS_URL + args).read())['result']
+        return simplejson.loads(http_client.urlopen(GOOGLE_PLACES_DETAILS_URL + args).read())['result']
     except KeyError:
         return None
    
@@ -563,48 +1234,36 @@ def makeAPICall(domain, apiHandler, postData=None, rawPostData=None, queryData=N
         queryString = urllib.urlencode(queryData)
         url += "?" + queryString
     
-    req = urllib2.Request(url)
-    
-    if headers:
-        for k, v in headers.items():
-            req.add_header(k, v)
-    
+    requestHeaders = dict(headers)
     if userName is not None and password is not None:
         base64String = base64.encodestring('%s:%s' % (userName, password)).rstrip('\n')
         authheader = 'Basic %s' % base64String
-        req.add_header('Authorization', authheader)
-            
-    defaultTimeout = socket.getdefaulttimeout()
-    try:
-        socket.setdefaulttimeout(timeout)
-        if postData:
-            params = friendlyURLEncode(postData)
-            response = urllib2.urlopen(req, params)
-        
-        elif rawPostData:
-            response = urllib2.urlopen(req, rawPostData)
-            
-        else:
-            response = urllib2.urlopen(req)
-            
-        if deserializeAs == 'json':
-            response = simplejson.load(response, encoding='utf-8')
-        
-        elif deserializeAs == 'xml':
-            response = response.read().decode('utf-8')
-            response = fromXML(response)
-        
-        elif deserializeAs == 'utf-8': #skip
-            response = response.read().decode('utf-8')
-        
-        elif deserializeAs == None: # don't decode
-            response = response.read()
-        
-        elif deserializeAs == "skip":
-            pass
-            
-    finally:
-        socket.setdefaulttimeout(defaultTimeout)
+        requestHeaders['Authorization'] = authheader
+    
+    if postData:
+        data = friendlyURLEncode(postData)
+    elif rawPostData:
+        data = rawPostData
+    else:
+        data = None
+    
+    response = http_client.urlopen(url, data, headers=requestHeaders, timeout=timeout)
+    
+    if deserializeAs == 'json':
+        response = simplejson.load(response, encoding='utf-8')
+    
+    elif deserializeAs == 'xml':
+        response = response.read().decode('utf-8')
+        response = fromXML(response)
+    
+    elif deserializeAs == 'utf-8': #skip
+        response = response.read().decode('utf-8')
+    
+    elif deserializeAs == None: # don't decode
+        response = response.read()
+    
+    elif deserializeAs == "skip":
+        pass
         
     return response
 
@@ -665,6 +1324,15 @@ def escape_xml(xml):
     return re.sub('&', '&amp;', xml)
 
 
+XML_ESCAPE_REGEX = re.compile(u'[&<>]')
+XML_ESCAPE_TABLE = {u'&': u'&amp;', u'<': u'&lt;', u'>': u'&gt;'}
+def escape_xml_text(text):
+    """
+    Escapes character data for an XML text node in a single pass
+    """
+    return XML_ESCAPE_REGEX.sub(lambda m: XML_ESCAPE_TABLE[m.group()], text)
+
+
 def iso_8601_parse(time_string):
     """
     Y-m-dTH:M:S 
@@ -731,8 +1399,7 @@ def camel_to_under(name):
 def generate_qr_code(data):
     fetch_url = GOOGLE_QR_CODE_URL
     post_data = friendlyURLEncode({'chl': data})
-    request = urllib2.Request(fetch_url)
-    raw = urllib2.urlopen(request, post_data).read()
+    raw = http_client.urlopen(fetch_url, post_data).read()
     return StringIO(raw)
 
 def is_num(x):
@@ -748,15 +1415,42 @@ def is_valid_location(lat=None, long=None):
 
 
 
-def auto_page(results, page_number=1, limit=10):
+class CachedCountPaginator(Paginator):
+    """
+    A Paginator taking its total row count from cached_count rather than running a COUNT each time
+    """
+    
+    def __init__(self, object_list, per_page, count_timeout, **kwargs):
+        super(CachedCountPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.count_timeout = count_timeout
+        self._cached_count = None
+    
+    @property
+    def count(self):
+        if self._cached_count is None:
+            self._cached_count = cached_count(self.object_list, self.count_timeout)
+        return self._cached_count
+
+
+def auto_page(results, page_number=1, limit=10, count_timeout=None):
+    """
+    Page through results by page number
+    count_timeout -- when set, the total row count is cached for this many seconds rather than
+                     running a COUNT on every call (see cached_count)
+    """
     try:
         page_number = int(page_number)
         limit = int(limit)
     except ValueError:
         page_number = 1
         limit = 10
+    if limit < 1:
+        limit = 10
         
-    pages = Paginator(results, limit)
+    if count_timeout:
+        pages = CachedCountPaginator(results, limit, count_timeout)
+    else:
+        pages = Paginator(results, limit)
     try:
         page = pages.page(page_number)
     except EmptyPage:
@@ -764,17 +1458,8 @@ def auto_page(results, page_number=1, limit=10):
     
     results = page.object_list
     
-    try:
-        pages.page(page.next_page_number())
-        next_page = page.next_page_number()
-    except EmptyPage:
-        next_page = None
-    
-    try:
-        pages.page(page.previous_page_number())
-        previous_page = page.previous_page_number()
-    except EmptyPage:
-        previous_page = None
+    next_page = page.has_next() and page.next_page_number() or None
+    previous_page = page.has_previous() and page.previous_page_number() or None
         
     page_dict = {'page': page_number,
                  'next_page': next_page,
@@ -782,6 +1467,91 @@ def auto_page(results, page_number=1, limit=10):
                  'total_pages': pages.num_pages}
     return results, page_dict
 
+
+def cached_count(results, timeout=60):
+    """
+    Returns the number of rows in results, caching the COUNT for querysets for 'timeout' seconds.
+    The count may lag behind inserts and deletes by up to 'timeout' seconds.
+    """
+    if not isinstance(results, QuerySet):
+        return len(results)
+    try:
+        sql, params = results.query.get_compiler(results.db).as_sql()
+    except Exception:
+        return results.count()
+    key = PAGE_COUNT_CACHE_PREFIX + hashlib.md5(encoding.smart_str(repr((sql, params)))).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = results.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(simplejson.dumps(value, cls=DateTimeAwareJSONEncoder))
+
+
+def decode_cursor(cursor):
+    """
+    Raises ValueError for anything that isn't a cursor we handed out, i.e. a single key value
+    """
+    try:
+        value = simplejson.loads(base64.urlsafe_b64decode(encoding.smart_str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if isinstance(value, bool) or not isinstance(value, (basestring, int, long, float)):
+        raise ValueError("Invalid cursor")
+    return value
+
+
+def cursor_page(results, after=None, before=None, limit=10, key='id', count_timeout=None):
+    """
+    Keyset pagination, pages are selected with "key > cursor" (or "<") on an indexed column rather than
+    an OFFSET, so deep pages cost the same as the first one and no COUNT is needed.
+    
+    results -- queryset to page through, its ordering is replaced by 'key'
+    after/before -- opaque cursors taken from a previous page's 'next'/'previous'
+    key -- a unique, indexed field to order by, prefix with '-' for descending order
+    count_timeout -- when set, include 'total_pages' from a count cached for this many seconds
+    
+    Raises ValueError if a cursor can't be decoded or limit is below 1.
+    """
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 10
+    if limit < 1:
+        raise ValueError("Invalid limit")
+    
+    field = key.lstrip('-')
+    descending = key.startswith('-')
+    page_dict = {'limit': limit, 'next': None, 'previous': None}
+    if count_timeout:
+        page_dict['total_pages'] = int(math.ceil(cached_count(results, count_timeout) / float(limit))) or 1
+    
+    if before:
+        # walk backwards from the cursor, then flip the rows back into page order
+        lookup = descending and '__gt' or '__lt'
+        rows = list(results.filter(**{field + lookup: decode_cursor(before)})
+                           .order_by(descending and field or '-' + field)[:limit + 1])
+        has_previous, has_next = len(rows) > limit, True
+        rows = rows[:limit]
+        rows.reverse()
+    else:
+        if after:
+            lookup = descending and '__lt' or '__gt'
+            results = results.filter(**{field + lookup: decode_cursor(after)})
+        rows = list(results.order_by(key)[:limit + 1])
+        has_previous, has_next = bool(after), len(rows) > limit
+        rows = rows[:limit]
+    
+    if rows:
+        if has_next:
+            page_dict['next'] = encode_cursor(getattr(rows[-1], field))
+        if has_previous:
+            page_dict['previous'] = encode_cursor(getattr(rows[0], field))
+    return rows, page_dict
+
 def HTMLEscape(html):
     html_escape_table = {
                          "&": "&amp;",
@@ -7,11 +7,15 @@ from django.core.mail import send_mail
 from django.conf import settings
 from django.db.models import Q
 from webservice_tools.response_util import ResponseObject
-from webservice_tools.utils import GeoCode, strToBool, is_valid_email, ReverseGeoCode, YahooPlacesSearch, GooglePlacesSearch, BaseHandler
+from webservice_tools.utils import GeoCode, strToBool, is_valid_email, ReverseGeoCode, YahooPlacesSearch, GooglePlacesSearch, BaseHandler, \
+    etag_matches, not_modified_response
 from django.http import HttpResponse
+from django.core.cache import cache
 from django.views.generic.simple import direct_to_template
-from webservice_tools.doc_generator.server_declaration import ServerDeclaration
+from webservice_tools.doc_generator.server_declaration import get_server_declaration, docs_etag, DOCS_CACHE_TIMEOUT
 from webservice_tools.models import APIChangeLogEntry
+from webservice_tools.http_util import http_client
+from webservice_tools import metrics
 
 class GeoHandler(BaseHandler):
     allowed_methods = ('GET',)
@@ -83,13 +87,24 @@ class DocHandler(BaseHandler):
         """
         Return generated documentation in html format
         API Handler: GET /services/docs"""
-        server_declaration = ServerDeclaration()
-        context = {'handlers': server_declaration.handler_list}
-        context['servername'] = getattr(settings, 'SERVER_NAME', '')
-        context['developer_email'] = getattr(settings, 'ADMINS')[1][1]
-        context['changelog_entries'] = APIChangeLogEntry.objects.all()
+        etag = docs_etag()
+        if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), '"%s"' % etag):
+            return not_modified_response('"%s"' % etag)
         
-        return direct_to_template(request, 'apidocs.html', extra_context=context)
+        cache_key = 'api_docs:%s' % etag
+        content = cache.get(cache_key)
+        if content is None:
+            server_declaration = get_server_declaration()
+            context = {'handlers': server_declaration.with_examples()}
+            context['servername'] = getattr(settings, 'SERVER_NAME', '')
+            context['developer_email'] = getattr(settings, 'ADMINS')[1][1]
+            context['changelog_entries'] = APIChangeLogEntry.objects.all()
+            content = direct_to_template(request, 'apidocs.html', extra_context=context).content
+            cache.set(cache_key, content, DOCS_CACHE_TIMEOUT)
+        
+        ret = HttpResponse(content, mimetype='text/html; charset=%s' % settings.DEFAULT_CHARSET)
+        ret['ETag'] = '"%s"' % etag
+        return ret
 
 
 class PlacesHandler(BaseHandler):
@@ -164,6 +179,26 @@ class KeepAliveHandler(BaseHandler):
         return response.send()
 
 
+class MetricsHandler(BaseHandler):
+    internal = True
+    allowed_methods = ('GET',)
+
+    def read(self, request, response):
+        """
+        Latency, query and response size histograms per handler and method, plus outbound HTTP pool stats
+        API Handler: GET /services/metrics
+        GET Params:
+            @scope [string] "all" (default) to merge every worker process' numbers, "local" for this process only
+        """
+        if request.GET.get('scope') == 'local':
+            stats = metrics.registry.snapshot()
+        else:
+            stats = metrics.registry.merged_snapshot()
+        response.set(handlers=dict((key, metrics.summarize(value)) for key, value in stats.items()),
+                     outbound_http=http_client.stats())
+        return response.send()
+
+
 def changePass(request):
     
     response = ResponseObject()